@@ -0,0 +1,128 @@
+import sys
+sys.path.append("..")
+sys.path.append("../preprocessing")
+import os
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+import utils.config as config
+from utils.synthetic_data import generate_pings
+from compress_trajectory import compress_streaming
+from segment_trajectories_vectorized import prepare_pings, segment_compressed_pings
+from calculate_stay_points import calculate_stay_points, calculate_stay_points_skmob
+from building_blocks.BB4 import trajectory_velocity_stats
+
+
+'''
+End-to-end benchmark of the preprocessing stages on synthetic pings.
+
+    python benchmark_preprocessing.py [n_users ...]
+
+Every run is appended to the JSON history (config.benchmark_history) with the time of each stage, and compared with the
+last run of the same size so regressions are visible.
+'''
+
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+REFERENCE_MAX_USERS = 10_000 # the skmob stay point reference is only timed up to this size
+
+
+def _timed(timings, stage, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    timings[stage] = round(time.perf_counter() - start, 4)
+    print(f"{stage}: {timings[stage]:.2f}s")
+    return result
+
+
+def run_benchmark(n_users, seed = 0):
+    '''
+    Time every preprocessing stage on the synthetic pings of n_users, returning the entry of the history.
+    '''
+    pings = generate_pings(n_users, seed = seed)
+    timings = {}
+
+    grouped = _timed(timings, "group_same_datetime", prepare_pings, pings)
+    compressed = _timed(timings, "compress", compress_streaming, grouped, config.COMPRESSION_THRESHOLD, config.VELOCITY_THRESHOLD)
+    details, summary = _timed(timings, "segmentation", segment_compressed_pings, compressed)
+    stay_points = _timed(timings, "stay_points", calculate_stay_points, details)
+    reference_match = None
+    if n_users <= REFERENCE_MAX_USERS:
+        reference = _timed(timings, "stay_points_skmob", calculate_stay_points_skmob, details)
+        reference_match = _same_stay_points(stay_points, reference)
+    _timed(timings, "bb4_stats", trajectory_velocity_stats, details)
+
+    return dict(timestamp = pd.Timestamp.now(tz="UTC").isoformat(),
+                commit = _git_commit(),
+                n_users = n_users,
+                n_pings = len(pings),
+                n_compressed = len(compressed),
+                n_trajectories = len(summary),
+                n_stay_points = len(stay_points),
+                stay_points_match_skmob = reference_match,
+                seed = seed,
+                stages = timings,
+                total = round(sum(seconds for stage, seconds in timings.items() if stage != "stay_points_skmob"), 4),
+                python = platform.python_version(),
+                numpy = np.__version__,
+                pandas = pd.__version__)
+
+
+def _same_stay_points(stay_points, reference):
+    # same rows regardless of their order
+    columns = [config.USER_ID, "trajectory_id", "datetime_arrive", "datetime_leave", "lat", "lon", "stay_time"]
+    stay_points = stay_points.loc[:, columns].sort_values(columns).reset_index(drop=True)
+    reference = reference.loc[:, columns].sort_values(columns).reset_index(drop=True)
+    try:
+        pd.testing.assert_frame_equal(stay_points, reference, check_dtype = False)
+        return True
+    except AssertionError:
+        return False
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def load_history(path = config.benchmark_history):
+    if not os.path.exists(path):
+        return []
+    with open(path) as history_file:
+        return json.load(history_file)
+
+
+def append_history(entry, path = config.benchmark_history):
+    history = load_history(path)
+    history.append(entry)
+    with open(path, "w") as history_file:
+        json.dump(history, history_file, indent=2)
+
+
+def compare_with_previous(entry, history):
+    '''
+    Print the ratio of every stage time to the last run of the same size and seed.
+    '''
+    previous = [run for run in history if run["n_users"] == entry["n_users"] and run["seed"] == entry["seed"]]
+    if len(previous) == 0:
+        return
+    previous = previous[-1]
+    print(f"Compared with {previous['commit']} ({previous['timestamp']}):")
+    for stage, seconds in entry["stages"].items():
+        if stage in previous["stages"] and previous["stages"][stage] > 0:
+            print(f"    {stage}: {seconds:.2f}s vs {previous['stages'][stage]:.2f}s ({seconds / previous['stages'][stage]:.2f}x)")
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+
+    for n_users in sizes:
+        print(f"Benchmarking {n_users} users")
+        entry = run_benchmark(n_users)
+        compare_with_previous(entry, load_history())
+        append_history(entry)
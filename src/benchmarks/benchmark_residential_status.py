@@ -0,0 +1,38 @@
+import sys
+sys.path.append("..")
+import time
+from utils.synthetic_data import generate_profiles
+from building_blocks.BB9 import residential_status, get_res_status
+
+
+'''
+Timing of the residential status classifier of BB9 on synthetic merged profiles: the vectorized residential_status
+against the row by row get_res_status it replaced. Their parity is tested in tests/test_residential_status.py.
+
+    python benchmark_residential_status.py [n_rows ...]
+'''
+
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def run_benchmark(n_rows, seed = 0):
+    profiles = generate_profiles(n_rows, seed)
+
+    start = time.perf_counter()
+    profiles.apply(get_res_status, axis=1)
+    rowwise = time.perf_counter() - start
+
+    start = time.perf_counter()
+    residential_status(profiles)
+    vectorized = time.perf_counter() - start
+
+    print(f"{n_rows} rows: get_res_status {rowwise:.2f}s, residential_status {vectorized:.3f}s "
+          f"({rowwise / max(vectorized, 1e-9):.0f}x)")
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or DEFAULT_SIZES
+
+    for n_rows in sizes:
+        run_benchmark(n_rows)
@@ -1,5 +1,9 @@
+import numpy as np
+import pandas as pd
+import shapely
 import utils.config as config
 from utils.utils import get_reverse_polygon, check_coordinates_order
+from utils.point_in_polygon import PolygonIndex
 
 """
 BB1 - Trajectories crossing polygons
@@ -11,8 +15,14 @@ start_datetime, end_datetime - Time interval  for the trajectories that cross th
 
 Output:
 Trajectories that cross the given polygon in the given time interval grouped by user
+
+The *_multi functions take a list of polygons: the points in the bounding box of all the polygons are read once and
+joined with the polygons in memory (utils.point_in_polygon), the result has one row per polygon and row of the single
+polygon function, with the position of the polygon in the list in the polygon_position column.
 """
 
+EARTH_RADIUS = 6371008.8 # meters, the sphere radius of ST_DISTANCE
+
 def get_trajectory_details(trajectories_list, project, bigquery_client):
     
     #TO DO: if list of trajectories very big, UNNEST makes query too long
@@ -140,3 +150,141 @@ def BB1_by_day(polygon, project, bigquery_client):
     results = bigquery_client.query(query).to_dataframe()
     
     return results
+
+
+def _lon_lat_polygons(polygons):
+    return [get_reverse_polygon(polygon) if check_coordinates_order(polygon.__geo_interface__["coordinates"][0]) else polygon
+            for polygon in polygons]
+
+
+def _bounding_box_condition(polygons, geography):
+    min_lon, min_lat, max_lon, max_lat = shapely.total_bounds(polygons)
+    return f"""ST_X({geography}) BETWEEN {min_lon} AND {max_lon} AND ST_Y({geography}) BETWEEN {min_lat} AND {max_lat}"""
+
+
+def _join_polygons(points, index):
+    # one row per (row of points, polygon) pair, the lon and lat columns are replaced by polygon_position
+    positions, polygon_positions = index.join(points.lon.values, points.lat.values)
+    joined = points.iloc[positions].drop(columns=["lon", "lat"])
+    joined.insert(0, "polygon_position", polygon_positions)
+    return joined
+
+
+def _distance(lon_1, lat_1, lon_2, lat_2):
+    lon_1, lat_1, lon_2, lat_2 = map(np.radians, (lon_1, lat_1, lon_2, lat_2))
+    a = np.sin((lat_2 - lat_1) / 2) ** 2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def BB1_simple_multi(start_datetime, end_datetime, polygons, project, bigquery_client):
+    
+    polygons = _lon_lat_polygons(polygons)
+    if len(polygons) == 0:
+        return pd.DataFrame(columns=["polygon_position", "trajectory_id", config.USER_ID])
+    
+    query = f"""SELECT DISTINCT TRAJ.trajectory_id, TRAJ.{config.USER_ID}, 
+                ST_X(TRAJ_DET.geography) AS lon, ST_Y(TRAJ_DET.geography) AS lat
+    FROM {project}.{config.table_trajectories} AS TRAJ 
+    INNER JOIN {project}.{config.table_trajectory_details} AS TRAJ_DET 
+    ON TRAJ.trajectory_id = TRAJ_DET.trajectory_id 
+    WHERE TRAJ_DET.datetime BETWEEN '{start_datetime}' AND '{end_datetime}' 
+    AND {_bounding_box_condition(polygons, "TRAJ_DET.geography")}"""
+    
+    points = bigquery_client.query(query).to_dataframe()
+    results = _join_polygons(points, PolygonIndex(polygons)).drop_duplicates()
+    
+    return results.sort_values(["polygon_position", config.USER_ID], kind="stable").reset_index(drop=True)
+
+
+def BB1_as_details_multi(start_datetime, end_datetime, polygons, project_dataset, bigquery_client):
+    
+    polygons = _lon_lat_polygons(polygons)
+    if len(polygons) == 0:
+        return pd.DataFrame(columns=["polygon_position"])
+    
+    # all the points of the trajectories with a point in the bounding box in the time interval, in one query
+    query = f"""SELECT *, ST_X(geography) AS lon, ST_Y(geography) AS lat, 
+                datetime BETWEEN '{start_datetime}' AND '{end_datetime}' AS in_interval
+    FROM {project_dataset}.{config.table_trajectory_details} 
+    WHERE trajectory_id IN (SELECT temp_traj.trajectory_id 
+                            FROM {project_dataset}.{config.table_trajectory_details} as temp_traj
+                            WHERE temp_traj.datetime BETWEEN '{start_datetime}' AND '{end_datetime}' 
+                                AND {_bounding_box_condition(polygons, "temp_traj.geography")})"""
+    
+    details = bigquery_client.query(query).to_dataframe()
+    details["point"] = np.arange(len(details))
+    hits = _join_polygons(details.loc[:, ["point", "trajectory_id", "in_interval", "lon", "lat"]], PolygonIndex(polygons))
+    
+    # the trajectories of every polygon, with all their points, and the points in the polygon
+    crossing = hits.loc[hits.in_interval.fillna(False).astype(bool), ["polygon_position", "trajectory_id"]].drop_duplicates()
+    results = crossing.merge(details.drop(columns=["in_interval"]), on="trajectory_id")
+    results = results.merge(hits.loc[:, ["polygon_position", "point"]].assign(intersect_flag=True),
+                            on=["polygon_position", "point"], how="left")
+    results["intersect_flag"] = results.intersect_flag.fillna(False).astype(bool)
+    
+    # LAG over the points of the trajectories of the polygon, by user
+    results = results.sort_values(["polygon_position", config.USER_ID, "datetime"], kind="stable")
+    previous = results.groupby(["polygon_position", config.USER_ID], sort=False)[["geography", "lon", "lat"]].shift()
+    results["previous_point"] = previous.geography.where(previous.geography.notna(), None)
+    results["previous_distance"] = _distance(previous.lon.values, previous.lat.values, results.lon.values, results.lat.values)
+    
+    columns = ["polygon_position"] + [column for column in details.columns if column not in ("point", "lon", "lat", "in_interval")]
+    return results.loc[:, columns + ["previous_point", "previous_distance", "intersect_flag"]].reset_index(drop=True)
+
+
+def BB1_stay_points_multi(start_datetime, end_datetime, polygons, project, bigquery_client):
+    
+    polygons = _lon_lat_polygons(polygons)
+    if len(polygons) == 0:
+        return pd.DataFrame(columns=["polygon_position"])
+    
+    query = f"""SELECT *, ST_X(centroid_geography) AS lon, ST_Y(centroid_geography) AS lat 
+    FROM {project}.{config.table_stay_points} 
+    WHERE {_bounding_box_condition(polygons, "centroid_geography")} AND
+          ((datetime_arrive BETWEEN '{start_datetime}' AND '{end_datetime}') OR 
+           (datetime_leave BETWEEN '{start_datetime}' AND '{end_datetime}') OR
+           (datetime_arrive <= '{start_datetime}' AND datetime_leave >= '{end_datetime}'))"""
+    
+    stay_points = bigquery_client.query(query).to_dataframe()
+    results = _join_polygons(stay_points, PolygonIndex(polygons))
+    
+    return results.sort_values(["polygon_position", config.USER_ID], kind="stable").reset_index(drop=True)
+
+
+def BB1_by_datetime_multi(polygons, project, bigquery_client):
+    
+    polygons = _lon_lat_polygons(polygons)
+    if len(polygons) == 0:
+        return pd.DataFrame(columns=["polygon_position", "day", "hour", config.USER_ID, "trajectory_id"])
+    
+    query = f"""SELECT DISTINCT DATE(datetime) as day, 
+                EXTRACT(HOUR FROM datetime) as hour, 
+                {config.USER_ID}, 
+                trajectory_id, 
+                ST_X(geography) AS lon, ST_Y(geography) AS lat
+    FROM {project}.{config.table_trajectory_details}
+    WHERE {_bounding_box_condition(polygons, "geography")} AND
+          datetime < '{config.end_datetime_demo}'"""
+    
+    points = bigquery_client.query(query).to_dataframe()
+    results = _join_polygons(points, PolygonIndex(polygons)).drop_duplicates()
+    
+    return results.sort_values("polygon_position", kind="stable").reset_index(drop=True)
+
+
+def BB1_by_day_multi(polygons, project, bigquery_client):
+    
+    polygons = _lon_lat_polygons(polygons)
+    if len(polygons) == 0:
+        return pd.DataFrame(columns=["polygon_position", "date", config.USER_ID, "trajectory_id"])
+    
+    query = f"""SELECT DISTINCT DATE(datetime) as date, {config.USER_ID}, trajectory_id, 
+                ST_X(geography) AS lon, ST_Y(geography) AS lat
+    FROM {project}.{config.table_trajectory_details}
+    WHERE {_bounding_box_condition(polygons, "geography")} AND
+          datetime < '{config.end_datetime_demo}'"""
+    
+    points = bigquery_client.query(query).to_dataframe()
+    results = _join_polygons(points, PolygonIndex(polygons)).drop_duplicates()
+    
+    return results.sort_values("polygon_position", kind="stable").reset_index(drop=True)
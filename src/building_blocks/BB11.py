@@ -14,11 +14,12 @@ SELECT DISTINCT p.imsi, p.centroid_lat, p.centroid_lon FROM premise_users AS p )
     hotel_df = client.query(query).to_dataframe()
     hotel_df['night_stay_establishment'] = 'hotel'
 
-    other = f"""SELECT DISTINCT(imsi) FROM {project_dataset}.{config.table_user_night_location} WHERE DATE(day_part) = '{current_day_part}' AND night_stay_place = 'yes'"""
+    # the night location table holds the current profile of every user, its day_part is the last day the user was seen
+    other = f"""SELECT DISTINCT(imsi) FROM {project_dataset}.{config.table_user_night_location} WHERE night_stay_place = 'yes'"""
     other_df = client.query(other).to_dataframe()
     other_df['night_stay_establishment'] = 'other'
     
-    un = f"""SELECT DISTINCT(imsi) FROM {project_dataset}.{config.table_user_night_location} WHERE DATE(day_part) = '{current_day_part}' AND imsi NOT IN (SELECT DISTINCT(imsi) FROM {project_dataset}.{config.table_user_night_location} WHERE DATE(day_part) = '{current_day_part}' AND night_stay_place = 'yes')"""
+    un = f"""SELECT DISTINCT(imsi) FROM {project_dataset}.{config.table_user_night_location} WHERE imsi NOT IN (SELECT DISTINCT(imsi) FROM {project_dataset}.{config.table_user_night_location} WHERE night_stay_place = 'yes')"""
     un_df = client.query(un).to_dataframe()
     un_df['night_stay_establishment'] = 'undefined'
     other_un_df = other_df.append(un_df, ignore_index = True)
@@ -1,8 +1,10 @@
 import pandas as pd
 import numpy as np
 from shapely.wkt import loads
-from google.cloud import bigquery
 import utils.config as config
+from utils.utils import elect_top
+from utils.profile_store import BigQueryProfileStore
+from utils.day_parts import get_day_points, window_points
     
 def get_night_data_profile(night_df):
     night_df = night_df.sort_values(['imsi', 'datetime'], ascending=[True, True])
@@ -34,20 +36,9 @@ def merge_old_new_profile(new_df, old_df):
 
     
 def update_home(one_df):
-    
-    df_commute = one_df[one_df['stay_time']<config.min_night_stay_time].copy()
-    
-    df_commute.loc[:,'night_stay_place'] = 'other'
-
-    df_sorted = one_df.groupby('imsi', group_keys=False).apply(
-    lambda x: x[x['stay_time'] >= config.min_night_stay_time].sort_values(['night_count', 'stay_time'], ascending=False))
-
-    # Update label to 'home' for the first row within each group (highest count and time)
-    df_sorted['night_stay_place'] = df_sorted.groupby('imsi').cumcount().eq(0).map({True: 'yes', False: 'other'})
-    
-    # Reindex the DataFrame and drop the grouping level
-    home_df = df_sorted.append(df_commute, ignore_index=True)
-    return home_df
+    # the home is the place of the most nights (then the longest stay) among the places of long enough night stays
+    return elect_top(one_df, 'imsi', ['night_count', 'stay_time'], one_df['stay_time'] >= config.min_night_stay_time,
+                     'night_stay_place', others=one_df['stay_time'] < config.min_night_stay_time)
 
 
 def merge_day_night_users(night_df, day_df):  
@@ -68,24 +59,6 @@ def merge_day_night_users(night_df, day_df):
 
     return merged_df
     
-def load_results_to_table(client, dataset_id, destination_table_id, labelled_df, current_day_part):
-    labelled_df['day_part'] = current_day_part
-    #Delete rows from table
-    query = f"DELETE FROM {dataset_id}.{destination_table_id} WHERE 1=1"
-
-    job_config = bigquery.QueryJobConfig()
-    job_config.use_legacy_sql = False
-    client.query(query, job_config=job_config).result()
-    
-    # Load new data into table
-    job_config = bigquery.LoadJobConfig()
-    job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
-    
-    table_ref = client.dataset(dataset_id).table(destination_table_id)    
-
-    job = client.load_table_from_dataframe(labelled_df, table_ref, job_config=job_config)
-    job.result() 
-    
 def get_users_in_polygon(polygon_wkt, geo_df):    
     polygon = loads(polygon_wkt)
     # Filter the GeoDataFrame using the polygon
@@ -95,51 +68,29 @@ def get_users_in_polygon(polygon_wkt, geo_df):
 
     
 def get_data(client, source_table_id, current_day_part):
-    previous_day_part = pd.to_datetime(current_day_part) - pd.Timedelta(days=1)
-    
-    query1 = f""" WITH s2cells AS (
-              SELECT distinct S2_CELLIDFROMPOINT(geography, 16) as s2code, 
-              imsi,
-              datetime
-              FROM {source_table_id}
-              WHERE (day_part = DATE('{previous_day_part}') AND
-                    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 20 AND
-                        EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) < 24)) OR
-                        (day_part = '{current_day_part}' AND
-    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 0 AND
-    EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) < 8))
-                )
-                SELECT * FROM s2cells"""
-    
-    midnight_df = client.query(query1).to_dataframe()
-    
-    query2 = f""" WITH s2cells AS (
-              SELECT DISTINCT S2_CELLIDFROMPOINT(geography, 16) as s2code, 
-              imsi
-              FROM {source_table_id}
-              WHERE (day_part = DATE('{current_day_part}') AND
-                    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 8 AND
-                        EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) < 20))
-                )
-                SELECT s2code, imsi FROM s2cells"""
-    
-    day_df = client.query(query2).to_dataframe()
+    # points of the night (previous evening and early morning) with their time, users of the day by cell
+    points = get_day_points(client, source_table_id, current_day_part)
+    midnight_df = window_points(points, 'night', ['s2code', 'imsi', 'datetime'])
+    day_df = window_points(points, 'day', ['s2code', 'imsi'])
     
     return midnight_df, day_df
     
 
-def insert_user_stay_place(client, source_table_id, current_day_part, dataset, destination_table_id):
+def insert_user_stay_place(client, source_table_id, current_day_part, dataset, destination_table_id, store = None):
+    '''
+    Update the night locations of the users seen in the day. Only the rows of those users are read from the profile
+    store (by default the destination table) and replaced, the other users keep their rows and day_part.
+    '''
     current_day_part = pd.Timestamp(current_day_part).date()
+    if store is None:
+        store = BigQueryProfileStore(client, dataset, destination_table_id)
     
     midnight_df, day_df = get_data(client, source_table_id, current_day_part)
     new_df = midnight_df.groupby('s2code').apply(lambda x:get_night_data_profile(x)).reset_index()
     print('new df len:',len(new_df))
     
-    previous_day_part = current_day_part - pd.Timedelta(days=1)
-    sql_old=f"SELECT * FROM {dataset}.{destination_table_id}"
-    # sql_old=f"SELECT * FROM {dataset}.{destination_table_id} WHERE day_part = DATE('{previous_day_part}')"
-    old_df= client.query(sql_old).to_dataframe()
-    old_df.drop('day_part', axis = 1)
+    users = pd.concat([new_df.imsi, day_df.imsi]).unique()
+    old_df = store.read(users)
     
     if(len(old_df)!=0):
         latest_df = merge_old_new_profile(new_df, old_df)
@@ -148,7 +99,6 @@ def insert_user_stay_place(client, source_table_id, current_day_part, dataset, d
     
     labelled_df= update_home(latest_df)
     full_df = merge_day_night_users(labelled_df, day_df)
-
-    # Get the datatypes of columns
-    column_types = full_df.dtypes
-    load_results_to_table(client, dataset, destination_table_id, full_df, current_day_part)
+    full_df['day_part'] = current_day_part
+    
+    store.replace(full_df)
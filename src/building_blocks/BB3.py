@@ -3,6 +3,8 @@ from google.cloud import bigquery
 import numpy as np
 from shapely.wkt import loads
 import utils.config as config
+from utils.utils import elect_top
+from utils.day_parts import get_day_points, window_points
     
 def get_day_data_profile(day_df):
     day_df = day_df.sort_values(['imsi', 'datetime'], ascending=[True, True])
@@ -38,26 +40,10 @@ def merge_old_new_profile(new_df, old_df):
 
     
 def update_work(one_df):
-    
-    df_commute = one_df[(one_df['stay_time']<config.min_night_stay_time) | (one_df['day_count'] <= 2)].copy()
-    df_commute.loc[:, 'work_place']= 'other'
-    print((df_commute))
-
-    # Sort the DataFrame within each group by 'count' and 'time' in descending order
-    #df_sorted = one_df.groupby('imsi', group_keys=False).apply(lambda x: x.sort_values(['day_count', 'stay_time'], ascending=False))
-    df_sorted = one_df.groupby('imsi', group_keys=False).apply(
-    lambda x: x[(x['stay_time'] >= config.min_night_stay_time) & (x['day_count'] > 2)].sort_values(['day_count', 'stay_time'], ascending=False)
-)
-
-
-    # Update label to 'home' for the first row within each group (highe\\\\\st count and time)
-    df_sorted['work_place'] = df_sorted.groupby('imsi').cumcount().eq(0).map({True: 'yes', False: 'other'})
-    print((df_sorted))
-    # Reindex the DataFrame and drop the grouping level
-    #df_sorted = df_sorted.reset_index(drop=True)
-    work_df = df_sorted.append(df_commute, ignore_index=True)
-    print(work_df)
-    return work_df
+    # the work place is the place of the most days (then the longest stay) among the places of long enough day stays
+    eligible = (one_df['stay_time'] >= config.min_night_stay_time) & (one_df['day_count'] > 2)
+    others = (one_df['stay_time'] < config.min_night_stay_time) | (one_df['day_count'] <= 2)
+    return elect_top(one_df, 'imsi', ['day_count', 'stay_time'], eligible, 'work_place', others=others)
 
 def merge_day_night_users(day_df, midnight_df):  
     #merge day and day users to get total count of users
@@ -103,34 +89,10 @@ def get_users_in_polygon(polygon_wkt, geo_df):
 
     
 def get_data(client, source_table_id, current_day_part):
-    previous_day_part = pd.to_datetime(current_day_part) - pd.Timedelta(days=1)
-    
-    query1 = f""" WITH s2cells AS (
-              SELECT DISTINCT S2_CELLIDFROMPOINT(geography, 16) as s2code, 
-              imsi
-              FROM {source_table_id}
-              WHERE (day_part = DATE('{previous_day_part}') AND
-                    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 18 AND
-                        EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) < 24)) OR
-                        (day_part = '{current_day_part}' AND
-    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 0 AND
-    EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) < 8)) AND imsi = 'swMbUYC/r6BFFLeE1YO3OL+TNkusa5hqc9wNGVFjem8='
-                )
-                SELECT * FROM s2cells"""
-    
-    midnight_df = client.query(query1).to_dataframe() 
-    
-    query2 = f""" WITH s2cells AS (
-              SELECT distinct S2_CELLIDFROMPOINT(geography, 16) as s2code, 
-              imsi, datetime
-              FROM {source_table_id}
-              WHERE (day_part = DATE('{current_day_part}') AND
-                    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 8 AND
-                        EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) < 18)) AND imsi = 'swMbUYC/r6BFFLeE1YO3OL+TNkusa5hqc9wNGVFjem8='
-                )
-                SELECT * FROM s2cells"""
-    
-    day_df = client.query(query2).to_dataframe()
+    # users of the night (outside work hours) by cell, points of the work hours with their time
+    points = get_day_points(client, source_table_id, current_day_part)
+    midnight_df = window_points(points, 'off_work', ['s2code', 'imsi'])
+    day_df = window_points(points, 'work', ['s2code', 'imsi', 'datetime'])
    
     return midnight_df, day_df
     
@@ -13,6 +13,13 @@ def get_trajectory_stats(time_start, time_end, project_dataset, client):
                                             AND start_time >= '{time_start}' AND start_time < '{time_end}')"""
 
     trajectory_details = client.query(query).to_dataframe()
+    return trajectory_velocity_stats(trajectory_details)
+
+
+def trajectory_velocity_stats(trajectory_details):
+    '''
+    Velocity and acceleration features of every trajectory, the input of the mode of transport classifier.
+    '''
     trajectory_stats = trajectory_details.groupby("trajectory_id").agg(v_ave = ("velocity", "mean"),
                                                                        v_med = ("velocity", "median"),
                                                                        v_max = ("velocity", "max"),
@@ -3,6 +3,20 @@ from scipy.stats import zscore
 from utils.utils import list_polygon_to_s2list, list_polygon_to_section, list_polygon_to_freguesia, split_dates
 import numpy as np
 from utils import config
+from utils.cell_index import get_cell_index
+from utils.hll import sketch, count_distinct
+from utils.bigquery_utils import upload_table_bq, table_exists
+
+
+'''
+Traffic flow per cell, section and freguesia, read from the cell occupancy cube (config.table_cell_occupancy): the
+distinct users per cell (config.s2_level), day and hour, appended every hour by the pipeline with insert_cell_occupancy
+after delete_cell_occupancy removed the rows of a previous run of the day. The days processed before the cube existed
+are filled from the trajectory details with preprocessing/backfill_cell_occupancy.py. With
+config.cell_occupancy_sketches the cube also keeps the HyperLogLog sketch of the users of every row (utils.hll), from
+which the users of sections, freguesias and whole periods are estimated; without them those counts are read from the
+trajectory details.
+'''
 
 
 def get_spatial_significance(df):
@@ -15,24 +29,103 @@ def get_temporal_significance(df):
     return df
 
 
+def delete_cell_occupancy(day, project_dataset, bq_client):
+    '''
+    Delete the rows of the day from the cell occupancy cube, before its hours are inserted again (a re-run of the day
+    or a backfill), so that the cube keeps one row per cell, day and hour.
+    '''
+    table = f"{project_dataset}.{config.table_cell_occupancy}"
+    if not table_exists(table, bq_client):
+        return
+    sql = f"""DELETE FROM {table}
+              WHERE day = DATE('{pd.Timestamp(day).date()}')"""
+    bq_client.query(sql).result()
+
+
+def insert_cell_occupancy(time_start, time_end, project_dataset, bq_client):
+    '''
+    Append the distinct users per cell of the points between time_start and time_end (an hour) to the cell occupancy
+    cube, with their sketches when config.cell_occupancy_sketches.
+    '''
+    sql = f"""SELECT DISTINCT S2_CELLIDFROMPOINT(geography, {config.s2_level}) AS s2_id, {config.USER_ID}, 
+                     DATE(datetime) as day, EXTRACT(HOUR FROM datetime) as hour
+              FROM {project_dataset}.{config.table_trajectory_details}
+              WHERE datetime >= '{time_start}' AND datetime < '{time_end}'"""
+    
+    people_per_cell = bq_client.query(sql).to_dataframe()
+    occupancy = people_per_cell.groupby(["s2_id", "day", "hour"]).agg(unique_users = (config.USER_ID, "nunique")).reset_index()
+    schema = {}
+    if config.cell_occupancy_sketches:
+        # the groups of sketch are in the same order as the groups of the aggregation
+        occupancy["sketch"] = sketch(people_per_cell, ["s2_id", "day", "hour"]).sketch.values
+        schema = {"sketch": "bytes"}
+    upload_table_bq(occupancy, f"{project_dataset}.{config.table_cell_occupancy}", schema, bq_client)
+    
+    return
+
+
+def get_cell_occupancy(start_time, end_time, bq_client, project_dataset, cells = None, sketches = False):
+    '''
+    Rows of the cell occupancy cube of the hours that overlap the period from start_time to end_time, for the given
+    cells or for all of them, with the sketches of the users when sketches. Periods are read by whole hours.
+    '''
+    columns = ["s2_id", "day", "hour", "unique_users"] + (["sketch"] if sketches else [])
+    if cells is not None and len(cells) == 0:
+        return pd.DataFrame(columns = columns)
+    
+    # the cells are selected here and not in the query, where the cells of a large polygon would not fit
+    sql = f"""SELECT {", ".join(columns)}
+              FROM {project_dataset}.{config.table_cell_occupancy}
+              WHERE day BETWEEN DATE('{start_time}') AND DATE('{end_time}')"""
+    
+    occupancy = bq_client.query(sql).to_dataframe()
+    # days as dates, whatever the DATE type of the client, as the days of the traffic flows they are merged with
+    occupancy["day"] = pd.to_datetime(occupancy.day).dt.date
+    hours = pd.to_datetime(occupancy.day) + pd.to_timedelta(occupancy.hour, unit = "h")
+    in_period = (hours + pd.Timedelta(hours = 1) > pd.Timestamp(start_time)) & (hours < pd.Timestamp(end_time))
+    if cells is not None:
+        in_period &= np.isin(occupancy.s2_id.values, np.asarray(cells).astype("int64"))
+    return occupancy.loc[in_period.values, columns].reset_index(drop = True)
+
+
+def count_people_per_code(codes, code_column, start_time, end_time, bq_client, project_dataset):
+    '''
+    Distinct users per code (sccode, frcode), day and hour in the polygons with the given codes. Only the cells of those
+    polygons are read, they are mapped to their codes with the cell index. The counts are estimated from the sketches of
+    the cell occupancy cube when it has them.
+    '''
+    cell_index = get_cell_index(bq_client, project_dataset)
+    cells = cell_index.cells_of(codes, code_column)
+    if len(cells) == 0:
+        return pd.DataFrame(columns = [code_column, "day", "hour", "unique_users"])
+    
+    if config.cell_occupancy_sketches:
+        occupancy = get_cell_occupancy(start_time, end_time, bq_client, project_dataset, cells = cells, sketches = True)
+        positions, cell_codes = cell_index.join(occupancy.s2_id.values, code_column)
+        occupancy = occupancy.iloc[positions].assign(**{code_column: cell_codes})
+        return count_distinct(occupancy, [code_column, "day", "hour"], column = "unique_users")
+    
+    sql = f"""SELECT DISTINCT S2_CELLIDFROMPOINT(geography, {config.s2_level}) AS s2_id, {config.USER_ID}, 
+                     DATE(datetime) as day, EXTRACT(HOUR FROM datetime) as hour
+              FROM {project_dataset}.{config.table_trajectory_details}
+              WHERE datetime BETWEEN '{start_time}' AND '{end_time}'"""
+    
+    people_per_cell = bq_client.query(sql).to_dataframe()
+    people_per_cell = people_per_cell.loc[np.isin(people_per_cell.s2_id.values, cells)].assign(
+        day = lambda frame: pd.to_datetime(frame.day).dt.date)
+    positions, cell_codes = cell_index.join(people_per_cell.s2_id.values, code_column)
+    people_per_cell = people_per_cell.iloc[positions].assign(**{code_column: cell_codes})
+    return people_per_cell.groupby([code_column, "day", "hour"]).agg(unique_users = (config.USER_ID, "nunique")).reset_index()
+
+
 def large_traffic_flow(area_polygon, start_time, end_time, bq_client, project_dataset, **kwargs):
     
     if kwargs.get("polygon_cover") is None:
-        s2_polygon_cover = list_polygon_to_s2list(area_polygon, config.s2_level, bq_client)
+        s2_polygon_cover = list_polygon_to_s2list(area_polygon, bq_client)
     else:
         s2_polygon_cover = kwargs["polygon_cover"]
     
-    sql = f"""WITH s2cells AS (
-                  SELECT S2_CELLIDFROMPOINT(geography, {config.s2_level}) as s2_id, {config.USER_ID}, 
-                  DATE(datetime) as day, EXTRACT(HOUR FROM datetime) as hour
-                  FROM {project_dataset}.{config.table_trajectory_details}
-                  WHERE datetime BETWEEN '{start_time}' AND '{end_time}'
-              )
-              SELECT s2_id, day, hour, COUNT(DISTINCT {config.USER_ID}) as unique_users
-              FROM s2cells
-              GROUP BY s2_id, day, hour"""
-    
-    people_per_cell = bq_client.query(sql).to_dataframe()
+    people_per_cell = get_cell_occupancy(start_time, end_time, bq_client, project_dataset, cells = s2_polygon_cover)
     days_hours = split_dates(start_time, end_time, granularity = {"hours": 1})
     polygon_cover_df = pd.DataFrame(np.array([[int(s2_id), int(day.split("-")[-1]), hour, 0] for s2_id in s2_polygon_cover for (day, hour) in days_hours]), 
                                     columns = ["s2_id", "day", "hour", "default_number"], dtype=int)
@@ -51,22 +144,7 @@ def large_traffic_flow_section(area_polygon, start_time, end_time, bq_client, pr
     else:
         section_polygon_cover = kwargs["polygon_cover"]
     
-    sql = f"""WITH s2cells AS (
-                  SELECT CAST(S2_CELLIDFROMPOINT(geography, {config.s2_level}) AS STRING) AS s2_id, {config.USER_ID}, 
-                  DATE(datetime) as day, EXTRACT(HOUR FROM datetime) as hour
-                  FROM {project_dataset}.{config.table_trajectory_details}
-                  WHERE datetime BETWEEN '{start_time}' AND '{end_time}'
-              ),
-              scc_mapper AS (
-                  SELECT DISTINCT s2code, sccode
-                  FROM {project_dataset}.{config.table_polygons}
-                  WHERE polygon_description = 'Celula'
-              )
-              SELECT CAST(scc_mapper.sccode AS STRING) AS sccode, s2cells.day, s2cells.hour, COUNT(DISTINCT s2cells.{config.USER_ID}) as unique_users
-              FROM s2cells INNER JOIN scc_mapper ON s2cells.s2_id = scc_mapper.s2code
-              GROUP BY scc_mapper.sccode, s2cells.day, s2cells.hour"""
-    
-    people_per_section = bq_client.query(sql).to_dataframe()
+    people_per_section = count_people_per_code(section_polygon_cover, "sccode", start_time, end_time, bq_client, project_dataset)
     days_hours = split_dates(start_time, end_time, granularity = {"hours": 1})
     polygon_cover_df = pd.DataFrame(np.array([[sccode, day.split("-"), hour, 0] for sccode in section_polygon_cover for (day, hour) in days_hours], dtype=object), 
                                     columns = ["sccode", "day", "hour", "default_number"])
@@ -87,21 +165,7 @@ def large_traffic_flow_freguesia(area_polygon, start_time, end_time, bq_client,
     else:
         freguesia_polygon_cover = kwargs["polygon_cover"]
     
-    sql = f"""WITH s2cells AS (
-                  SELECT CAST(S2_CELLIDFROMPOINT(geography, {config.s2_level}) AS STRING) AS s2_id, {config.USER_ID}, 
-                  DATE(datetime) as day, EXTRACT(HOUR FROM datetime) as hour
-                  FROM {project_dataset}.{config.table_trajectory_details}
-                  WHERE datetime BETWEEN '{start_time}' AND '{end_time}'
-              ),
-              frc_mapper AS (
-                  SELECT DISTINCT s2code, frcode
-                  FROM {project_dataset}.{config.table_polygons}
-              )
-              SELECT CAST(frc_mapper.frcode AS STRING) AS frcode, s2cells.day, s2cells.hour, COUNT(DISTINCT s2cells.{config.USER_ID}) as unique_users
-              FROM s2cells INNER JOIN frc_mapper ON s2cells.s2_id = frc_mapper.s2code
-              GROUP BY frc_mapper.frcode, s2cells.day, s2cells.hour"""
-    
-    people_per_freguesia = bq_client.query(sql).to_dataframe()
+    people_per_freguesia = count_people_per_code(freguesia_polygon_cover, "frcode", start_time, end_time, bq_client, project_dataset)
     days_hours = split_dates(start_time, end_time, granularity = {"hours": 1})
     polygon_cover_df = pd.DataFrame(np.array([[frcode, day.split("-"), hour, 0] for frcode in freguesia_polygon_cover for (day, hour) in days_hours], dtype=object), 
                                     columns = ["frcode", "day", "hour", "default_number"])
@@ -118,21 +182,25 @@ def large_traffic_flow_freguesia(area_polygon, start_time, end_time, bq_client,
 def traffic_flow(area_polygon, start_time, end_time, bq_client, project_dataset, **kwargs):
     
     if kwargs.get("polygon_cover") is None:
-        s2_polygon_cover = list_polygon_to_s2list(area_polygon, config.s2_level, bq_client)
+        s2_polygon_cover = list_polygon_to_s2list(area_polygon, bq_client)
     else:
         s2_polygon_cover = kwargs["polygon_cover"]
     
-    sql = f"""WITH s2cells AS (
-                  SELECT S2_CELLIDFROMPOINT(geography, {config.s2_level}) as s2_id, {config.USER_ID} 
-                  FROM {project_dataset}.{config.table_trajectory_details}
-                  WHERE datetime BETWEEN '{start_time}' AND '{end_time}'
-              )
-              SELECT s2_id, COUNT(DISTINCT {config.USER_ID}) as unique_users
-              FROM s2cells
-              GROUP BY s2_id
-           """
+    if config.cell_occupancy_sketches:
+        occupancy = get_cell_occupancy(start_time, end_time, bq_client, project_dataset, cells = s2_polygon_cover, sketches = True)
+        people_per_cell = count_distinct(occupancy, ["s2_id"], column = "unique_users")
+    else:
+        sql = f"""WITH s2cells AS (
+                      SELECT S2_CELLIDFROMPOINT(geography, {config.s2_level}) as s2_id, {config.USER_ID} 
+                      FROM {project_dataset}.{config.table_trajectory_details}
+                      WHERE datetime BETWEEN '{start_time}' AND '{end_time}'
+                  )
+                  SELECT s2_id, COUNT(DISTINCT {config.USER_ID}) as unique_users
+                  FROM s2cells
+                  GROUP BY s2_id
+               """
+        people_per_cell = bq_client.query(sql).to_dataframe()
     
-    people_per_cell = bq_client.query(sql).to_dataframe()
     polygon_cover_df = pd.DataFrame(np.array([[s2_id, 0] for s2_id in s2_polygon_cover]), columns = ["s2_id", "default_number"])
     joined_counts = polygon_cover_df.merge(people_per_cell, how="left", on="s2_id")
     joined_counts["number_users"] = np.fmax(joined_counts.unique_users, joined_counts.default_number)
@@ -144,17 +212,12 @@ def traffic_flow(area_polygon, start_time, end_time, bq_client, project_dataset,
 def temporal_traffic_anomaly(s2cell_id, bq_client, project_dataset):
     
     
-    sql = f"""WITH dates AS (
-                  SELECT EXTRACT(DAYOFWEEK FROM datetime) as week_day, 
-                         EXTRACT(HOUR FROM datetime) as hour,
-                         EXTRACT(DAYOFYEAR from datetime) as day, 
-                         {config.USER_ID} 
-                  FROM {project_dataset}.{config.table_trajectory_details}
-                  WHERE S2_CELLIDFROMPOINT(geography, {config.s2_level}) = {s2cell_id}
-              )
-              SELECT week_day, hour, day, COUNT(DISTINCT {config.USER_ID}) as unique_users
-              FROM dates
-              GROUP BY week_day, hour, day
+    sql = f"""SELECT EXTRACT(DAYOFWEEK FROM day) as week_day, 
+                     hour,
+                     EXTRACT(DAYOFYEAR from day) as day, 
+                     unique_users
+              FROM {project_dataset}.{config.table_cell_occupancy}
+              WHERE s2_id = {s2cell_id}
            """
 
     cell_traffic = bq_client.query(sql).to_dataframe()
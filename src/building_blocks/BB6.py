@@ -1,9 +1,14 @@
 from utils.bigquery_utils import upload_table_bq
 import utils.config as config
+from utils.cell_index import get_cell_index, join_cell_arrays
 
 
-def BB6_section(time_start, time_end, project_dataset, bq_client):
-    
+def hourly_legs(time_start, time_end, project_dataset, bq_client, cell_index):
+    '''
+    Legs between consecutive stay points leaving in the hour, with the section where they start (start_scc) and the
+    residency status of the user in it, the transport mode, the professional status, and the arrays of home and work
+    cells of the user (home_s2, work_s2). Sections come from the cell index instead of a join with the polygons table.
+    '''
     sql = f"""WITH consecutives AS (
               SELECT {config.USER_ID},
                   trajectory_id,
@@ -25,52 +30,6 @@ def BB6_section(time_start, time_end, project_dataset, bq_client):
                      TIMESTAMP_DIFF(end_time, start_time, SECOND) as total_time
               FROM consecutives
             ),
-            scc_mapping AS (
-                SELECT DISTINCT s2code, sccode
-                FROM {project_dataset}.{config.table_polygons}
-                WHERE polygon_description = 'Celula'
-            ),
-            s2cells_mapped AS (
-                SELECT s2cells.*, scc_mapping.sccode as start_scc
-                FROM s2cells INNER JOIN scc_mapping
-                    ON s2cells.start_s2 = scc_mapping.s2code
-            ),
-            users_mapped AS (
-                SELECT s2cells.start_s2,
-                       s2cells.end_s2,
-                       s2cells.trajectory_id,
-                       s2cells.trajectory_leg,
-                       s2cells.{config.USER_ID},
-                       s2cells.total_distance,
-                       s2cells.total_time,
-                       users.residential_status as residency_status
-                FROM {project_dataset}.{config.table_users} AS users INNER JOIN s2cells_mapped as s2cells
-                    ON users.{config.USER_ID} = s2cells.{config.USER_ID} AND users.polygon_id = s2cells.start_scc
-            ),
-            start_mapped AS (
-                SELECT scc_mapping.sccode as start_scc,
-                       users_mapped.end_s2,
-                       users_mapped.trajectory_id,
-                       users_mapped.trajectory_leg,
-                       users_mapped.{config.USER_ID},
-                       users_mapped.total_distance,
-                       users_mapped.total_time,
-                       users_mapped.residency_status
-                FROM users_mapped INNER JOIN scc_mapping
-                    ON users_mapped.start_s2 = scc_mapping.s2code
-            ),
-            end_mapped AS (
-                SELECT start_mapped.start_scc,
-                       scc_mapping.sccode as end_scc,
-                       start_mapped.trajectory_id,
-                       start_mapped.trajectory_leg,
-                       start_mapped.{config.USER_ID},
-                       start_mapped.total_distance,
-                       start_mapped.total_time,
-                       start_mapped.residency_status
-                FROM start_mapped INNER JOIN scc_mapping
-                    ON start_mapped.end_s2 = scc_mapping.s2code
-            ),
             prof_status AS (
                 SELECT {config.USER_ID}, professional_status
                 FROM {project_dataset}.{config.table_user_professional}
@@ -79,37 +38,57 @@ def BB6_section(time_start, time_end, project_dataset, bq_client):
                 SELECT * FROM {project_dataset}.{config.table_mode_of_transport}
             ),
             user_home AS (
-                SELECT DISTINCT night_loc.{config.USER_ID}, scc_mapping.sccode as home_scc
-                FROM {project_dataset}.{config.table_user_night_location} as night_loc INNER JOIN scc_mapping
-                     ON CAST(night_loc.s2code AS STRING) = scc_mapping.s2code
-                WHERE night_loc.night_stay_place = 'yes'
+                SELECT {config.USER_ID}, ARRAY_AGG(DISTINCT CAST(s2code AS STRING)) as home_s2
+                FROM {project_dataset}.{config.table_user_night_location}
+                WHERE night_stay_place = 'yes'
+                GROUP BY {config.USER_ID}
             ),
             user_work AS (
-                SELECT DISTINCT day_loc.{config.USER_ID}, scc_mapping.sccode as work_scc
-                FROM {project_dataset}.{config.table_user_work_location} as day_loc INNER JOIN scc_mapping
-                     ON CAST(day_loc.s2code AS STRING) = scc_mapping.s2code
-                WHERE day_loc.work_place = 'yes'
+                SELECT {config.USER_ID}, ARRAY_AGG(DISTINCT CAST(s2code AS STRING)) as work_s2
+                FROM {project_dataset}.{config.table_user_work_location}
+                WHERE work_place = 'yes'
+                GROUP BY {config.USER_ID}
             )
-            SELECT end_mapped.start_scc, 
-                   end_mapped.end_scc, 
-                   end_mapped.{config.USER_ID}, 
-                   end_mapped.trajectory_id,
-                   end_mapped.trajectory_leg,
-                   end_mapped.total_distance,
-                   end_mapped.total_time,
-                   end_mapped.residency_status,
+            SELECT s2cells.start_s2, 
+                   s2cells.end_s2, 
+                   s2cells.{config.USER_ID}, 
+                   s2cells.trajectory_id,
+                   s2cells.trajectory_leg,
+                   s2cells.total_distance,
+                   s2cells.total_time,
                    prof_status.professional_status,
                    mode_of_transport.mode_of_transport as transport_mode,
-                   user_home.home_scc,
-                   user_work.work_scc
-            FROM end_mapped
-                 INNER JOIN mode_of_transport ON end_mapped.trajectory_id = mode_of_transport.trajectory_id
-                 LEFT JOIN prof_status ON end_mapped.{config.USER_ID} = prof_status.{config.USER_ID}
-                 LEFT JOIN user_home ON end_mapped.{config.USER_ID} = user_home.{config.USER_ID}
-                 LEFT JOIN user_work ON end_mapped.{config.USER_ID} = user_work.{config.USER_ID}
-            WHERE end_mapped.total_time > 0 AND end_mapped.total_distance > 0
+                   user_home.home_s2,
+                   user_work.work_s2
+            FROM s2cells
+                 INNER JOIN mode_of_transport ON s2cells.trajectory_id = mode_of_transport.trajectory_id
+                 LEFT JOIN prof_status ON s2cells.{config.USER_ID} = prof_status.{config.USER_ID}
+                 LEFT JOIN user_home ON s2cells.{config.USER_ID} = user_home.{config.USER_ID}
+                 LEFT JOIN user_work ON s2cells.{config.USER_ID} = user_work.{config.USER_ID}
+            WHERE s2cells.total_time > 0 AND s2cells.total_distance > 0
             """
-    od_mat = bq_client.query(sql).to_dataframe()
+    legs = bq_client.query(sql).to_dataframe()
+    
+    users_sql = f"""SELECT {config.USER_ID}, CAST(polygon_id AS STRING) AS start_scc, residential_status as residency_status
+                    FROM {project_dataset}.{config.table_users}
+                    WHERE {config.USER_ID} IN (SELECT {config.USER_ID} FROM {project_dataset}.{config.table_stay_points}
+                                               WHERE datetime_leave >= '{time_start}' AND datetime_leave < '{time_end}')
+                 """
+    users = bq_client.query(users_sql).to_dataframe()
+    
+    positions, start_scc = cell_index.join(legs.start_s2.values, "sccode")
+    legs = legs.iloc[positions].assign(start_scc = start_scc)
+    return legs.merge(users, on = [config.USER_ID, "start_scc"])
+
+
+def BB6_section(time_start, time_end, project_dataset, bq_client):
+    
+    cell_index = get_cell_index(bq_client, project_dataset)
+    od_mat = hourly_legs(time_start, time_end, project_dataset, bq_client, cell_index)
+    positions, end_scc = cell_index.join(od_mat.end_s2.values, "sccode")
+    od_mat = od_mat.iloc[positions].assign(end_scc = end_scc)
+    od_mat = join_cell_arrays(od_mat, "home_s2", "sccode", "home_scc", cell_index)
+    od_mat = join_cell_arrays(od_mat, "work_s2", "sccode", "work_scc", cell_index)
     
     od_mat.loc[((od_mat.start_scc != od_mat.home_scc) & (od_mat.end_scc != od_mat.work_scc)) & 
        ((od_mat.start_scc != od_mat.work_scc) & (od_mat.end_scc != od_mat.home_scc)), "trip_purpose"] = "NHO"
@@ -142,86 +121,9 @@ def BB6_section(time_start, time_end, project_dataset, bq_client):
 
 def BB6(time_start, time_end, project_dataset, bq_client):
     
-    sql = f"""WITH consecutives AS (
-              SELECT {config.USER_ID},
-                  trajectory_id,
-                  CONCAT(trajectory_id,'_',EXTRACT(HOUR FROM datetime_leave),'_',EXTRACT(DAY FROM datetime_leave)) AS trajectory_leg,
-                  datetime_leave as start_time,
-                  centroid_geography as start_point,
-                  LEAD(centroid_geography) OVER (PARTITION BY {config.USER_ID}, trajectory_id ORDER BY datetime_arrive, datetime_leave ASC) AS end_point,
-                  LEAD(datetime_arrive) OVER (PARTITION BY {config.USER_ID}, trajectory_id ORDER BY datetime_arrive, datetime_leave ASC) AS end_time
-              FROM {project_dataset}.{config.table_stay_points}
-              WHERE datetime_leave >= '{time_start}' AND datetime_leave < '{time_end}'
-          ),
-          s2cells AS (
-              SELECT CAST(S2_CELLIDFROMPOINT(start_point, {config.s2_level}) AS STRING) as start_s2, 
-                     CAST(S2_CELLIDFROMPOINT(end_point, {config.s2_level}) AS STRING) as end_s2, 
-                     trajectory_id,
-                     trajectory_leg,
-                     {config.USER_ID},
-                     ST_DISTANCE(start_point, end_point) as total_distance,
-                     TIMESTAMP_DIFF(end_time, start_time, SECOND) as total_time
-              FROM consecutives
-            ),
-            scc_mapping AS (
-                SELECT DISTINCT s2code, sccode
-                FROM {project_dataset}.{config.table_polygons}
-                WHERE polygon_description = 'Celula'
-            ),
-            s2cells_mapped AS (
-                SELECT s2cells.*, scc_mapping.sccode as start_scc
-                FROM s2cells INNER JOIN scc_mapping
-                    ON s2cells.start_s2 = scc_mapping.s2code
-            ),
-            users_mapped AS (
-                SELECT s2cells.start_s2,
-                       s2cells.end_s2,
-                       s2cells.trajectory_id,
-                       s2cells.trajectory_leg,
-                       s2cells.{config.USER_ID},
-                       s2cells.total_distance,
-                       s2cells.total_time,
-                       users.residential_status as residency_status
-                FROM {project_dataset}.{config.table_users} AS users INNER JOIN s2cells_mapped as s2cells
-                    ON users.{config.USER_ID} = s2cells.{config.USER_ID} AND users.polygon_id = s2cells.start_scc
-            ),
-            prof_status AS (
-                SELECT {config.USER_ID}, professional_status
-                FROM {project_dataset}.{config.table_user_professional}
-            ),
-            mode_of_transport AS (
-                SELECT * FROM {project_dataset}.{config.table_mode_of_transport}
-            ),
-            user_home AS (
-                SELECT DISTINCT {config.USER_ID}, CAST(s2code AS STRING) as s2code
-                FROM {project_dataset}.{config.table_user_night_location}
-                WHERE night_stay_place = 'yes'
-            ),
-            user_work AS (
-                SELECT DISTINCT {config.USER_ID}, CAST(s2code AS STRING) as s2code
-                FROM {project_dataset}.{config.table_user_work_location}
-                WHERE work_place = 'yes'
-            )
-            SELECT users_mapped.start_s2 as start_s2, 
-                   users_mapped.end_s2 as end_s2, 
-                   users_mapped.{config.USER_ID}, 
-                   users_mapped.trajectory_id,
-                   users_mapped.trajectory_leg,
-                   users_mapped.total_distance,
-                   users_mapped.total_time,
-                   users_mapped.residency_status,
-                   prof_status.professional_status,
-                   mode_of_transport.mode_of_transport as transport_mode,
-                   user_home.s2code as home_s2,
-                   user_work.s2code as work_s2
-            FROM users_mapped
-                 INNER JOIN mode_of_transport ON users_mapped.trajectory_id = mode_of_transport.trajectory_id
-                 LEFT JOIN prof_status ON users_mapped.{config.USER_ID} = prof_status.{config.USER_ID}
-                 LEFT JOIN user_home ON users_mapped.{config.USER_ID} = user_home.{config.USER_ID}
-                 LEFT JOIN user_work ON users_mapped.{config.USER_ID} = user_work.{config.USER_ID}
-            WHERE users_mapped.total_time > 0 AND users_mapped.total_distance > 0
-            """
-    od_mat = bq_client.query(sql).to_dataframe()
+    od_mat = hourly_legs(time_start, time_end, project_dataset, bq_client, get_cell_index(bq_client, project_dataset))
+    od_mat = od_mat.drop(columns = ["start_scc"]).explode("home_s2").explode("work_s2").reset_index(drop=True)
+    
     od_mat.loc[((od_mat.start_s2 != od_mat.home_s2) & (od_mat.end_s2 != od_mat.work_s2)) & 
        ((od_mat.start_s2 != od_mat.work_s2) & (od_mat.end_s2 != od_mat.home_s2)), "trip_purpose"] = "NHO"
 
@@ -2,23 +2,22 @@ import pandas as pd
 from google.cloud import bigquery
 import numpy as np
 import utils.config as config
+from utils.utils import elect_top
+from utils.day_parts import get_day_points
+from utils.cell_index import get_cell_index
+
+
+PROFILE_KEYS = ['level', 'polygon_id', 'imsi'] # a profile per user and polygon, level is the code column of the polygon
 
     
-def get_night_data_profile(polygon_users_df, midnight_df):
-    polygon_users_df['datetime'] = pd.to_datetime(polygon_users_df['datetime'])
-    night_df = polygon_users_df[(polygon_users_df['datetime'].dt.hour >= 0) & (polygon_users_df['datetime'].dt.hour < 8)]
-    
-    midnight_df['datetime'] = pd.to_datetime(midnight_df['datetime'])
-    night_df = night_df.append(midnight_df).reset_index(drop=True)
-    
-    # sort, group_by id, calculate the max amd min of time per id and place in first_seen and last_seen
+def get_night_data_profile(night_points):
+    # group by polygon and id, calculate the max amd min of time per group and place in first_seen and last_seen
     # classify national and international tourist based on mcc (on first day everyone is tourist)
     # initialise length_of_stay for first day
-    night_df = night_df.sort_values(['imsi', 'datetime','mcc'], ascending=[True, True, True]).reset_index()
-    night_df = night_df.groupby('imsi').agg(first_seen=('datetime', 'min'), last_seen=('datetime', 'max'), mcc= ('mcc', 'max'))
-    night_df['residential_status'] = night_df['mcc'].apply(lambda x: 'national tourist' if x == '268' else 'international tourist')
+    night_df = night_points.groupby(PROFILE_KEYS).agg(first_seen=('datetime', 'min'), last_seen=('datetime', 'max'), mcc= ('mcc', 'max'))
     time_diff = (night_df['last_seen'] - night_df['first_seen']).dt.total_seconds() / 60
-    night_df['residential_status'] = ['commuter' if diff < config.max_commute_time else label for diff, label in zip(time_diff, night_df['residential_status'])]
+    tourist = np.where(night_df['mcc'] == '268', 'national tourist', 'international tourist')
+    night_df['residential_status'] = np.where(time_diff < config.max_commute_time, 'commuter', tourist)
     night_df.loc[:, 'stay_time_night'] = time_diff
     night_df['stay_time_day']=0.0
     night_df['night_count']=1.0
@@ -26,38 +25,29 @@ def get_night_data_profile(polygon_users_df, midnight_df):
     night_df['length_of_stay']=1.0
     night_df['night_stay_place'] = 'other'
     night_df['day_stay_place'] = 'other'
-    #night_df = night_df.drop('mcc',axis = 1)
-    night_df = night_df.drop('first_seen',axis = 1)
-    night_df = night_df.drop('last_seen',axis = 1)
+    night_df = night_df.drop(['first_seen', 'last_seen'], axis = 1)
     night_df = night_df.reset_index()
     return night_df
     
-def get_day_data_profile(polygon_users_df):
-    polygon_users_df['datetime'] = pd.to_datetime(polygon_users_df['datetime'])
-    day_df = polygon_users_df[(polygon_users_df['datetime'].dt.hour >= 8) & (polygon_users_df['datetime'].dt.hour < 20)]
-    #day_df = day_df.drop('mcc',axis = 1)
-    day_df = day_df.reset_index()
-
-    # sort, group_by id, calculate the max amd min of time per id and place in first_seen and last_seen
+def get_day_data_profile(day_points):
+    # group by polygon and id, calculate the max amd min of time per group and place in first_seen and last_seen
     # classify commuters(passerbys): found less than 3omin only ine day and casual visitors found 1day without night stay
     # initialise length_of_stay for first day
-    day_df = day_df.sort_values(['imsi', 'datetime', 'mcc'], ascending=[True, True, True]).reset_index()
-    day_df = day_df.groupby('imsi').agg(first_seen=('datetime', 'min'), last_seen=('datetime', 'max'), mcc= ('mcc', 'max'))
+    day_df = day_points.groupby(PROFILE_KEYS).agg(first_seen=('datetime', 'min'), last_seen=('datetime', 'max'), mcc= ('mcc', 'max'))
     time_diff = (day_df['last_seen'] - day_df['first_seen']).dt.total_seconds() / 60
-    day_df['residential_status'] = ['commuter' if diff < config.max_commute_time else 'casual visitor' for diff in time_diff]
+    day_df['residential_status'] = np.where(time_diff < config.max_commute_time, 'commuter', 'casual visitor')
     day_df.loc[:, 'stay_time_day'] = time_diff
     day_df['stay_time_night']=0.0
     day_df['night_count']=0.0
     day_df['day_count'] = 1.0
     day_df['length_of_stay']=1.0
     day_df['day_stay_place'] = 'other'
+    day_df = day_df.drop(['first_seen', 'last_seen'], axis = 1)
     day_df = day_df.reset_index()
-    day_df = day_df.drop('first_seen',axis = 1)
-    day_df = day_df.drop('last_seen',axis = 1)
     return day_df
     
 def merge_day_night(night_df, day_df, current_day_part):
-    merged_df = pd.merge(night_df, day_df, on='imsi', how='outer')
+    merged_df = pd.merge(night_df, day_df, on=PROFILE_KEYS, how='outer')
     merged_df['mcc'] = merged_df['mcc_x'].combine_first(merged_df['mcc_y'])
     merged_df['stay_time_night'] = merged_df['stay_time_night_x'].fillna(0.0)
     merged_df['stay_time_day'] = merged_df['stay_time_day_y'].fillna(0.0)
@@ -72,10 +62,87 @@ def merge_day_night(night_df, day_df, current_day_part):
     merged_df['day_part'] = current_day_part
     return merged_df
 
+def residential_status(merged_df):
+    '''
+    Residential status of every row of the merged profiles, the rules of get_res_status as masks evaluated in order with
+    np.select: the first rule that holds gives the status, None when none does.
+    '''
+    length_of_stay = merged_df['length_of_stay'].values
+    night_count = merged_df['night_count'].values
+    stay_time_night = merged_df['stay_time_night'].values
+    stay_time_day = merged_df['stay_time_day'].values
+    full_res_status = merged_df['residential_status_y'].values.astype(object)
+    df_res_status = merged_df['residential_status_x'].values.astype(object)
+    new_user = pd.isnull(full_res_status)
+
+    short_stay = length_of_stay < config.min_regular_visit_days
+    long_stay = length_of_stay >= config.min_regular_visit_days
+    # both sides of every threshold are compared, a missing value is on neither side as in the row by row rules
+    short_night = stay_time_night < config.min_night_stay_time
+    long_night = stay_time_night >= config.min_night_stay_time
+    night_visit = (config.max_commute_time <= stay_time_night) & short_night
+    day_visit = stay_time_day >= config.max_commute_time
+    short_day = stay_time_day < config.max_commute_time
+    tourist = np.where((merged_df['mcc'] == '268').values, 'national tourist', 'international tourist')
+
+    rules = [(pd.isnull(df_res_status), full_res_status),
+             (new_user & short_stay & short_night & day_visit, 'casual visitor'),
+             (new_user & long_stay & short_night & day_visit, 'regular visitor'),
+             (new_user, df_res_status),
+             ((stay_time_night < config.max_commute_time) & short_day, 'commuter'),
+             (short_stay & night_visit & short_day, 'casual visitor'),
+             (long_stay & night_visit & short_day, 'regular visitor'),
+             (long_stay & (night_count >= 0.0) & day_visit & short_night, 'regular visitor'),
+             (short_stay & (night_count >= 0.0) & day_visit & short_night, 'casual visitor'),
+             ((night_count > 0.0) & (night_count < config.min_residence_days) & long_night, tourist),
+             ((night_count >= config.min_residence_days) & long_night, 'resident')]
+
+    conditions = [np.asarray(condition, dtype=bool) for condition, status in rules]
+    choices = [np.broadcast_to(np.asarray(status, dtype=object), len(merged_df)) for condition, status in rules]
+    return np.select(conditions, choices, default=None)
+
+
+# row by row reference of residential_status, for the parity check of benchmarks/benchmark_residential_status.py
+def get_res_status(row):
+    length_of_stay = row['length_of_stay']
+    night_count = row['night_count']
+    mcc = row['mcc']
+    full_res_status = row['residential_status_y']
+    df_res_status = row['residential_status_x']
+    stay_time_night = row['stay_time_night']
+    stay_time_day = row['stay_time_day']
+    
+    if pd.isnull(df_res_status):
+        return full_res_status
+    elif pd.isnull(full_res_status):
+        if length_of_stay  < config.min_regular_visit_days and stay_time_night < config.min_night_stay_time and stay_time_day >= config.max_commute_time:
+            return 'casual visitor'
+        if length_of_stay  >= config.min_regular_visit_days and stay_time_night < config.min_night_stay_time and stay_time_day >= config.max_commute_time:
+            return 'regular visitor'
+        else:     
+            return df_res_status
+    elif stay_time_night < config.max_commute_time and stay_time_day < config.max_commute_time:
+        return 'commuter'
+    elif length_of_stay  < config.min_regular_visit_days and config.max_commute_time <= stay_time_night < config.min_night_stay_time and stay_time_day < config.max_commute_time:
+        return 'casual visitor'
+    elif length_of_stay  >= config.min_regular_visit_days and config.max_commute_time <= stay_time_night < config.min_night_stay_time and stay_time_day < config.max_commute_time:
+        return 'regular visitor'
+    elif length_of_stay  >= config.min_regular_visit_days and night_count >= 0.0 and stay_time_day >= config.max_commute_time and stay_time_night < config.min_night_stay_time:
+        return 'regular visitor'
+    elif length_of_stay  < config.min_regular_visit_days and night_count >= 0.0 and stay_time_day >= config.max_commute_time and stay_time_night < config.min_night_stay_time:
+        return 'casual visitor'            
+    elif night_count > 0.0 and night_count < config.min_residence_days and stay_time_night >= config.min_night_stay_time:
+        if mcc == '268':
+            return 'national tourist'
+        else:
+            return 'international tourist'     
+    elif night_count >= config.min_residence_days and stay_time_night >= config.min_night_stay_time:
+        return 'resident'
+
 def merge_old_new_profile(new_df, old_df):
     
-    # Merge the two dataframes
-    merged_df = pd.merge(new_df, old_df, on='imsi', how='outer')
+    # Merge the two dataframes, the profiles of every polygon with the previous profiles of the polygon
+    merged_df = pd.merge(new_df, old_df, on=PROFILE_KEYS, how='outer')
     merged_df['mcc'] = merged_df['mcc_x'].combine_first(merged_df['mcc_y'])
     merged_df["length_of_stay"] = merged_df["length_of_stay_x"].fillna(0.0) + merged_df["length_of_stay_y"].fillna(0.0)
     merged_df["night_count"] = merged_df["night_count_x"].fillna(0.0) + merged_df["night_count_y"].fillna(0.0)
@@ -84,7 +151,7 @@ def merge_old_new_profile(new_df, old_df):
     merged_df["stay_time_night"] = np.where(merged_df["stay_time_night_x"].isnull() | (merged_df["stay_time_night_x"] == 0.0), merged_df["stay_time_night_y"].fillna(0.0), (merged_df["stay_time_night_x"].fillna(0.0) + (merged_df["stay_time_night_y"].fillna(0.0)*merged_df["night_count_y"].fillna(0.0))) / merged_df["night_count"])
     
     merged_df["stay_time_day"] = np.where(merged_df["stay_time_day_x"].isnull() | (merged_df["stay_time_day_x"] == 0.0), merged_df["stay_time_day_y"].fillna(0.0), (merged_df["stay_time_day_x"].fillna(0.0) + (merged_df["stay_time_day_y"].fillna(0.0)*merged_df["day_count_y"].fillna(0.0))) / merged_df["day_count"])
-    merged_df['day_part'] = new_df['day_part'][0]
+    merged_df['day_part'] = new_df['day_part'].iloc[0]
 
 
     # Calculate the updated length of stay
@@ -93,85 +160,25 @@ def merge_old_new_profile(new_df, old_df):
 
 
     # Calculate the updated residential status based on conditions
-    def get_res_status(row):
-        length_of_stay = row['length_of_stay']
-        night_count = row['night_count']
-        mcc = row['mcc']
-        full_res_status = row['residential_status_y']
-        df_res_status = row['residential_status_x']
-        stay_time_night = row['stay_time_night']
-        stay_time_day = row['stay_time_day']
-        
-        if pd.isnull(df_res_status):
-            return full_res_status
-        elif pd.isnull(full_res_status):
-            if length_of_stay  < config.min_regular_visit_days and stay_time_night < config.min_night_stay_time and stay_time_day >= config.max_commute_time:
-                return 'casual visitor'
-            if length_of_stay  >= config.min_regular_visit_days and stay_time_night < config.min_night_stay_time and stay_time_day >= config.max_commute_time:
-                return 'regular visitor'
-            else:     
-                return df_res_status
-        elif stay_time_night < config.max_commute_time and stay_time_day < config.max_commute_time:
-            return 'commuter'
-        elif length_of_stay  < config.min_regular_visit_days and config.max_commute_time <= stay_time_night < config.min_night_stay_time and stay_time_day < config.max_commute_time:
-            return 'casual visitor'
-        elif length_of_stay  >= config.min_regular_visit_days and config.max_commute_time <= stay_time_night < config.min_night_stay_time and stay_time_day < config.max_commute_time:
-            return 'regular visitor'
-        elif length_of_stay  >= config.min_regular_visit_days and night_count >= 0.0 and stay_time_day >= config.max_commute_time and stay_time_night < config.min_night_stay_time:
-            return 'regular visitor'
-        elif length_of_stay  < config.min_regular_visit_days and night_count >= 0.0 and stay_time_day >= config.max_commute_time and stay_time_night < config.min_night_stay_time:
-            return 'casual visitor'            
-        elif night_count > 0.0 and night_count < config.min_residence_days and stay_time_night >= config.min_night_stay_time:
-            if mcc == '268':
-                return 'national tourist'
-            else:
-                return 'international tourist'     
-        elif night_count >= config.min_residence_days and stay_time_night >= config.min_night_stay_time:
-            return 'resident'
-       
-            
-    merged_df['residential_status'] = merged_df.apply(get_res_status, axis=1)
+    merged_df['residential_status'] = residential_status(merged_df)
     
     # Only keep the relevant columns
-    merged_df = merged_df[['imsi','mcc','stay_time_night','night_count', 'stay_time_day', 'day_count', 'length_of_stay','night_stay_place','day_stay_place', 'residential_status', 'day_part']]
-
-    # Rename the columns to match df1
-    merged_df.columns = ['imsi','mcc','stay_time_night','night_count','stay_time_day', 'day_count', 'length_of_stay','night_stay_place','day_stay_place', 'residential_status', 'day_part']
+    merged_df = merged_df[PROFILE_KEYS + ['mcc','stay_time_night','night_count', 'stay_time_day', 'day_count', 'length_of_stay','night_stay_place','day_stay_place', 'residential_status', 'day_part']]
 
     return merged_df
 
 def update_home(one_df):
     resident_filter = (one_df['night_count'] > 0.0) & (one_df['stay_time_night'] >= config.min_night_stay_time)
-    resident_df = one_df[resident_filter]
-
-    # Filter rows with quality 'bad' and marks equal to 0.0
     other_filter = (one_df['night_count'] == 0.0) |((one_df['night_count'] > 0.0) & (one_df['stay_time_night'] < config.min_night_stay_time))
-    other_df = one_df[other_filter]
-    
-    # Sort the DataFrame within each group by 'marks' and 'score' in descending order
-    df_sorted = resident_df.groupby('imsi', group_keys=False).apply(lambda x: x.sort_values(['night_count', 'stay_time_night'], ascending=False))
 
-    # Update label to 'pass' for the first row within each group (highest marks and score)
-    df_sorted['night_stay_place'] = df_sorted.groupby('imsi').cumcount().eq(0).map({True: 'yes', False: 'other'})
-    
-
-    full_df = df_sorted.append(other_df, ignore_index=True)
-    return full_df
+    # the other rows keep their night_stay_place
+    return elect_top(one_df, 'imsi', ['night_count', 'stay_time_night'], resident_filter, 'night_stay_place',
+                     others=other_filter, relabel_others=False)
 
 def update_work(one_df):
-    df_commute = one_df[(one_df['stay_time_day']<config.min_night_stay_time) | (one_df['day_count'] <= 2)].copy()
-    df_commute.loc[:, 'day_stay_place']= 'other'
-
-    # Sort the DataFrame within each group by 'count' and 'time' in descending order
-    df_sorted = one_df.groupby('imsi', group_keys=False).apply(
-    lambda x: x[(x['stay_time_day'] >= config.min_night_stay_time) & (x['day_count'] > 2)].sort_values(['day_count', 'stay_time_day'], ascending=False))
-    # Update label to 'home' for the first row within each group (highe\\\\\st count and time)
-    df_sorted['day_stay_place'] = df_sorted.groupby('imsi').cumcount().eq(0).map({True: 'yes', False: 'other'})
-
-    # Reindex the DataFrame and drop the grouping level
-    work_df = df_sorted.append(df_commute, ignore_index=True)
-
-    return work_df
+    eligible = (one_df['stay_time_day'] >= config.min_night_stay_time) & (one_df['day_count'] > 2)
+    others = (one_df['stay_time_day'] < config.min_night_stay_time) | (one_df['day_count'] <= 2)
+    return elect_top(one_df, 'imsi', ['day_count', 'stay_time_day'], eligible, 'day_stay_place', others=others)
 
 
 def update_residents(full_df):
@@ -203,46 +210,34 @@ def append_df(client, dataset_id, table_name, final_df):
     job_config = bigquery.LoadJobConfig()
     job_config.write_disposition = bigquery.WriteDisposition.WRITE_APPEND
     
-    table_ref = client.dataset(dataset_id).table(table_name)    
-
-    job = client.load_table_from_dataframe(final_df, table_ref, job_config=job_config)
+    job = client.load_table_from_dataframe(final_df, f"{dataset_id}.{table_name}", job_config=job_config)
     job.result()  # Wait for the job to complete
 
     
-def get_users_in_polygon(polygon, current_day_part, raw_table_id, client, project_dataset):
-    previous_day_part = current_day_part - pd.Timedelta(days=1)
-    # Query the BigQuery table for rows with latitude and longitude inside the polygon
-    query = f""" SELECT imsi, datetime, mcc FROM {project_dataset}.{raw_table_id} WHERE ST_INTERSECTS(ST_GEOGFROMWKB(ST_AsBinary(@polygon)), 
-    ST_GEOGPOINT(CAST(lon AS FLOAT64), CAST(lat AS FLOAT64)))
-      AND day_part = '{current_day_part}'"""
-    
-    job_config = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("polygon", "GEOGRAPHY", polygon),
-        ]
-    )
-
-    full_day_df = client.query(query, job_config=job_config).to_dataframe()
-    
-    query2 = f""" SELECT imsi, datetime, mcc FROM {project_dataset}.{raw_table_id} WHERE ST_INTERSECTS(ST_GEOGFROMWKB(ST_AsBinary(@polygon)), 
-    ST_GEOGPOINT(CAST(lon AS FLOAT64), CAST(lat AS FLOAT64)))
-    AND day_part = '{previous_day_part}' AND
-    (EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) >= 20 AND
-    EXTRACT(HOUR FROM CAST({'datetime'} AS DATETIME)) <= 23)"""
-    
-    job_config2 = bigquery.QueryJobConfig(
-        query_parameters=[
-            bigquery.ScalarQueryParameter("polygon", "GEOGRAPHY", polygon),
-        ]
-    )
-
-    midnight_df = client.query(query2, job_config=job_config2).to_dataframe()
-    
-    return full_day_df, midnight_df
+def get_users_in_polygons(points, polygon_ids, cell_index):
+    '''
+    Points of get_day_points in the polygons, one row per point and polygon with the level (code column of the polygons)
+    and the polygon_id. polygon_ids maps every level to its codes, the polygons of a point are the ones of its S2 cell
+    in the cell index.
+    '''
+    located = []
+    for level, codes in polygon_ids.items():
+        positions, cell_codes = cell_index.join(points['s2code'].values, level)
+        inside = np.isin(cell_codes, np.asarray(codes).astype(str))
+        level_points = points.iloc[positions[inside]].loc[:, ['imsi', 'datetime', 'mcc', 'day_part', 'night', 'day']]
+        level_points.insert(0, 'polygon_id', cell_codes[inside])
+        level_points.insert(0, 'level', level)
+        located.append(level_points)
+    return pd.concat(located, ignore_index=True)
 
 
 def insert_user_residential_status(client, project_dataset, raw_table_id, current_day_part):
-    table_name = 'user_profile_demo'
+    '''
+    Update the residential status of the users in every Concelho, Freguesia and Secção of config.area_cocodes, for all
+    the polygons at once: the points of the day are assigned to the polygons with the cell index, the night and day
+    profiles are grouped by polygon and user and merged with the previous profiles in one join.
+    '''
+    table_name = config.table_users
     
     column_types = {'polygon_id': object, 'imsi': object,'mcc':int, 'night_count':float, 'stay_time_night':float ,'day_count':float, 'stay_time_day':float, 'length_of_stay': float, 'night_stay_place': object, 'day_stay_place':object, 'residential_status': object, 'day_part': 'datetime64'}
     final_df = pd.DataFrame(columns=column_types.keys()).astype(column_types)
@@ -254,55 +249,47 @@ def insert_user_residential_status(client, project_dataset, raw_table_id, curren
     'Freguesia': 'frcode',
     'Secção': 'sccode'}
 
-    
     levels = ['Concelho', 'Freguesia', 'Secção']
-    for level in levels:
-        lcode = level_code_mapping[level]
-        one_df = pd.DataFrame(columns=column_types.keys()).astype(column_types)
-        sql = f"SELECT {lcode} as polygon_id, geography AS polygon_geom FROM {project_dataset}.{config.table_polygons} WHERE polygon_description = '{level}' and cocode in ({cocode_str}) "
-        
-        shape_df = client.query(sql)
-        for row in shape_df:
-            current_day_part = pd.Timestamp(current_day_part).date()
-            pid = row.polygon_id
-            polygon = row.polygon_geom
-            polygon_users_df, midnight_df = get_users_in_polygon(polygon, current_day_part, raw_table_id)
-            if(len(polygon_users_df)!=0):
-                night_df = get_night_data_profile(polygon_users_df, midnight_df, current_day_part, config.max_commute_time)
-                day_df = get_day_data_profile(polygon_users_df, current_day_part, config.max_commute_time)
-                new_df = merge_day_night(night_df, day_df, current_day_part)
-                previous_day_part = current_day_part - pd.Timedelta(days=1)
-                sql_old=f"SELECT * FROM {project_dataset}.{table_name} WHERE polygon_id = '{pid}'"
-                old_df= client.query(sql_old).to_dataframe()
-                old_df.drop('polygon_id', axis = 1)
-                latest_df = merge_old_new_profile(new_df, old_df, min_night_stay_time, config.max_commute_time, min_regular_visit_days, min_residence_days)
-                latest_df['polygon_id'] = pid
-
-                one_df = one_df.append(latest_df, ignore_index=True)
-            else:
-                continue
-        full_df=update_home(one_df, min_night_stay_time)
-        full_df_2=update_work(full_df, min_night_stay_time)
-        level_df= update_residents(full_df_2, min_regular_visit_days)
-        print(level_df)
-        final_df = final_df.append(level_df, ignore_index= True)
-    append_df(client, {project_dataset}.{config.table_polygons}, table_name, final_df)
-              
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
-        
+    current_day_part = pd.Timestamp(current_day_part).date()
+    
+    # codes of the polygons of every level
+    descriptions = ', '.join([f"'{level}'" for level in levels])
+    sql = f"""SELECT DISTINCT polygon_description, CAST(cocode AS STRING) AS cocode, CAST(frcode AS STRING) AS frcode, CAST(sccode AS STRING) AS sccode
+              FROM {project_dataset}.{config.table_polygons} WHERE polygon_description IN ({descriptions}) and cocode in ({cocode_str})"""
+    polygons = client.query(sql).to_dataframe()
+    polygon_ids = {level_code_mapping[level]: polygons.loc[polygons.polygon_description == level, level_code_mapping[level]].dropna().unique()
+                   for level in levels}
+    
+    points = get_day_points(client, raw_table_id, current_day_part)
+    polygon_points = get_users_in_polygons(points, polygon_ids, get_cell_index(client, project_dataset))
+    # the polygons without points of the day are left out
+    active = polygon_points.loc[polygon_points['day_part'] == current_day_part, ['level', 'polygon_id']].drop_duplicates()
+    polygon_points = polygon_points.merge(active, on=['level', 'polygon_id'])
+    
+    if len(polygon_points) != 0:
+        night_df = get_night_data_profile(polygon_points[polygon_points['night']])
+        day_df = get_day_data_profile(polygon_points[polygon_points['day']])
+        new_df = merge_day_night(night_df, day_df, current_day_part)
         
+        # previous profiles of the polygons with points of the day, selected in the query with a staging table of the
+        # polygons instead of reading the whole table
+        job_config = bigquery.LoadJobConfig()
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        client.load_table_from_dataframe(pd.DataFrame({'polygon_id': new_df['polygon_id'].astype(str).unique()}),
+                                         f"{project_dataset}.{table_name}_polygons", job_config=job_config).result()
+        sql = f"""SELECT * FROM {project_dataset}.{table_name}
+                  WHERE polygon_id IN (SELECT polygon_id FROM {project_dataset}.{table_name}_polygons)"""
+        old_df = client.query(sql).to_dataframe()
+        old_df['polygon_id'] = old_df['polygon_id'].astype(str)
+        old_df = old_df.merge(new_df[['level', 'polygon_id']].drop_duplicates(), on='polygon_id')
+        latest_df = merge_old_new_profile(new_df, old_df)
 
-        
+        level_dfs = [final_df]
+        for level in levels:
+            one_df = latest_df[latest_df['level'] == level_code_mapping[level]]
+            full_df = update_home(one_df)
+            full_df_2 = update_work(full_df)
+            level_dfs.append(update_residents(full_df_2))
+        final_df = pd.concat(level_dfs, ignore_index=True).loc[:, list(column_types)]
+    
+    append_df(client, project_dataset, table_name, final_df)
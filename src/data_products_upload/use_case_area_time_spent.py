@@ -3,11 +3,11 @@ from google.cloud import bigquery
 import pandas as pd
 import numpy as np
 import utils.config as config
-from utils.utils import align_user_table
+from utils.utils import align_user_tables
 import shapely
 from utils.bigquery_utils import upload_table_bq
-from use_cases.time_in_polygon import time_spent_in_area
-from use_cases.dwell_time import dwell_split, dwell_split_empty
+from use_cases.time_in_polygon import time_spent_in_areas
+from use_cases.dwell_time import dwell_time_by_polygon
 
 credentials, project = google.auth.default()
 client = bigquery.Client(credentials=credentials)
@@ -28,80 +28,36 @@ user_table = client.query(f"SELECT * FROM {project_dataset}.{config.table_users}
 max_time = pd.Timestamp(config.end_datetime_demo)
 time_delta_daily = pd.Timedelta(days=1)
 
-to_upload_df = pd.DataFrame(columns = ["polygon_id", "datetime", "residency_status", "dwell_time_interval", "count_people"])
-to_upload_df_daily = pd.DataFrame(columns = ["polygon_id", "date", "residency_status", "dwell_time_interval", "count_people"])
-
-
-for i, (poly_ind, polygon) in enumerate(output_polygons.loc[output_polygons.polygon_description.isin(["Concelho", 
-                                                                                                      "Freguesia", 
-                                                                                                      "Subsecção", 
-                                                                                                      "Secção", 
-                                                                                                      "POI"])].iterrows()):
+area_polygons = output_polygons.loc[output_polygons.polygon_description.isin(["Concelho", 
+                                                                               "Freguesia", 
+                                                                               "Subsecção", 
+                                                                               "Secção", 
+                                                                               "POI"])].reset_index(drop=True)
+
+# the hourly and daily stay times of all the polygons and days, from one scan of the trajectory details
+days = pd.date_range(pd.Timestamp(config.start_datetime_demo_prev), max_time, freq = time_delta_daily, inclusive = "left")
+stay_hourly, stay_daily = time_spent_in_areas([shapely.wkt.loads(geography) for geography in area_polygons.geography], 
+                                              days[0], days[-1] + time_delta_daily, project_dataset, client)
+stay_daily["date"] = stay_daily.datetime.dt.strftime("%Y-%m-%d")
+stay_hourly = stay_hourly.sort_values("polygon_position", kind = "stable")
+stay_daily = stay_daily.sort_values("polygon_position", kind = "stable")
+
+hours = [pd.to_datetime(f"{day.date()} {hour:02d}:00:00", utc=True) for day in days for hour in range(24)]
+dates = [f"{day.date()}" for day in days]
+user_statuses = align_user_tables(area_polygons, user_table)
+polygon_ids = area_polygons.polygon_id.values
+
+for chunk_start in range(0, len(area_polygons), 50):
     
-    print(f"{i} ({poly_ind}) ({polygon['polygon_id']})")
+    print(f"{chunk_start} / {len(area_polygons)}")
+    positions = range(chunk_start, min(chunk_start + 50, len(area_polygons)))
+    hourly_rows = slice(*np.searchsorted(stay_hourly.polygon_position.values, [positions.start, positions.stop]))
+    daily_rows = slice(*np.searchsorted(stay_daily.polygon_position.values, [positions.start, positions.stop]))
     
-    if i%51 == 50:
-        upload_table_bq(to_upload_df, output_table_hourly, schema = {}, client = client)
-        upload_table_bq(to_upload_df_daily, output_table_daily, schema = {}, client = client)
-        to_upload_df = pd.DataFrame(columns = ["polygon_id", "datetime", "residency_status", "dwell_time_interval", "count_people"])
-        to_upload_df_daily = pd.DataFrame(columns = ["polygon_id", "date", "residency_status", "dwell_time_interval", "count_people"])
-
-    pol_relevant_user_table = align_user_table(polygon, user_table)
+    to_upload_df = dwell_time_by_polygon(stay_hourly.iloc[hourly_rows].loc[:, ["polygon_position", config.USER_ID, "datetime", "stay_time"]], 
+                                         user_statuses, "datetime", hours, dwell_time_intervals, positions, polygon_ids)
+    to_upload_df_daily = dwell_time_by_polygon(stay_daily.iloc[daily_rows].loc[:, ["polygon_position", config.USER_ID, "date", "stay_time"]], 
+                                               user_statuses, "date", dates, dwell_time_big, positions, polygon_ids)
     
-    current_day = pd.Timestamp(config.start_datetime_demo_prev)
-    
-    while current_day < max_time:
-        
-        time_in_area_hourly = time_spent_in_area(current_day, shapely.wkt.loads(polygon["geography"]), project_dataset, client, hourly=True)
-        
-        empty_dwell = dwell_split_empty(current_day, polygon["polygon_id"], dwell_time_intervals, hourly=True)
-        
-        if len(time_in_area_hourly) == 0:
-            to_upload_df = pd.concat([to_upload_df, empty_dwell])
-        
-        else:
-            time_with_labels = time_in_area_hourly.merge(pol_relevant_user_table, on=config.USER_ID, how="left")
-            time_with_labels.residential_status.fillna("commuter", inplace=True)
-            dwell_time = time_with_labels.groupby(["residential_status", 
-                                                    "datetime"]).apply(lambda x: dwell_split(x, dwell_time_intervals)).reset_index()#.drop(columns=["level_2"])
-
-            dwell_time_total = time_in_area_hourly.groupby(["datetime"]).apply(lambda x: dwell_split(x, dwell_time_intervals)).reset_index()#.drop(columns=["level_1"])
-            dwell_time_total["residential_status"] = "total"
-            dwell_time = pd.concat([dwell_time.loc[:, ["datetime", "residential_status", "dwell_time_interval", "count_people"]], 
-                                    dwell_time_total.loc[:, ["datetime", "residential_status", "dwell_time_interval", "count_people"]]])
-            dwell_time["polygon_id"] = polygon["polygon_id"]
-            dwell_time.rename(columns={"residential_status": "residency_status"}, inplace = True)
-            dwell_time = dwell_time.loc[:, ["polygon_id", "datetime", "residency_status", "dwell_time_interval", "count_people"]]
-            zero_padded = empty_dwell.merge(dwell_time, on = ["polygon_id", "datetime", "residency_status", "dwell_time_interval"], how = "left")
-            zero_padded["count_people"] = np.fmax(zero_padded["count_people_x"], zero_padded["count_people_y"])
-            to_upload_df = pd.concat([to_upload_df, zero_padded.drop(columns = ["count_people_x", "count_people_y"])])
-
-        
-        time_in_area_daily = time_spent_in_area(current_day, shapely.wkt.loads(polygon["geography"]), project_dataset, client, hourly=False)
-        empty_dwell = dwell_split_empty(current_day, polygon["polygon_id"], dwell_time_big, hourly=False)
-        
-        if len(time_in_area_daily) == 0:
-            
-            to_upload_df_daily = pd.concat([to_upload_df_daily, empty_dwell])
-        
-        else:
-            time_with_labels = time_in_area_daily.merge(pol_relevant_user_table, on=config.USER_ID, how="left")
-            time_with_labels.residential_status.fillna("commuter", inplace=True)
-            dwell_time = time_with_labels.groupby(["residential_status"]).apply(lambda x: dwell_split(x, dwell_time_big)).reset_index()#.drop(columns=["level_1"])
-
-            dwell_time_total = dwell_split(time_in_area_daily, dwell_time_big)
-            dwell_time_total["residential_status"] = "total"
-            dwell_time = pd.concat([dwell_time.loc[:, ["residential_status", "dwell_time_interval", "count_people"]], 
-                                    dwell_time_total.loc[:, ["residential_status", "dwell_time_interval", "count_people"]]])
-            dwell_time["polygon_id"] = polygon["polygon_id"]
-            dwell_time["date"] = str(current_day.date())
-            dwell_time.rename(columns={"residential_status": "residency_status"}, inplace = True)
-            dwell_time = dwell_time.loc[:, ["polygon_id", "date", "residency_status", "dwell_time_interval", "count_people"]]
-            zero_padded = empty_dwell.merge(dwell_time, on = ["polygon_id", "date", "residency_status", "dwell_time_interval"], how = "left")
-            zero_padded["count_people"] = np.fmax(zero_padded["count_people_x"], zero_padded["count_people_y"])
-            to_upload_df_daily = pd.concat([to_upload_df_daily, zero_padded.drop(columns = ["count_people_x", "count_people_y"])])
-
-        current_day = current_day + time_delta_daily
-
-upload_table_bq(to_upload_df, output_table_hourly, schema = {}, client = client)
-upload_table_bq(to_upload_df_daily, output_table_daily, schema = {}, client = client)
\ No newline at end of file
+    upload_table_bq(to_upload_df, output_table_hourly, schema = {}, client = client)
+    upload_table_bq(to_upload_df_daily, output_table_daily, schema = {}, client = client)
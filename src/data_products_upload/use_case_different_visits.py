@@ -4,7 +4,8 @@ import pandas as pd
 import utils.config as config
 from utils.utils import align_user_table
 from utils.bigquery_utils import upload_table_bq
-from use_cases.different_visits import get_different_visits_query, get_always_inside_query, get_different_visits_dist
+import shapely
+from use_cases.different_visits import get_different_visits, get_always_inside_query, get_different_visits_dist
 
 credentials, project = google.auth.default()
 client = bigquery.Client(credentials=credentials)
@@ -25,11 +26,17 @@ max_time = pd.to_datetime(config.end_datetime_demo_prev, utc=True)
 to_upload_df = pd.DataFrame(columns = ["polygon_id", "date_start", "interval_length", "date_end", 
                                        "residency_status", "number_different_visits", "count_people"])
 
-for i, (poly_ind, polygon) in enumerate(output_polygons.loc[output_polygons.polygon_description.isin(["Concelho", 
-                                                                                                      "Freguesia", 
-                                                                                                      "POI", 
-                                                                                                      "Secção", 
-                                                                                                      "Subsecção"])].iterrows()):
+area_polygons = output_polygons.loc[output_polygons.polygon_description.isin(["Concelho", 
+                                                                               "Freguesia", 
+                                                                               "POI", 
+                                                                               "Secção", 
+                                                                               "Subsecção"])]
+
+# the visits to all the polygons, from one scan of the trajectory details
+all_polygons_visits = get_different_visits([shapely.wkt.loads(geography) for geography in area_polygons.geography], project_dataset, client)
+visits_by_polygon = dict(tuple(all_polygons_visits.drop(columns=["polygon_position"]).groupby(all_polygons_visits.polygon_position)))
+
+for i, (poly_ind, polygon) in enumerate(area_polygons.iterrows()):
         
     print(f"{i} ({poly_ind})")
     if i%101 == 100 and len(to_upload_df) > 0:
@@ -40,7 +47,7 @@ for i, (poly_ind, polygon) in enumerate(output_polygons.loc[output_polygons.poly
     pol_relevant_user_table = align_user_table(polygon, user_table)
     
     current_day = pd.to_datetime(config.start_datetime_demo, utc=True)
-    all_diff_visits = client.query(get_different_visits_query(polygon["geography"], project_dataset)).to_dataframe()
+    all_diff_visits = visits_by_polygon.get(i, all_polygons_visits.iloc[:0].drop(columns=["polygon_position"]))
     
     while current_day < max_time:
         
@@ -0,0 +1,47 @@
+import pandas as pd
+import sys
+from functools import partial
+from building_blocks import BB5
+from utils.bigquery_utils import default_client, UploadManager
+from utils.local_client import LocalClient
+from utils.profiling import RunReport, InstrumentedClient
+from scheduler import run_hourly
+
+
+'''
+Fill the cell occupancy cube of BB5 for the days whose trajectory details were processed before the pipeline wrote it,
+or rewrite the days of a range. Every day is deleted from the cube and its hours inserted again, as in the pipeline.
+
+    python backfill_cell_occupancy.py first_day last_day [data_dir]
+'''
+
+
+def main(first_day, last_day, data_dir = None):
+
+    if data_dir is not None:
+        client_factory = partial(LocalClient, data_dir)
+    else:
+        client_factory = default_client
+    raw_client = client_factory()
+    upload_manager = UploadManager(raw_client)
+    client = InstrumentedClient(upload_manager)
+    project_dataset = f"{raw_client.project}.rw_data_west1"
+    report = RunReport(f"backfill_cell_occupancy {first_day} {last_day}")
+
+    for day in pd.date_range(first_day, last_day, freq="D"):
+        day = str(day.date())
+        print(day)
+        with report.stage("cell_occupancy", day = day):
+            BB5.delete_cell_occupancy(day, project_dataset, client)
+            run_hourly(BB5.insert_cell_occupancy, day, (project_dataset,), client, client_factory)
+        # the day is committed before the next one, an interrupted backfill keeps the finished days
+        upload_manager.flush()
+        if isinstance(raw_client, LocalClient):
+            raw_client.flush()
+
+    print(report.summary())
+
+
+if __name__ == "__main__":
+    # the guard is needed by the process pool of the hourly loops, its workers import this module
+    main(sys.argv[1], sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None)
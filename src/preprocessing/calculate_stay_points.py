@@ -1,7 +1,9 @@
+import math
+import numpy as np
 import pandas as pd
-from skmob.preprocessing import detection
-import skmob
+import utils.config as config
 from utils.config import USER_ID
+from trajectory_kernels import group_starts, group_ends
 
 
 def _get_first_last_sp(traj_df):
@@ -30,20 +32,163 @@ def get_first_last_sp(df):
     return df.groupby(["trajectory_id"]).apply(_get_first_last_sp).reset_index(drop=True)
 
 
-
-def calculate_stay_points(df):
+def calculate_stay_points_skmob(df, spatial_radius_m = config.STAY_POINT_DISTANCE_THRESHOLD,
+                                time_threshold = config.STAY_POINT_TIME_THRESHOLD):
     '''
-    Find stay points in trajectories.
-    
+    Find stay points in trajectories with skmob. Reference implementation of calculate_stay_points, kept for the
+    benchmark.
     '''
-    
+    # only needed by the reference implementation
+    from skmob.preprocessing import detection
+    import skmob
+
     traj_df = skmob.TrajDataFrame(df, datetime="datetime", user_id = USER_ID, longitude="lon", trajectory_id = "trajectory_id")
-    sps = detection.stay_locations(traj_df)
+    sps = detection.stay_locations(traj_df, minutes_for_a_stop = time_threshold / 60, spatial_radius_km = spatial_radius_m / 1000)
     sps["centroid_geography"] = [f"POINT({lon} {lat})" for lat, lon in zip(sps.lat.values, sps.lng.values)]
     sps = sps.loc[:,['datetime', 'lat', 'lng', 'uid','tid','leaving_datetime', 'centroid_geography']]
     sps.rename({"datetime": 'datetime_arrive', 'leaving_datetime': 'datetime_leave', "lng": 'lon',
                 'uid': USER_ID, "tid": 'trajectory_id'}, inplace=True, axis=1)
     sps["stay_time"] = (sps["datetime_leave"] - sps["datetime_arrive"]).dt.seconds
     final_sps = pd.concat([sps, get_first_last_sp(df)], ignore_index = True)
-    
+
     return final_sps
+
+
+def _haversine_km(lat1, lon1, lat2, lon2):
+    # same formula as skmob.utils.gislib.getDistanceByHaversine, on arrays
+    lon1 = lon1 * np.pi / 180.0
+    lon2 = lon2 * np.pi / 180.0
+    lat1 = lat1 * np.pi / 180.0
+    lat2 = lat2 * np.pi / 180.0
+    a = (np.sin((lat2 - lat1) / 2)) ** 2 + np.cos(lat1) * np.cos(lat2) * (np.sin((lon2 - lon1) / 2.0)) ** 2
+    return 6371.0 * 2.0 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+
+
+def _haversine_km_scalar(lat1, lon1, lat2, lon2):
+    # _haversine_km on floats
+    lon1 = lon1 * math.pi / 180.0
+    lon2 = lon2 * math.pi / 180.0
+    lat1 = lat1 * math.pi / 180.0
+    lat2 = lat2 * math.pi / 180.0
+    a = (math.sin((lat2 - lat1) / 2)) ** 2 + math.cos(lat1) * math.cos(lat2) * (math.sin((lon2 - lon1) / 2.0)) ** 2
+    return 6371.0 * 2.0 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
+
+
+def _scan_trajectory(lat, lon, nanoseconds, anchor, point, last, spatial_radius_km, minutes_for_a_stop):
+    # the scan of _stay_point_ranges on the floats of one trajectory, from its anchor and the last point compared to it
+    lat, lon = lat[anchor:last + 1].tolist(), lon[anchor:last + 1].tolist()
+    nanoseconds = nanoseconds[anchor:last + 1].tolist()
+    offset, anchor, last = anchor, 0, last - anchor
+    first_points, end_points = [], []
+
+    for point in range(point - offset + 1, last + 1):
+        if point == last or _haversine_km_scalar(lat[anchor], lon[anchor], lat[point], lon[point]) > spatial_radius_km:
+            if (nanoseconds[point] - nanoseconds[anchor]) / 1e9 / 60. > minutes_for_a_stop:
+                first_points.append(anchor + offset)
+                end_points.append(point + offset)
+            anchor = point
+
+    return np.array(first_points, dtype="int64"), np.array(end_points, dtype="int64")
+
+
+def _stay_point_ranges(lat, lon, nanoseconds, starts, spatial_radius_km, minutes_for_a_stop, min_scanned = 32):
+    '''
+    Scan every trajectory once, as skmob's stay_locations does. The anchor is the first point of the current candidate
+    stay; a candidate ends at the first point further than the radius from the anchor (or at the last point of the
+    trajectory) and becomes a stay point if it lasted more than minutes_for_a_stop. Returns, for every stay point, the
+    index of its first point and of the point where it ends: the stay is made of the points in between, and the user
+    leaves it at the time of the ending point.
+
+    Every anchor depends on the previous one, so a trajectory is scanned point by point, but the trajectories are
+    scanned together: every step compares the next point of every trajectory with its anchor with numpy. When fewer
+    than min_scanned trajectories are left, a numpy step costs more than a scalar loop over their points, and the
+    longest trajectories are finished one by one.
+    '''
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(lat)) - 1
+    scanned = last > first
+    anchor, point, last = first[scanned], first[scanned], last[scanned]
+    first_points, end_points = [], []
+
+    while len(point) >= min_scanned:
+        point = point + 1
+        leaves = (_haversine_km(lat[anchor], lon[anchor], lat[point], lon[point]) > spatial_radius_km) | (point == last)
+        stays = leaves & ((nanoseconds[point] - nanoseconds[anchor]) / 1e9 / 60. > minutes_for_a_stop)
+        first_points.append(anchor[stays])
+        end_points.append(point[stays])
+        anchor = np.where(leaves, point, anchor)
+        unfinished = point < last
+        anchor, point, last = anchor[unfinished], point[unfinished], last[unfinished]
+
+    for anchor, point, last in zip(anchor.tolist(), point.tolist(), last.tolist()):
+        trajectory_first, trajectory_end = _scan_trajectory(lat, lon, nanoseconds, anchor, point, last,
+                                                            spatial_radius_km, minutes_for_a_stop)
+        first_points.append(trajectory_first)
+        end_points.append(trajectory_end)
+
+    # in the order of the points, as found by a scan of the trajectories one after the other
+    first_points = np.concatenate([np.array([], dtype="int64")] + first_points)
+    end_points = np.concatenate([np.array([], dtype="int64")] + end_points)
+    order = np.argsort(first_points, kind="stable")
+    return first_points[order], end_points[order]
+
+
+def _segment_medians(values, first_points, end_points):
+    # median of values[first:end] for every range, as np.median: middle value, or mean of the two middle values
+    lengths = end_points - first_points
+    offsets = np.cumsum(lengths) - lengths
+    segment = np.repeat(np.arange(len(lengths)), lengths)
+    indices = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(first_points, lengths)
+
+    segment_values = values[indices]
+    sorted_values = segment_values[np.lexsort((segment_values, segment))]
+    low = sorted_values[offsets + (lengths - 1) // 2]
+    high = sorted_values[offsets + lengths // 2]
+    return np.where(lengths % 2 == 1, low, (low + high) / 2)
+
+
+def _first_last_stay_points(df, starts):
+    # the first and last points of every trajectory are added as stay points of zero duration
+    first = np.flatnonzero(starts)
+    last = np.flatnonzero(group_ends(starts))
+    points = np.column_stack([first, last]).ravel()
+
+    dictionary = dict(trajectory_id = df.trajectory_id.values[points],
+                      lat = df.lat.values[points],
+                      lon = df.lon.values[points],
+                      datetime_arrive = df.datetime.iloc[points].reset_index(drop=True),
+                      datetime_leave = df.datetime.iloc[points].reset_index(drop=True),
+                      stay_time = np.zeros(len(points), dtype="int64"),
+                      centroid_geography = df.geography.values[points])
+    dictionary[USER_ID] = df[USER_ID].values[points]
+    return pd.DataFrame.from_dict(dictionary)
+
+
+def calculate_stay_points(df, spatial_radius_m = config.STAY_POINT_DISTANCE_THRESHOLD,
+                          time_threshold = config.STAY_POINT_TIME_THRESHOLD):
+    '''
+    Find stay points in trajectories.
+
+    A stay point is detected when the user spends more than time_threshold seconds within spatial_radius_m meters of
+    a point of the trajectory, with the algorithm of skmob's stay_locations. Its location is the median of the points of
+    the stay. The first and last points of every trajectory are added as stay points of zero duration.
+    '''
+    df = df.sort_values(by=[USER_ID, "trajectory_id", "datetime"], kind="mergesort").reset_index(drop=True)
+    starts = group_starts(df[USER_ID].values, df.trajectory_id.values)
+    nanoseconds = df.datetime.values.astype("datetime64[ns]").view("int64")
+
+    first_points, end_points = _stay_point_ranges(df.lat.values, df.lon.values, nanoseconds, starts,
+                                                  spatial_radius_m / 1000, time_threshold / 60)
+
+    lat = _segment_medians(df.lat.values, first_points, end_points)
+    lon = _segment_medians(df.lon.values, first_points, end_points)
+    sps = pd.DataFrame({"datetime_arrive": df.datetime.iloc[first_points].reset_index(drop=True),
+                        "lat": lat,
+                        "lon": lon,
+                        USER_ID: df[USER_ID].values[first_points],
+                        "trajectory_id": df.trajectory_id.values[first_points],
+                        "datetime_leave": df.datetime.iloc[end_points].reset_index(drop=True),
+                        "centroid_geography": "POINT(" + pd.Series(lon).astype(str) + " " + pd.Series(lat).astype(str) + ")"})
+    sps["stay_time"] = (sps["datetime_leave"] - sps["datetime_arrive"]).dt.seconds
+
+    return pd.concat([sps, _first_last_stay_points(df, starts)], ignore_index = True)
@@ -1,6 +1,7 @@
 import numpy as np
 from utils.config import USER_ID
 import pandas as pd
+import math
 
 
 def getDistanceByEuclidean(coords1, coords2):
@@ -148,3 +149,105 @@ def _compress_array(lat_lng_dtime_other, spatial_radius, velocity_threshold):
         compressed_traj += [[med_lat, med_lon, sum_t[-1]] + extra_cols]
 
     return compressed_traj
+
+
+
+def _distance_radians(lat_1, lon_1, lat_2, lon_2):
+    # same Euclidean formula as getDistanceMatrix, for a single pair of points already converted to radians
+    dx = (lon_1 - lon_2) * math.cos(0.5 * (lat_1 + lat_2))
+    dy = lat_1 - lat_2
+    return math.sqrt(dx ** 2 + dy ** 2) * 6371000  # 6371000 is the approximate radius of the earth in meters
+
+
+def _is_too_fast(distance_meters, seconds, max_velocity):
+    # scalar version of check_velocity, keeping numpy semantics for a zero time difference
+    if seconds == 0:
+        return distance_meters > 0
+    return distance_meters / seconds >= max_velocity
+
+
+def _median(values):
+    # np.median for a short list of floats, without the array round-trip
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2 == 1:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def _compress_stream(lat, lon, nanoseconds, starts, spatial_radius, velocity_threshold):
+    '''
+    Single pass over the points of all users, with the same anchor/median rule as _compress_array.
+    
+    Only the distances from the current anchor and from the last accepted point are computed, so the working set is the
+    cluster of points around the current anchor. Returns, for every point of the compressed trajectories, the index of the
+    anchor row, the median coordinates of its cluster and the index of the row that gives its datetime.
+    '''
+    lat_rad, lon_rad = np.radians(lat).tolist(), np.radians(lon).tolist()
+    lat, lon, starts = lat.tolist(), lon.tolist(), starts.tolist()
+    anchors, median_lats, median_lons, time_rows = [], [], [], []
+    
+    def close_cluster(i_0, cluster):
+        med_lat, med_lon = _median([lat[j] for j in cluster]), _median([lon[j] for j in cluster])
+        anchors.append(i_0)
+        median_lats.append(med_lat)
+        median_lons.append(med_lon)
+        time_rows.append(cluster[0])
+        if len(cluster) > 1:
+            anchors.append(i_0)
+            median_lats.append(med_lat)
+            median_lons.append(med_lon)
+            time_rows.append(cluster[-1])
+    
+    i_0, last_i, cluster = 0, 0, []
+    for i in range(len(lat)):
+        
+        if starts[i]:
+            if len(cluster) > 0:
+                close_cluster(i_0, cluster)
+            i_0, last_i, cluster = i, i, [i]
+            continue
+        
+        Dr = _distance_radians(lat_rad[i_0], lon_rad[i_0], lat_rad[i], lon_rad[i])
+        
+        if Dr > spatial_radius:
+            
+            D_last = _distance_radians(lat_rad[last_i], lon_rad[last_i], lat_rad[i], lon_rad[i])
+            if _is_too_fast(D_last, (nanoseconds[i] - nanoseconds[last_i]) / 1e9, velocity_threshold):
+                continue
+                
+            close_cluster(i_0, cluster)
+            i_0, cluster = i, []
+            
+        cluster.append(i)
+        last_i = i
+    
+    if len(cluster) > 0:
+        close_cluster(i_0, cluster)
+    
+    return np.array(anchors, dtype=int), np.array(median_lats), np.array(median_lons), np.array(time_rows, dtype=int)
+
+
+def compress_streaming(tdf, spatial_radius_m=25, velocity_threshold_ms = 35):
+    """Trajectory compression in a single pass over all users.
+    
+    Same output as `compress`, but instead of building a distance matrix per user it only computes the distances the
+    anchor/median rule needs, so memory is linear in the number of points. The input must be sorted by user and datetime.
+    """
+    if len(tdf) == 0:
+        return tdf.reset_index(drop=True)
+    
+    users = tdf[USER_ID].values
+    starts = np.ones(len(tdf), dtype=bool)
+    starts[1:] = users[1:] != users[:-1]
+    datetimes = pd.to_datetime(tdf["datetime"]).reset_index(drop=True)
+    nanoseconds = datetimes.values.view("int64").tolist()
+    
+    anchors, median_lats, median_lons, time_rows = _compress_stream(tdf.lat.values.astype(float), tdf.lon.values.astype(float), 
+                                                                    nanoseconds, starts, spatial_radius_m, velocity_threshold_ms)
+    
+    ctdf = tdf.iloc[anchors].reset_index(drop=True)
+    ctdf["lat"] = median_lats
+    ctdf["lon"] = median_lons
+    ctdf["datetime"] = datetimes.iloc[time_rows].reset_index(drop=True)
+    return ctdf
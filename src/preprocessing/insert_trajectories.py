@@ -1,16 +1,24 @@
 import utils.config as config
-from utils.bigquery_queries import finished_trajectories_query, unfinished_trajectories_query
-from segment_trajectories import process_finished_trajectories
+from utils.bigquery_queries import finished_trajectories_query, unfinished_trajectories_query, new_pings_query
+from segment_trajectories_vectorized import process_finished_trajectories
 from utils.bigquery_utils import upload_table_bq
 
 
-def insert_trajectories(day, time_start, time_end, raw_data_table, project_dataset, bq_client):
+def insert_trajectories(day, time_start, time_end, raw_data_table, project_dataset, bq_client, trajectory_buffer = None):
     
-    finished_trajectories_q = finished_trajectories_query(day, time_start, time_end, raw_data_table, project_dataset)
-    unfinished_trajectories_q = unfinished_trajectories_query(day, time_start, time_end, raw_data_table, project_dataset)
+    if trajectory_buffer is not None:
+        # only the pings of this hour are read, the tails of the unfinished trajectories are kept locally
+        new_pings = bq_client.query(new_pings_query(day, time_start, time_end, raw_data_table)).to_dataframe()
+        finished_trajectories = trajectory_buffer.update(new_pings, day, time_end)
+    else:
+        finished_trajectories_q = finished_trajectories_query(day, time_start, time_end, raw_data_table, project_dataset)
+        unfinished_trajectories_q = unfinished_trajectories_query(day, time_start, time_end, raw_data_table, project_dataset)
+        
+        finished_trajectories = bq_client.query(finished_trajectories_q).to_dataframe()
+        bq_client.query(unfinished_trajectories_q).result()
     
-    finished_trajectories = bq_client.query(finished_trajectories_q).to_dataframe()
-    bq_client.query(unfinished_trajectories_q).result()
+    if len(finished_trajectories) == 0:
+        return finished_trajectories
     
     processed_finished_trajectories, trajectory_summary = process_finished_trajectories(finished_trajectories)
     
@@ -1,62 +1,111 @@
 import pandas as pd
-import google.auth
-from google.cloud import bigquery
 import sys
-from building_blocks import BB2, BB3, BB4, BB6, BB9, BB10, BB11
+from functools import partial
+from building_blocks import BB2, BB3, BB4, BB5, BB6, BB9, BB10, BB11
 import utils.config as config
 import pickle as pkl
-from utils.bigquery_utils import upload_table_bq
-
-
-credentials, project = google.auth.default()
-client = bigquery.Client(credentials=credentials)
-project_dataset = f"{project}.rw_data_west1"
+from utils.bigquery_utils import upload_table_bq, default_client, UploadManager
+from utils.local_client import LocalClient
+from utils.profiling import RunReport, InstrumentedClient
+from utils.cell_index import get_cell_index
 
 demo_table = "cityanalyser-busdp-p-238755.data_products.df_city_analyser_demo"
 
 import insert_trajectories
 import insert_stay_points
+from trajectory_buffer import UnfinishedTrajectoryBuffer
+from scheduler import run_hourly
+
+
+def main(day, data_dir = None):
+
+    if data_dir is not None:
+        # run offline on a local extract: every table is a Parquet file in the given directory
+        client_factory = partial(LocalClient, data_dir)
+    else:
+        client_factory = default_client
+    raw_client = client_factory()
+    # the uploads are batched per table and loaded in parallel jobs
+    upload_manager = UploadManager(raw_client)
+    client = InstrumentedClient(upload_manager)
+    project_dataset = f"{raw_client.project}.rw_data_west1"
+
+    def commit_tables():
+        # the workers of the hourly loops read the tables with their own clients
+        upload_manager.flush()
+        if isinstance(raw_client, LocalClient):
+            raw_client.flush()
+
+    trajectory_buffer = UnfinishedTrajectoryBuffer()
+    # the day starts without tails, the ones of a previous run of the day would hold pings after the first hour
+    trajectory_buffer.clear()
+    report = RunReport(f"preprocessing_pipeline {day}")
+
+    # the hours depend on each other through the unfinished trajectories, they are processed in order
+    for hour in range(0,23):
+        this_hour = f"{day} {hour:02d}:00:00"
+        print(this_hour)
+        next_hour = str(pd.Timestamp(this_hour) + pd.Timedelta(hours=1))
+        # Query the database for data, separate into trajectories and upload to details and summary tables on bigquery
+        with report.stage("insert_trajectories", hour = this_hour) as stage:
+            finished = insert_trajectories.insert_trajectories(day, this_hour, next_hour, demo_table, project_dataset, client, trajectory_buffer)
+            stage["rows_out"] = len(finished)
+        if len(finished) > 0:
+            # if there are any finished trajectories, calculate their stay points and upload to bigquery
+            with report.stage("insert_stay_points", hour = this_hour, rows_in = len(finished)):
+                insert_stay_points.insert_stay_points(finished, project_dataset, client)
+
+    # find where users are staying during the night
+    with report.stage("BB2"):
+        BB2.insert_user_stay_place(client, f"{project_dataset}.{config.table_trajectory_details}", day, project_dataset, config.table_user_night_location)
+    # find where users are staying during the day
+    with report.stage("BB3"):
+        BB3.insert_user_stay_place(client, f"{project_dataset}.{config.table_trajectory_details}", day, project_dataset, f"{project_dataset}{config.table_user_work_location}")
+
+    # determine the mode of transport of trajectories during this day
+    classifier = pkl.load(open(config.mode_of_transport_model, "rb"))
+    with report.stage("BB4_stationary_undefined"):
+        stationary_trajectories = BB4.get_stationary_trajectories(client, project_dataset, day)
+        upload_table_bq(stationary_trajectories, f"{project_dataset}.{config.table_mode_of_transport}", {}, client)
+        undefined_trajectories = BB4.get_undefined_trajectories(client, project_dataset, day)
+        upload_table_bq(undefined_trajectories, f"{project_dataset}.{config.table_mode_of_transport}", {}, client)
+    commit_tables()
+    with report.stage("BB4_labels") as stage:
+        labeled_hours = run_hourly(BB4.assign_transport_mode_label, day, (classifier, project_dataset), client, client_factory)
+        labeled_hours = [labeled_trajectories for labeled_trajectories in labeled_hours if labeled_trajectories is not None]
+        stage["rows_out"] = sum(len(labeled_trajectories) for labeled_trajectories in labeled_hours)
+        for labeled_trajectories in labeled_hours:
+            upload_table_bq(labeled_trajectories, f"{project_dataset}.{config.table_mode_of_transport}", {}, client)
+
+    # assign a residential status to users
+    with report.stage("BB9"):
+        BB9.insert_user_residential_status(client, project_dataset, f"{project_dataset}.{config.table_trajectory_details}", day)
+    # assign a professional status to users
+    with report.stage("BB10"):
+        BB10.insert_professional_status_classification(client, project_dataset, day)
+    # classify where users are spending the night (hotel, home, other)
+    with report.stage("BB11"):
+        BB11.insert_night_stay_type(client, project_dataset, day)
+
+    # Upload the origin-destination matrix, the hours are independent
+    commit_tables()
+    # built before the workers start, they load it from disk
+    get_cell_index(client, project_dataset)
+    with report.stage("BB6"):
+        run_hourly(BB6.BB6, day, (project_dataset,), client, client_factory)
+    with report.stage("BB6_section"):
+        run_hourly(BB6.BB6_section, day, (project_dataset,), client, client_factory)
+    # distinct users per cell and hour, read by the traffic flow (BB5)
+    with report.stage("cell_occupancy"):
+        # in the main process, the workers do not write
+        BB5.delete_cell_occupancy(day, project_dataset, client)
+        run_hourly(BB5.insert_cell_occupancy, day, (project_dataset,), client, client_factory)
+
+    commit_tables()
+    report.save(config.pipeline_report.format(day = day))
+    print(report.summary())
+
 
-day = sys.argv[1]
-
-for hour in range(0,23):
-    this_hour = f"{day} {hour:02d}:00:00"
-    print(this_hour)
-    next_hour = str(pd.Timestamp(this_hour) + pd.Timedelta(hours=1))
-    # Query the database for data, separate into trajectories and upload to details and summary tables on bigquery
-    finished = insert_trajectories.insert_trajectories(day, this_hour, next_hour, demo_table, project_dataset, client)
-    if len(finished) > 0:
-        # if there are any finished trajectories, calculate their stay points and upload to bigquery
-        insert_stay_points.insert_stay_points(finished, project_dataset, client)
-
-# find where users are staying during the night
-BB2.insert_user_stay_place(client, f"{project_dataset}.{config.table_trajectory_details}", day, project_dataset, f"{project_dataset}{config.table_user_night_location}")
-# find where users are staying during the day
-BB3.insert_user_stay_place(client, f"{project_dataset}.{config.table_trajectory_details}", day, project_dataset, f"{project_dataset}{config.table_user_work_location}")
-
-# determine the mode of transport of trajectories during this day
-classifier = pkl.load(open(config.mode_of_transport_model, "rb"))
-stationary_trajectories = BB4.get_stationary_trajectories(client, project_dataset, day)
-upload_table_bq(stationary_trajectories, f"{project_dataset}.{config.table_mode_of_transport}", {}, client)
-undefined_trajectories = BB4.get_undefined_trajectories(client, project_dataset, day)
-upload_table_bq(undefined_trajectories, f"{project_dataset}.{config.table_mode_of_transport}", {}, client)
-for hour in range(0, 23):
-    this_hour = f"{day} {hour:02d}:00:00"
-    next_hour = str(pd.Timestamp(this_hour) + pd.Timedelta(hours=1))
-    labeled_trajectories = BB4.assign_transport_mode_label(this_hour, next_hour, classifier, project_dataset, client)
-    if labeled_trajectories is not None:
-        upload_table_bq(labeled_trajectories, f"{project_dataset}.{config.table_mode_of_transport}", {}, client)
-
-# assign a residential status to users
-BB9.insert_user_residential_status(client, project_dataset, f"{project_dataset}.{config.table_trajectory_details}", day)
-# assign a professional status to users
-BB10.insert_professional_status_classification(client, project_dataset, day)
-# classify where users are spending the night (hotel, home, other)
-BB11.insert_night_stay_type(client, project_dataset, day)
-
-# Upload the origin-destination matrix 
-for hour in range(0, 23):
-    this_hour = f"{day} {hour:02d}:00:00"
-    next_hour = str(pd.Timestamp(this_hour) + pd.Timedelta(hours=1))
-    BB6.BB6(this_hour, next_hour, project_dataset, client)
-    BB6.BB6_section(this_hour, next_hour, project_dataset, client)
\ No newline at end of file
+if __name__ == "__main__":
+    # the guard is needed by the process pool of the hourly loops, its workers import this module
+    main(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else None)
@@ -0,0 +1,91 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import utils.config as config
+from utils.profiling import RunReport, InstrumentedClient, record
+
+
+'''
+Process pool for the hourly loops of the pipeline whose hours are independent of each other (BB4 labelling, BB6,
+BB6_section and the cell occupancy of BB5). The segmentation loop carries the unfinished trajectories from one hour to the next, so it stays
+sequential in preprocessing_pipeline.py.
+
+Clients can not be pickled, so every worker builds its own client with client_factory when it starts. The uploads made
+by a task are not sent from the worker: they are returned and replayed in hour order on the client of the main process,
+so the main process is the only writer (the local Parquet tables of LocalClient can not take concurrent writers). The
+query metrics of every task are added to the active profiling stage of the main process.
+'''
+
+
+_worker_client = None
+
+
+def hourly_windows(day, hours = range(0, 23)):
+    windows = []
+    for hour in hours:
+        this_hour = f"{day} {hour:02d}:00:00"
+        next_hour = str(pd.Timestamp(this_hour) + pd.Timedelta(hours=1))
+        windows.append((this_hour, next_hour))
+    return windows
+
+
+class _DoneJob:
+
+    def result(self):
+        return self
+
+
+class DeferredUploadClient:
+    '''
+    Client proxy that keeps the uploads instead of running them, to be replayed by the main process.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+        self.uploads = []
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def load_table_from_dataframe(self, dataframe, destination, job_config = None):
+        self.uploads.append((dataframe, destination, job_config))
+        return _DoneJob()
+
+
+def _init_worker(client_factory):
+    global _worker_client
+    _worker_client = client_factory()
+
+
+def _run_task(function, this_hour, next_hour, args):
+
+    client = DeferredUploadClient(InstrumentedClient(_worker_client))
+    with RunReport(function.__name__).stage(function.__name__, hour = this_hour) as stage:
+        result = function(this_hour, next_hour, *args, client)
+    return result, client.uploads, stage
+
+
+def run_hourly(function, day, args, client, client_factory = None, n_jobs = config.pipeline_n_jobs):
+    '''
+    Call function(this_hour, next_hour, *args, client) for every hour of the day and return the results in hour order.
+
+    With n_jobs > 1 and a client_factory the hours run in a pool of n_jobs processes. The tables the function reads must
+    be committed before (flushed, for a LocalClient), since the workers use their own clients.
+    '''
+    windows = hourly_windows(day)
+    if n_jobs == 1 or client_factory is None:
+        return [function(this_hour, next_hour, *args, client) for this_hour, next_hour in windows]
+
+    results = []
+    # spawn, not fork: the main process may hold DuckDB or gRPC state that is not fork safe
+    with ProcessPoolExecutor(max_workers = n_jobs, mp_context = multiprocessing.get_context("spawn"),
+                             initializer = _init_worker, initargs = (client_factory,)) as executor:
+        futures = [executor.submit(_run_task, function, this_hour, next_hour, args) for this_hour, next_hour in windows]
+        for future in futures:
+            result, uploads, stage = future.result()
+            for dataframe, destination, job_config in uploads:
+                client.load_table_from_dataframe(dataframe, destination, job_config = job_config).result()
+            record(**{key: stage[key] for key in ["queries", "bytes_processed", "rows_read"] if key in stage})
+            results.append(result)
+
+    return results
@@ -3,7 +3,7 @@ import pandas as pd
 import time
 from compress_trajectory import compress
 import numpy as np
-from numpy.lib.stride_tricks import sliding_window_view
+from trajectory_kernels import group_starts, segmented_consecutive_distance, smooth_coords_calculate_distance
 
 
 def sort_df_values(df):
@@ -32,36 +32,14 @@ def calculate_dates_times(df, cols_to_group = [config.USER_ID]):
 
 def calc_distance(df):
     
-    coords = df.loc[:, ["lat", "lon"]].values
-    # convert the array to a NumPy array and convert latitudes to radians
-    coords = np.radians(np.asarray(coords.astype(float)))
-
-    # calculate the pairwise differences in latitude and longitude
-    dlat = coords[:, 0, np.newaxis] - coords[:, 0]
-    dlon = coords[:, 1, np.newaxis] - coords[:, 1]
-
-    # calculate the distance using the Euclidean formula
-    dx = dlon * np.cos(0.5 * (coords[:, 0, np.newaxis] + coords[:, 0]))
-    dy = dlat
-    distance = np.sqrt(dx ** 2 + dy ** 2) * 6371000  # 6371000 is the approximate radius of the earth in meters
-
-    return np.append(np.diag(distance, k=1), [0])
+    # only the distance between consecutive points is needed, so there is no need for the full pairwise matrix
+    return segmented_consecutive_distance(df.lat.values.astype(float), df.lon.values.astype(float), group_starts(np.zeros(len(df))))
 
 
 def _align_coords_calculate_distance(df):
     
-    padded = np.pad(df[["lat","lon"]].values, ((4,0), (0,0)), mode="edge")
-    slidding_padded = sliding_window_view(padded, (5, 2)).squeeze(1)[::1, :, :]
-    median_lat = np.median(slidding_padded[:, :, 0], axis=1)
-    median_lon = np.median(slidding_padded[:, :, 1], axis=1)
-
-    # Combine the median latitudes and longitudes into a single array
-    median_coordinates = np.column_stack((median_lat, median_lon))
-
-    df["lat"] = median_coordinates[:, 0]
-    df["lon"] = median_coordinates[:, 1]
-    
-    df['distance'] = calc_distance(df) 
+    starts = group_starts(np.zeros(len(df)))
+    df["lat"], df["lon"], df['distance'] = smooth_coords_calculate_distance(df.lat.values, df.lon.values, starts)
     
     return df
     
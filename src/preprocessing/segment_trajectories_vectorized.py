@@ -0,0 +1,122 @@
+import utils.config as config
+import pandas as pd
+import time
+from compress_trajectory import compress_streaming
+import numpy as np
+from segment_trajectories import sort_df_values, group_same_datetime
+from trajectory_kernels import (group_starts, group_ends, segmented_dates_times, smooth_coords_calculate_distance, 
+                                segmented_consecutive_distance, segmented_shift_next)
+
+
+'''
+Whole-frame implementation of process_finished_trajectories.
+
+Instead of calling a Python function once per user (or per trajectory) through groupby.apply, every step works on the
+complete frame sorted by user and datetime. Group membership is encoded as boolean masks marking the first (or last)
+row of each group, and per group operations become segmented diff/shift on the flat arrays and np.add.reduceat style
+reductions over the group start offsets.
+'''
+
+
+def assign_trajectory_ids(df, trajectory_starts):
+    '''
+    Every trajectory is identified by the user and the datetime of its first point.
+    '''
+    first_rows = df.loc[trajectory_starts, [config.USER_ID, "datetime"]]
+    first_ids = (first_rows[config.USER_ID].astype(str) + "_" +
+                 first_rows["datetime"].dt.strftime(config.TRAJECTORY_CONVERT_TIME_FORMAT)).values
+    return first_ids[np.cumsum(trajectory_starts) - 1]
+
+
+def trajectory_statistics(df, starts):
+    '''
+    One row per trajectory with the same columns as segment_trajectories.get_trajectory_statistics.
+    '''
+    first = np.flatnonzero(starts)
+    last = np.flatnonzero(group_ends(starts))
+
+    datetimes = df.datetime.values
+    total_time = (datetimes[last] - datetimes[first]).astype("timedelta64[s]").astype("int64") % 86400  # as Timedelta.seconds
+    total_distance = np.add.reduceat(df.distance.values, first)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        average_speed = np.where(total_time > 0, total_distance / total_time, 0)
+        average_acceleration = np.where(total_time > 0, average_speed / total_time, 0)
+
+    lat, lon = df.lat.values, df.lon.values
+    distance_difference = [config.distance_function([lat[i], lon[i]], [lat[j], lon[j]]).meters for i, j in zip(first, last)]
+
+    stats_dict = dict(total_time = total_time,
+                      distance_difference = distance_difference,
+                      total_distance = total_distance,
+                      average_speed = average_speed,
+                      average_acceleration = average_acceleration,
+                      n_points = last - first + 1,
+                      start_point = df.geography.values[first],
+                      end_point = df.geography.values[last],
+                      start_time = df.datetime.iloc[first].reset_index(drop=True),
+                      end_time = df.datetime.iloc[last].reset_index(drop=True),
+                      trajectory_id = df.trajectory_id.values[first])
+    stats_dict[config.USER_ID] = df[config.USER_ID].values[first]
+
+    return pd.DataFrame.from_dict(stats_dict)
+
+
+def prepare_pings(df):
+    '''
+    Raw pings to the sorted frame the segmentation works on, with pings of the same user and datetime grouped.
+    '''
+    df = df.rename(columns={'rec_timestamp': 'datetime'})
+    df['datetime'] = pd.to_datetime(df["datetime"])
+    df["lat"] = df.lat.astype(float)
+    df["lon"] = df.lon.astype(float)
+
+    df = sort_df_values(df)
+    return group_same_datetime(df)
+
+
+def segment_compressed_pings(df):
+    '''
+    Split the compressed pings of every user into trajectories, returning the trajectory details and their summary.
+    '''
+    start = time.time()
+    user_starts = group_starts(df[config.USER_ID].values)
+    df['seconds_since_prior'], df['seconds_to_next'] = segmented_dates_times(df.datetime.values, user_starts)
+    df["lat"], df["lon"], df['distance'] = smooth_coords_calculate_distance(df.lat.values, df.lon.values, user_starts)
+    print(f"Finished aligning coords and calc dists: {time.time()-start:.2f}s")
+
+    start = time.time()
+    cuts = (((df["seconds_since_prior"] > config.NEW_TRAJECTORY_TIME_THRESHOLD) &
+             (df["distance"] < config.COMPRESSION_THRESHOLD)) |
+            (df["distance"] > config.NEW_TRAJECTORY_DISTANCE_THRESHOLD)).values
+    trajectory_starts = user_starts | cuts
+    df["trajectory_id"] = assign_trajectory_ids(df, trajectory_starts)
+    print(f"Finished segmenting trajectories: {time.time()-start:.2f}s")
+
+    start = time.time()
+    df['geography'] = "POINT(" + df.lon.astype(str) + " " + df.lat.astype(str) + ")"
+    df['seconds_since_prior'], df['seconds_to_next'] = segmented_dates_times(df.datetime.values, trajectory_starts)
+    df['distance'] = segmented_consecutive_distance(df.lat.values, df.lon.values, trajectory_starts)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        df['velocity'] = df['distance'] / df.seconds_to_next
+        df['acceleration'] = (segmented_shift_next(df['velocity'].values, trajectory_starts) - df['velocity']) / df.seconds_to_next
+    print(f"Finished distances: {time.time()-start:.2f}s")
+
+    start = time.time()
+    df = df.reset_index(drop=True)
+    finished_trajectories_summary = trajectory_statistics(df, trajectory_starts)
+    print(f"Finished stats: {time.time()-start:.2f}s")
+
+    return df, finished_trajectories_summary
+
+
+def process_finished_trajectories(df):
+
+    start = time.time()
+    df = prepare_pings(df)
+    print(f"Finished grouping datetimes: {time.time()-start:.2f}s")
+
+    start = time.time()
+    df = compress_streaming(df, config.COMPRESSION_THRESHOLD, config.VELOCITY_THRESHOLD) # distances are in meters
+    print(f"Finished compressing: {time.time()-start:.2f}s")
+
+    return segment_compressed_pings(df)
@@ -0,0 +1,71 @@
+import os
+import pandas as pd
+import utils.config as config
+
+
+class UnfinishedTrajectoryBuffer:
+    '''
+    Local, persistent carry-over of the pings of users whose trajectory is not finished yet.
+
+    Replaces the unfinished_trajectories_table round-trip: instead of re-reading the raw table from the first unfinished
+    timestamp of every user, each hour only the new pings are read and appended to the buffered tails. A user's pings are
+    released as soon as a gap longer than NEW_TRAJECTORY_TIME_THRESHOLD closes their trajectory, with the same rules as
+    finished_trajectories_query and unfinished_trajectories_query. The tails are kept as a Parquet file sorted by user.
+    '''
+
+    def __init__(self, path = config.unfinished_trajectories_buffer):
+        self.path = path
+
+    def load(self, day):
+
+        if not os.path.exists(self.path):
+            return pd.DataFrame(columns = config.data_columns)
+
+        buffered = pd.read_parquet(self.path)
+        # the raw table is only read for the current day_part, tails from another day are not carried over
+        return buffered.loc[pd.to_datetime(buffered.day_part).dt.date == pd.Timestamp(day).date(), :]
+
+    def save(self, unfinished):
+
+        unfinished.sort_values(by=[config.USER_ID, "rec_timestamp"]).to_parquet(self.path, index=False)
+
+    def clear(self):
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def update(self, new_pings, day, time_end):
+        '''
+        Add the pings of the current hour to the buffered tails, keep the unfinished trajectories and return the pings of
+        the finished ones.
+        '''
+
+        pings = pd.concat([self.load(day), new_pings.loc[:, config.data_columns]], ignore_index = True)
+        pings["rec_timestamp"] = pd.to_datetime(pings["rec_timestamp"], utc = True)
+        pings = pings.drop_duplicates().sort_values(by=[config.USER_ID, "rec_timestamp"]).reset_index(drop=True)
+
+        finished_mask = split_finished_pings(pings, time_end)
+        self.save(pings.loc[~finished_mask, :])
+
+        return pings.loc[finished_mask, :].reset_index(drop=True)
+
+
+def split_finished_pings(pings, time_end):
+    '''
+    Boolean mask of the pings that belong to finished trajectories. The pings must be sorted by user and timestamp.
+
+    A ping is finished if it is before the last gap longer than NEW_TRAJECTORY_TIME_THRESHOLD of its user, or if the user
+    has not been seen for NEW_TRAJECTORY_TIME_THRESHOLD seconds before time_end.
+    '''
+
+    users = pings[config.USER_ID]
+    timestamps = pings["rec_timestamp"]
+
+    next_timestamps = timestamps.groupby(users).shift(-1)
+    gap_after = (next_timestamps - timestamps).dt.total_seconds() > config.NEW_TRAJECTORY_TIME_THRESHOLD
+    last_before_gap = timestamps.where(gap_after).groupby(users).transform("max")
+
+    last_seen = timestamps.groupby(users).transform("max")
+    inactive_since = pd.Timestamp(time_end, tz = "UTC") - pd.Timedelta(seconds = config.NEW_TRAJECTORY_TIME_THRESHOLD)
+
+    return ((timestamps <= last_before_gap) | (last_seen <= inactive_since)).values
@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+
+
+'''
+Array kernels shared by the segmentation engines.
+
+All functions work on the flat arrays of many users (or trajectories) concatenated in sorted order. Group membership is
+given as a boolean mask that is True on the first row of every group, so windows, differences and shifts restart at
+every group boundary. Memory is linear in the number of points.
+'''
+
+
+def group_starts(*columns):
+    '''
+    Boolean mask that is True on the first row of every run of equal keys. The columns are assumed to be sorted.
+    '''
+    n = len(columns[0])
+    starts = np.zeros(n, dtype=bool)
+    if n == 0:
+        return starts
+    starts[0] = True
+    for column in columns:
+        values = np.asarray(column)
+        starts[1:] |= values[1:] != values[:-1]
+    return starts
+
+
+def group_ends(starts):
+    '''
+    Boolean mask that is True on the last row of every group, given the mask of the first rows.
+    '''
+    ends = np.zeros_like(starts)
+    if len(starts) > 0:
+        ends[:-1] = starts[1:]
+        ends[-1] = True
+    return ends
+
+
+def _total_seconds(delta_ns):
+    return pd.to_timedelta(delta_ns, unit="ns").total_seconds().values
+
+
+def segmented_dates_times(datetimes, starts):
+    '''
+    Seconds since the prior point and to the next point, restarting at every group.
+    '''
+    ns = datetimes.view("int64")
+    delta = np.zeros(len(ns), dtype="int64")
+    delta[1:] = ns[1:] - ns[:-1]
+
+    seconds_since_prior = _total_seconds(np.where(starts, 0, delta))
+    seconds_to_next = np.abs(_total_seconds(np.where(group_ends(starts), 0, np.roll(delta, -1))))
+
+    return seconds_since_prior, seconds_to_next
+
+
+def _median_window_indices(starts, window = 5):
+    # for every lag, the index of the lagged point, clipped to the first row of the group (edge padding)
+    index = np.arange(len(starts))
+    group_first = np.maximum.accumulate(np.where(starts, index, 0))
+    return [np.maximum(index - lag, group_first) for lag in range(window - 1, 0, -1)]
+
+
+def segmented_median_5(values, starts, window_indices = None):
+    '''
+    Median of the current value and the 4 previous values of the same group. At the start of a group the window is
+    padded with the first value of the group, as np.pad(mode="edge") does in the per-user implementation.
+
+    The median is taken with element-wise min/max only: the two middle values of the 4 previous points are
+    max(min(a, b), min(c, d)) and min(max(a, b), max(c, d)), and the median of 5 is the median of those two and the
+    current point. This gives exactly the value np.median returns for the odd window.
+    '''
+    if window_indices is None:
+        window_indices = _median_window_indices(starts)
+    a, b, c, d = [values[indices] for indices in window_indices]
+
+    low = np.maximum(np.minimum(a, b), np.minimum(c, d))
+    high = np.minimum(np.maximum(a, b, out=a), np.maximum(c, d, out=c))
+    return np.maximum(np.minimum(values, low), np.minimum(np.maximum(values, low), high))
+
+
+def segmented_consecutive_distance(lat, lon, starts):
+    '''
+    Distance in meters from every point to the next point of the same group, 0 for the last point of each group.
+    Same Euclidean approximation as compress_trajectory.getDistanceMatrix, restricted to its k=1 diagonal.
+    '''
+    lat_rad = np.radians(lat)
+    lon_rad = np.radians(lon)
+
+    distance = np.zeros(len(lat))
+    dlat = np.subtract(lat_rad[:-1], lat_rad[1:])
+    dx = np.subtract(lon_rad[:-1], lon_rad[1:])
+    mean_lat = np.add(lat_rad[:-1], lat_rad[1:], out=lat_rad[:-1])
+    mean_lat *= 0.5
+    dx *= np.cos(mean_lat, out=mean_lat)
+    dx *= dx
+    dlat *= dlat
+    dx += dlat
+    np.sqrt(dx, out=distance[:-1])
+    distance *= 6371000  # 6371000 is the approximate radius of the earth in meters
+    distance[group_ends(starts)] = 0
+
+    return distance
+
+
+def smooth_coords_calculate_distance(lat, lon, starts):
+    '''
+    Sliding 5-point median of the coordinates followed by the distance to the next smoothed point, for all groups at once.
+    '''
+    window_indices = _median_window_indices(starts)
+    median_lat = segmented_median_5(np.asarray(lat, dtype=float), starts, window_indices)
+    median_lon = segmented_median_5(np.asarray(lon, dtype=float), starts, window_indices)
+    return median_lat, median_lon, segmented_consecutive_distance(median_lat, median_lon, starts)
+
+
+def segmented_shift_next(values, starts):
+    '''
+    Value of the next row of the same group, NaN for the last row of each group.
+    '''
+    shifted = np.full(len(values), np.nan)
+    shifted[:-1] = values[1:]
+    shifted[group_ends(starts)] = np.nan
+    return shifted
@@ -2,13 +2,16 @@ from building_blocks.BB1 import BB1_by_datetime, BB1_by_day
 from utils.utils import align_user_table
 import shapely
 import pandas as pd
-from utils.utils import zero_pad_results
+from utils.utils import densify, demo_time_domain
 import utils.config as config
 
 
+CATCHMENT_AREAS = ["local", "regional", "national", "international"]
+
+
 def group_by_catchment_area(df, polygon):
     
-    catchment_area_labels = ["local", "regional", "national", "international"]
+    catchment_area_labels = CATCHMENT_AREAS
 
     international = len(df[(df.residential_status_x == "international tourist") |
                           (df.mcc != "268")].imsi.unique())
@@ -35,21 +38,13 @@ def catchment_area(polygon, user_table, project_dataset, client):
                                                                            (user_table.residential_status == "resident")], on="imsi", how="left")
     
     catchment_levels = labels_resident_location.groupby(["day", "hour"]).apply(lambda x: group_by_catchment_area(x, polygon)).reset_index()
-    if len(catchment_levels) == 0:
-        catchment_levels["catchment_area"] = pd.Categorical([],categories=["local", "regional", "national", "international"])
-        catchment_levels["day"] = pd.Timestamp(config.start_datetime_demo_prev).date()
-        catchment_levels["hour"] = 0
-        catchment_levels["count_people"] = 0
-        catchment_levels.drop(columns = "index", inplace=True)
-        
-    
-    zero_padded = catchment_levels.groupby("catchment_area").apply(lambda x: zero_pad_results(x.drop(columns=["catchment_area"]), 
-                                                                                              "count_people", 
-                                                                    True)).reset_index()
+    catchment_levels = catchment_levels.reindex(columns = ["day", "hour", "catchment_area", "count_people"])
+    
+    zero_padded = densify(catchment_levels, {"catchment_area": CATCHMENT_AREAS, **demo_time_domain(True)})
     
     zero_padded.count_people = zero_padded.count_people.astype(int)
     
-    zero_padded["datetime"] = zero_padded.apply(lambda x: f"{str(x['day'])} {x['hour']:02d}:00:00", axis=1)
+    zero_padded["datetime"] = [f"{str(day)} {hour:02d}:00:00" for day, hour in zip(zero_padded.day, zero_padded.hour)]
     zero_padded["polygon_id"] = polygon["polygon_id"]
     
     return zero_padded.rename(columns = {"catchment_area": "c_area"}).loc[:, ["polygon_id", "datetime", "c_area", "count_people"]]
@@ -70,15 +65,9 @@ def catchment_area_daily(polygon, user_table, project_dataset, client):
                                                                            (user_table.residential_status == "resident")], on="imsi", how="left")
     
     catchment_levels = labels_resident_location.groupby(["date"]).apply(lambda x: group_by_catchment_area(x, polygon)).reset_index()
-    if len(catchment_levels) == 0:
-        catchment_levels["catchment_area"] = pd.Categorical([],categories=["local", "regional", "national", "international"])
-        catchment_levels["date"] = pd.Timestamp(config.start_datetime_demo_prev).date()
-        catchment_levels["count_people"] = 0
-        catchment_levels.drop(columns = "index", inplace=True, errors = "ignore")
-        
-    
-    zero_padded = catchment_levels.groupby("catchment_area").apply(lambda x: zero_pad_results(x.drop(columns=["catchment_area", "level_1"], errors="ignore"), 
-                                                                                              "count_people", False)).reset_index()
+    catchment_levels = catchment_levels.reindex(columns = ["date", "catchment_area", "count_people"])
+    
+    zero_padded = densify(catchment_levels, {"catchment_area": CATCHMENT_AREAS, **demo_time_domain(False)})
     
     zero_padded.count_people = zero_padded.count_people.astype(int)
     zero_padded["polygon_id"] = polygon["polygon_id"]
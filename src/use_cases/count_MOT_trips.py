@@ -1,6 +1,6 @@
 import pandas as pd
 import shapely
-from utils.utils import zero_pad_results
+from utils.utils import densify, rollup, dimension_values, demo_time_domain, RESIDENTIAL_STATUSES, MODES_OF_TRANSPORT
 from building_blocks.BB1 import BB1_by_datetime, BB1_by_day
 import utils.config as config
 
@@ -18,36 +18,23 @@ def count_MOT(polygon, user_table, MOT_table, project_dataset, client, hourly =
     pp_locations = data_in_polygon.merge(user_table, on=config.USER_ID, how="left")
     pt_locations = pp_locations.merge(MOT_table, on="trajectory_id", how="left")
     
-    pt_locations = pt_locations.groupby(aggregation_column + ["residential_status", "mode_of_transport"]).agg(count_trips=("trajectory_id", "nunique")).reset_index()
+    pt_locations = rollup(pt_locations, [aggregation_column + ["residential_status", "mode_of_transport"], 
+                                         aggregation_column + ["mode_of_transport"], 
+                                         aggregation_column + ["residential_status"], 
+                                         aggregation_column], 
+                          {"count_trips": ("trajectory_id", "nunique")})
     
-            
     if len(pt_locations) == 0:
-        pt_locations = pd.DataFrame(columns = aggregation_column + ["residential_status", "mode_of_transport", "count_trips"])
-        pt_locations["residential_status"] = pd.Categorical(["resident"], categories=["resident", "national tourist", 'international tourist', 
-                                                                      "regular visitor", "casual visitor", "commuter"], ordered=True)
-        pt_locations["mode_of_transport"] = pd.Categorical(["car"], categories = ["train",'car', 'walk', 'bus', 'bike', "stationary", "undefined"])
-        pt_locations["count_trips"] = 0
+        statuses, modes = RESIDENTIAL_STATUSES + ["total"], MODES_OF_TRANSPORT + ["total"]
+    else:
+        statuses, modes = dimension_values(pt_locations.residential_status), dimension_values(pt_locations.mode_of_transport)
         
-    zero_padded = pt_locations.groupby(["residential_status", "mode_of_transport"]).apply(lambda x: zero_pad_results(x.drop(columns=["residential_status", "mode_of_transport"]), 
-                                                                                              "count_trips", 
-                                                                                              hourly)).reset_index()
-    
-    zero_padded_total_res = zero_padded.groupby(aggregation_column + ["mode_of_transport"]).agg(count_trips=("count_trips", "sum")).reset_index()
-    zero_padded_total_res["residential_status"] = "total"
-    
-    zero_padded_total_mot = zero_padded.groupby(aggregation_column + ["residential_status"]).agg(count_trips=("count_trips", "sum")).reset_index()
-    zero_padded_total_mot["mode_of_transport"] = "total"
-    
-    zero_padded_total = zero_padded.groupby(aggregation_column).agg(count_trips=("count_trips", "sum")).reset_index()
-    zero_padded_total["mode_of_transport"] = "total"
-    zero_padded_total["residential_status"] = "total"
-    
-    zero_padded = pd.concat([zero_padded, zero_padded_total, zero_padded_total_res, zero_padded_total_mot])
+    zero_padded = densify(pt_locations, {"residential_status": statuses, "mode_of_transport": modes, **demo_time_domain(hourly)})
     zero_padded["polygon_id"] = polygon["polygon_id"]
     cols_order = ["polygon_id", "date", "residency_status", "mode_of_transport", "count_trips"]
     
     if hourly:
-        zero_padded["datetime"] = zero_padded.apply(lambda x: f"{str(x['day'])} {x['hour']:02d}:00:00", axis=1)
+        zero_padded["datetime"] = [f"{str(day)} {hour:02d}:00:00" for day, hour in zip(zero_padded.day, zero_padded.hour)]
         zero_padded.drop(columns = ["day", "hour"], inplace=True)
         cols_order = ["polygon_id", "datetime", "residency_status", "mode_of_transport", "count_trips"]
         zero_padded = zero_padded.loc[zero_padded.datetime < "2023-05-01 11:00:00", :]
@@ -1,8 +1,9 @@
 import pandas as pd
 import shapely
-from utils.utils import zero_pad_results
-from building_blocks.BB1 import BB1_by_datetime, BB1_by_day
+from utils.utils import densify, rollup, dimension_values, demo_time_domain, align_user_tables, RESIDENTIAL_STATUSES
+from building_blocks.BB1 import BB1_by_datetime, BB1_by_day, BB1_by_datetime_multi
 import utils.config as config
+from utils.hll import sketch
 
 
 #########################################
@@ -15,6 +16,11 @@ import utils.config as config
 ##########################################
 
 
+def _add_datetime(zero_padded):
+    zero_padded["datetime"] = [f"{str(day)} {hour:02d}:00:00" for day, hour in zip(zero_padded.day, zero_padded.hour)]
+    return zero_padded.drop(columns = ["day", "hour"])
+
+
 def count_people_in_polygon(polygon, user_table, project_dataset, client, hourly = True):
     
     if hourly:
@@ -26,21 +32,15 @@ def count_people_in_polygon(polygon, user_table, project_dataset, client, hourly
         
     pp_locations = people_in_polygon.merge(user_table, on=config.USER_ID, how="left")
     
-    pp_locations = pp_locations.groupby(aggregation_column + ["residential_status"]).agg(number_users=(config.USER_ID, "nunique")).reset_index()
+    pp_locations = rollup(pp_locations, [aggregation_column + ["residential_status"], aggregation_column], 
+                          {"number_users": (config.USER_ID, "nunique")})
     
-    zero_padded = pp_locations.groupby("residential_status").apply(lambda x: zero_pad_results(x.drop(columns=["residential_status"]), 
-                                                                                              "number_users", 
-                                                                                              hourly)).reset_index().drop(columns=["level_1"])
-    zero_padded_total = zero_padded.groupby(aggregation_column).agg(number_users=("number_users", "sum")).reset_index()
-    zero_padded_total["residential_status"] = "total"
-    
-    zero_padded = pd.concat([zero_padded, zero_padded_total])
+    zero_padded = densify(pp_locations, {"residential_status": dimension_values(pp_locations.residential_status), **demo_time_domain(hourly)})
     zero_padded["polygon_id"] = polygon["polygon_id"]
     cols_order = ["polygon_id", "date", "residency_status", "count_people"]
     
     if hourly:
-        zero_padded["datetime"] = zero_padded.apply(lambda x: f"{str(x['day'])} {x['hour']:02d}:00:00", axis=1)
-        zero_padded.drop(columns = ["day", "hour"], inplace=True)
+        zero_padded = _add_datetime(zero_padded)
         cols_order = ["polygon_id", "datetime", "residency_status", "count_people"]
     
     zero_padded.number_users = zero_padded.number_users.astype(int)
@@ -59,7 +59,7 @@ def count_people_in_polygon_total(polygon, project_dataset, client, hourly = Tru
         
     pp_locations = people_in_polygon.groupby(aggregation_column).agg(number_users=(config.USER_ID, "nunique")).reset_index()
     
-    zero_padded = zero_pad_results(pp_locations, "number_users", hourly)
+    zero_padded = densify(pp_locations, demo_time_domain(hourly))
     
     zero_padded["residential_status"] = "total"
     
@@ -67,9 +67,50 @@ def count_people_in_polygon_total(polygon, project_dataset, client, hourly = Tru
     
     cols_order = ["polygon_id", "date", "residency_status", "count_people"]
     if hourly:
-        zero_padded["datetime"] = zero_padded.apply(lambda x: f"{str(x['day'])} {x['hour']:02d}:00:00", axis=1)
-        zero_padded.drop(columns = ["day", "hour"], inplace=True)
+        zero_padded = _add_datetime(zero_padded)
         cols_order = ["polygon_id", "datetime", "residency_status", "count_people"]
     
     zero_padded.number_users = zero_padded.number_users.astype(int)
-    return zero_padded.rename(columns={"residential_status": "residency_status", "number_users": "count_people"}).loc[:, cols_order]
\ No newline at end of file
+    return zero_padded.rename(columns={"residential_status": "residency_status", "number_users": "count_people"}).loc[:, cols_order]
+
+
+def _count_by_status(pp_locations, hourly, polygons):
+    # number of users by polygon, time bin and residential status, dense over the polygons, the statuses and the time bins
+    aggregation_column = ["day", "hour"] if hourly else ["date"]
+    counts = rollup(pp_locations, [["polygon_position"] + aggregation_column + ["residential_status"], ["polygon_position"] + aggregation_column], 
+                    {"number_users": (config.USER_ID, "nunique")})
+    
+    counts = densify(counts, {"polygon_position": list(range(len(polygons))), "residential_status": RESIDENTIAL_STATUSES + ["total"], **demo_time_domain(hourly)})
+    counts["polygon_id"] = polygons.polygon_id.values[counts.polygon_position.values]
+    counts.number_users = counts.number_users.astype(int)
+    return counts.rename(columns={"residential_status": "residency_status", "number_users": "count_people"})
+
+
+def count_people_in_polygons(polygons, user_table, project_dataset, client, sketches = False):
+    '''
+    count_people_in_polygon of all the rows of polygons, hourly and daily, from one scan of the trajectory details: the
+    points are joined with all the polygons at once and counted in one aggregation per granularity.
+    
+    Returns the hourly and the daily counts, and with sketches the HyperLogLog sketches of the users by polygon, hour and
+    residency status (see utils.hll), from which days, weeks or larger areas are counted without the detail data.
+    '''
+    polygons = polygons.reset_index(drop=True)
+    people_in_polygons = BB1_by_datetime_multi([shapely.wkt.loads(geography) for geography in polygons.geography], 
+                                               project_dataset, client)
+    people_in_polygons["day"] = pd.to_datetime(people_in_polygons.day).dt.date
+    
+    # users without a residential status in the area of the polygon are not counted, as in count_people_in_polygon
+    pp_locations = people_in_polygons.merge(align_user_tables(polygons, user_table), on=["polygon_position", config.USER_ID])
+    
+    hourly = _add_datetime(_count_by_status(pp_locations, True, polygons))
+    daily = _count_by_status(pp_locations.rename(columns={"day": "date"}), False, polygons)
+    counts = (hourly.loc[:, ["polygon_id", "datetime", "residency_status", "count_people"]].reset_index(drop=True), 
+              daily.loc[:, ["polygon_id", "date", "residency_status", "count_people"]].reset_index(drop=True))
+    
+    if sketches:
+        hourly_sketches = _add_datetime(sketch(pp_locations, ["polygon_position", "day", "hour", "residential_status"]))
+        hourly_sketches["polygon_id"] = polygons.polygon_id.values[hourly_sketches.polygon_position.values]
+        hourly_sketches = hourly_sketches.rename(columns={"residential_status": "residency_status"})
+        counts += (hourly_sketches.loc[:, ["polygon_id", "datetime", "residency_status", "sketch"]],)
+    
+    return counts
@@ -1,65 +1,15 @@
 import utils.config as config
 import pandas as pd
+from utils.visits import get_polygon_visits, filter_visits
 
-def get_different_visits_query(polygon, project_dataset):
-    
-    query = f"""WITH visits AS (
-                    SELECT 
-                        {config.USER_ID},
-                        datetime,
-                        ST_INTERSECTS(ST_GEOGFROMTEXT('{polygon}'), geography) AS inside_polygon
-                    FROM {project_dataset}.{config.table_trajectory_details}
-                    WHERE datetime <= '{config.end_datetime_demo}'
-                ),
-                visits_with_change AS (
-                    SELECT
-                        {config.USER_ID},
-                        datetime,
-                        inside_polygon,
-                        LAG(inside_polygon) OVER (PARTITION BY {config.USER_ID} ORDER BY datetime ASC) AS prev_inside_polygon
-                    FROM visits
-                ),
-                visit_start AS (
-                    SELECT
-                        {config.USER_ID},
-                        datetime AS time_in,
-                        inside_polygon,
-                        ROW_NUMBER() OVER (PARTITION BY {config.USER_ID} ORDER BY datetime ASC) AS visit_num
-                    FROM visits_with_change
-                    WHERE inside_polygon AND (prev_inside_polygon IS NULL OR NOT prev_inside_polygon)
-                ),
-                visit_end AS (
-                    SELECT
-                        {config.USER_ID},
-                        datetime AS time_out,
-                        inside_polygon,
-                        ROW_NUMBER() OVER (PARTITION BY {config.USER_ID} ORDER BY datetime ASC) AS visit_num
-                    FROM visits_with_change
-                    WHERE NOT inside_polygon AND prev_inside_polygon
-                ),
-                time_in_polygon AS (
-                    SELECT
-                        v.{config.USER_ID},
-                        v.time_in,
-                        ve.time_out
-                    FROM visit_start AS v JOIN visit_end AS ve 
-                         ON v.{config.USER_ID} = ve.{config.USER_ID} AND v.visit_num = ve.visit_num
-                    ORDER BY v.{config.USER_ID}, v.time_in
-                ),
-                time_outside_polygon AS (
-                    SELECT
-                        *,
-                        TIMESTAMP_DIFF(time_out, time_in, SECOND) as time_inside_polygon,
-                        LAG(time_out) OVER (PARTITION BY {config.USER_ID} ORDER BY time_in ASC) as prev_time_out
-                    FROM time_in_polygon
-                )
-                SELECT {config.USER_ID}, time_in, time_out
-                FROM time_outside_polygon
-                WHERE time_inside_polygon >= {config.THRESHOLD_VISIT_INSIDE} AND
-                      (prev_time_out IS NULL OR TIMESTAMP_DIFF(time_in, prev_time_out, SECOND) >= {config.THRESHOLD_VISIT_OUTSIDE})
-                """
-    
-    return query
+def get_different_visits(polygons, project_dataset, bq_client):
+    '''
+    Visits of the users to each of the polygons (shapely) until config.end_datetime_demo, without the short visits and
+    the visits that start shortly after the previous one, with the position of the polygon in polygons.
+    '''
+    visits = get_polygon_visits(polygons, f"datetime <= '{config.end_datetime_demo}'", project_dataset, bq_client)
+    
+    return filter_visits(visits)
     
     
 def get_always_inside_query(polygon, day_start, day_end, project_dataset):
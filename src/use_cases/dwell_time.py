@@ -1,9 +1,19 @@
 import pandas as pd
+import utils.config as config
+from utils.utils import densify, RESIDENTIAL_STATUSES
+
+
+RESIDENCY_LABELS = ["total"] + RESIDENTIAL_STATUSES
+
+
+def dwell_labels(split_intervals):
+    return [f"<= {int(i/60)}" for i in split_intervals[1:]]
+
 
 def dwell_split(df, split_intervals):
     stay_time = df.stay_time.values
     
-    split_labels = [f"<= {int(i/60)}" for i in split_intervals[1:]]
+    split_labels = dwell_labels(split_intervals)
     if len(stay_time) == 0:
         time_counts = [0 for i in range(len(split_labels))]
     else:
@@ -14,29 +24,48 @@ def dwell_split(df, split_intervals):
                                    "count_people": time_counts})
 
 
+def dwell_counts(stay_times, group_columns, split_intervals):
+    '''
+    dwell_split of all the groups of stay_times by group_columns at once: number of rows by group and dwell time
+    interval, for the intervals with rows.
+    '''
+    intervals = pd.cut(stay_times.stay_time.astype(float), split_intervals, labels=dwell_labels(split_intervals))
+    return stay_times.assign(dwell_time_interval=intervals).groupby(group_columns + ["dwell_time_interval"], observed=True).size().reset_index(name="count_people")
+
+
 def dwell_split_empty(day, polygon_id, split_intervals, hourly):
     
-    split_labels = [f"<= {int(i/60)}" for i in split_intervals[1:]]
-    residency_labels = ["total", "resident", "national tourist", 'international tourist', 
-                       "regular visitor", "casual visitor", "commuter"]
     if hourly:
-    
-        datetimes = [pd.to_datetime(f"{day} {hour:02d}:00:00", utc=True) for hour in range(24)] 
-        slabs = [sl for sl in split_labels for _ in datetimes for _ in residency_labels]
-        ds = [d for _ in split_labels for d in datetimes for _ in residency_labels]
-        rs = [r for _ in split_labels for _ in datetimes for r in residency_labels]
-        ps = [polygon_id for _ in rs]
-        c = [0 for _ in rs]
-        out_d = dict(polygon_id = ps, datetime = ds, residency_status = rs, dwell_time_interval = slabs, count_people = c)
-        
+        times = ("datetime", [pd.to_datetime(f"{day} {hour:02d}:00:00", utc=True) for hour in range(24)])
     else:
-        
-        date = [f"{day.date()}"]
-        slabs = [sl for sl in split_labels for _ in date for _ in residency_labels]
-        ds = [d for _ in split_labels for d in date for _ in residency_labels]
-        rs = [r for _ in split_labels for _ in date for r in residency_labels]
-        ps = [polygon_id for _ in rs]
-        c = [0 for _ in rs]
-        out_d = dict(polygon_id = ps, date = ds, residency_status = rs, dwell_time_interval = slabs, count_people = c)
-        
-    return pd.DataFrame.from_dict(out_d)
\ No newline at end of file
+        times = ("date", [f"{day.date()}"])
+    
+    empty = pd.MultiIndex.from_product([dwell_labels(split_intervals), times[1], RESIDENCY_LABELS], 
+                                       names=["dwell_time_interval", times[0], "residency_status"]).to_frame(index=False)
+    empty["polygon_id"] = polygon_id
+    empty["count_people"] = 0
+    
+    return empty.loc[:, ["polygon_id", times[0], "residency_status", "dwell_time_interval", "count_people"]]
+
+
+def dwell_time_by_polygon(stay_times, user_statuses, time_column, time_values, split_intervals, polygon_positions, polygon_ids):
+    '''
+    Number of people by polygon, time bin, residency status (and total) and dwell time interval, dense over the
+    polygon_positions, the time_values of time_column, the residency labels and the intervals, from the stay times by
+    polygon, user and time bin and the residential status of the users in every polygon (users without one are
+    commuters).
+    '''
+    time_with_labels = stay_times.merge(user_statuses, on=["polygon_position", config.USER_ID], how="left")
+    time_with_labels.residential_status = time_with_labels.residential_status.fillna("commuter")
+    
+    dwell_time = dwell_counts(time_with_labels, ["polygon_position", time_column, "residential_status"], split_intervals)
+    dwell_time_total = dwell_counts(stay_times, ["polygon_position", time_column], split_intervals)
+    dwell_time_total["residential_status"] = "total"
+    dwell_time = pd.concat([dwell_time, dwell_time_total]).rename(columns={"residential_status": "residency_status"})
+    
+    dwell_time = densify(dwell_time.astype({"residency_status": str, "dwell_time_interval": str}), 
+                         {"polygon_position": list(polygon_positions), time_column: list(time_values), 
+                          "residency_status": RESIDENCY_LABELS, "dwell_time_interval": dwell_labels(split_intervals)})
+    dwell_time["polygon_id"] = polygon_ids[dwell_time.polygon_position.values]
+    
+    return dwell_time.loc[:, ["polygon_id", time_column, "residency_status", "dwell_time_interval", "count_people"]]
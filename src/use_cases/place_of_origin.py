@@ -1,6 +1,7 @@
 import utils.config as config
-from utils.utils import check_coordinates_order, get_reverse_polygon
+from utils.utils import check_coordinates_order, get_reverse_polygon, rollup
 import shapely
+from utils.cell_index import get_cell_index, join_cell_arrays
 import pandas as pd
 
 
@@ -9,31 +10,29 @@ def place_of_origin_query_by_datetime(polygon, project_dataset):
     if check_coordinates_order(polygon.__geo_interface__["coordinates"][0]):
         polygon = get_reverse_polygon(polygon)
         
-    sql = f"""WITH frc_mapping AS (
-                SELECT DISTINCT s2code, frnome
-                FROM {project_dataset}.{config.table_polygons}
-            ),
-            user_home AS (
-                SELECT DISTINCT night_loc.{config.USER_ID}, frc_mapping.frnome as home_frc
-                FROM {project_dataset}.{config.table_user_night_location} as night_loc INNER JOIN frc_mapping
-                     ON CAST(night_loc.s2code AS STRING) = frc_mapping.s2code
-                WHERE night_loc.night_stay_place = 'yes'
+    sql = f"""WITH user_home AS (
+                SELECT {config.USER_ID}, ARRAY_AGG(DISTINCT CAST(s2code AS STRING)) as home_s2
+                FROM {project_dataset}.{config.table_user_night_location}
+                WHERE night_stay_place = 'yes'
+                GROUP BY {config.USER_ID}
             ),
             user_mcc AS (
                 SELECT DISTINCT users.{config.USER_ID}, table_mcc.country as country
                 FROM {project_dataset}.{config.table_users} as users INNER JOIN {project_dataset}.{config.table_mcc} as table_mcc
                         ON CAST(users.mcc AS STRING) = CAST(table_mcc.mcc AS STRING)
+            ),
+            visits AS (
+                SELECT DISTINCT DATE(datetime) as day, 
+                                EXTRACT(HOUR FROM datetime) as hour, 
+                                traj.{config.USER_ID},
+                                user_mcc.country
+                FROM {project_dataset}.{config.table_trajectory_details} as traj
+                     LEFT JOIN user_mcc ON traj.{config.USER_ID} = user_mcc.{config.USER_ID}
+                WHERE ST_INTERSECTS(ST_GEOGFROMTEXT('{polygon}'), traj.geography) AND 
+                      datetime <= '{config.end_datetime_demo_prev}'
             )
-            SELECT DISTINCT DATE(datetime) as day, 
-                            EXTRACT(HOUR FROM datetime) as hour, 
-                            traj.{config.USER_ID},
-                            user_mcc.country,
-                            user_home.home_frc
-            FROM {project_dataset}.{config.table_trajectory_details} as traj
-                 LEFT JOIN user_home ON traj.{config.USER_ID} = user_home.{config.USER_ID}
-                 LEFT JOIN user_mcc ON traj.{config.USER_ID} = user_mcc.{config.USER_ID}
-            WHERE ST_INTERSECTS(ST_GEOGFROMTEXT('{polygon}'), traj.geography) AND 
-                  datetime <= '{config.end_datetime_demo_prev}'
+            SELECT visits.*, user_home.home_s2
+            FROM visits LEFT JOIN user_home ON visits.{config.USER_ID} = user_home.{config.USER_ID}
           """
     
     return sql
@@ -44,30 +43,28 @@ def place_of_origin_query_by_date(polygon, project_dataset):
     if check_coordinates_order(polygon.__geo_interface__["coordinates"][0]):
         polygon = get_reverse_polygon(polygon)
         
-    sql = f"""WITH frc_mapping AS (
-                SELECT DISTINCT s2code, frnome
-                FROM {project_dataset}.{config.table_polygons}
-            ),
-            user_home AS (
-                SELECT DISTINCT night_loc.{config.USER_ID}, frc_mapping.frnome as home_frc
-                FROM {project_dataset}.{config.table_user_night_location} as night_loc INNER JOIN frc_mapping
-                     ON CAST(night_loc.s2code AS STRING) = frc_mapping.s2code
-                WHERE night_loc.night_stay_place = 'yes'
+    sql = f"""WITH user_home AS (
+                SELECT {config.USER_ID}, ARRAY_AGG(DISTINCT CAST(s2code AS STRING)) as home_s2
+                FROM {project_dataset}.{config.table_user_night_location}
+                WHERE night_stay_place = 'yes'
+                GROUP BY {config.USER_ID}
             ),
             user_mcc AS (
                 SELECT DISTINCT users.{config.USER_ID}, table_mcc.country as country
                 FROM {project_dataset}.{config.table_users} as users INNER JOIN {project_dataset}.{config.table_mcc} as table_mcc
                         ON CAST(users.mcc AS STRING) = CAST(table_mcc.mcc AS STRING)
+            ),
+            visits AS (
+                SELECT DISTINCT DATE(datetime) as date, 
+                                traj.{config.USER_ID},
+                                user_mcc.country
+                FROM {project_dataset}.{config.table_trajectory_details} as traj
+                     LEFT JOIN user_mcc ON traj.{config.USER_ID} = user_mcc.{config.USER_ID}
+                WHERE ST_INTERSECTS(ST_GEOGFROMTEXT('{polygon}'), traj.geography) AND 
+                      datetime <= '{config.end_datetime_demo_prev}' 
             )
-            SELECT DISTINCT DATE(datetime) as date, 
-                            traj.{config.USER_ID},
-                            user_mcc.country,
-                            user_home.home_frc
-            FROM {project_dataset}.{config.table_trajectory_details} as traj
-                 LEFT JOIN user_home ON traj.{config.USER_ID} = user_home.{config.USER_ID}
-                 LEFT JOIN user_mcc ON traj.{config.USER_ID} = user_mcc.{config.USER_ID}
-            WHERE ST_INTERSECTS(ST_GEOGFROMTEXT('{polygon}'), traj.geography) AND 
-                  datetime <= '{config.end_datetime_demo_prev}' 
+            SELECT visits.*, user_home.home_s2
+            FROM visits LEFT JOIN user_home ON visits.{config.USER_ID} = user_home.{config.USER_ID}
           """
     
     return sql
@@ -86,27 +83,22 @@ def get_place_of_origin(polygon, user_table, project_dataset, client, hourly = T
     if len(people_in_polygon) == 0:
         return None
     
+    # the homes are mapped to their freguesia with the cell index
+    people_in_polygon = join_cell_arrays(people_in_polygon, "home_s2", "frnome", "home_frc", get_cell_index(client, project_dataset))
+    
     
     pp_locations = people_in_polygon.merge(user_table, on=config.USER_ID, how="left")
     pp_locations.residential_status.fillna("commuter", inplace=True)
     
     pp_locations_foreigners = pp_locations.loc[(pp_locations.residential_status == "international tourist") | (pp_locations.home_frc.isna()), :]
     
-    pp_locations_foreigners = pp_locations_foreigners.groupby(aggregation_column + ["residential_status", "country"]).agg(number_users=(config.USER_ID, "nunique")).reset_index()
-    
-    pp_locations_foreigners_total = pp_locations_foreigners.groupby(aggregation_column + ["country"]).agg(number_users = ("number_users", "sum")).reset_index()
-    pp_locations_foreigners_total["residential_status"] = "total"
-    
-    pp_locations_foreigners = pd.concat([pp_locations_foreigners, pp_locations_foreigners_total])
+    pp_locations_foreigners = rollup(pp_locations_foreigners, [aggregation_column + ["residential_status", "country"], aggregation_column + ["country"]], 
+                                     {"number_users": (config.USER_ID, "nunique")})
     
     pp_locations_nationals = pp_locations.loc[(pp_locations.residential_status != "international tourist") & (~pp_locations.home_frc.isna()), :]
     
-    pp_locations_nationals = pp_locations_nationals.groupby(aggregation_column + ["residential_status", "home_frc"]).agg(number_users=(config.USER_ID, "nunique")).reset_index()
-    
-    pp_locations_nationals_total = pp_locations_nationals.groupby(aggregation_column + ["home_frc"]).agg(number_users = ("number_users", "sum")).reset_index()
-    pp_locations_nationals_total["residential_status"] = "total"
-    
-    pp_locations_nationals = pd.concat([pp_locations_nationals, pp_locations_nationals_total])
+    pp_locations_nationals = rollup(pp_locations_nationals, [aggregation_column + ["residential_status", "home_frc"], aggregation_column + ["home_frc"]], 
+                                    {"number_users": (config.USER_ID, "nunique")})
     
     
     place_of_origin = pd.concat([pp_locations_foreigners.rename(columns = {"country": "place_of_origin"}), 
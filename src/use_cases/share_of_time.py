@@ -1,6 +1,6 @@
 import pandas as pd
 import utils.config as config
-from utils.utils import zero_pad_results_single_day
+from utils.utils import densify, rollup
 
 def share_of_time(supermarkets, polygon, user_table, day):
     
@@ -12,16 +12,15 @@ def share_of_time(supermarkets, polygon, user_table, day):
     time_with_labels = supermarkets.merge(user_table, on=config.USER_ID, how="left")
     time_with_labels.residential_status.fillna("commuter", inplace=True)
     
-    share_of_time = time_with_labels.groupby(["datetime", "grupo", "residential_status"]).agg(total_time = ("stay_time", "sum")).reset_index()
-    share_of_time_total = time_with_labels.groupby(["datetime", "grupo"]).agg(total_time = ("stay_time", "sum")).reset_index()
-    share_of_time_total["residential_status"] = "total"
-    share_of_time = pd.concat([share_of_time, share_of_time_total])
-    zero_padded = share_of_time.groupby(["grupo", 
-                                         "residential_status"]).apply(lambda x: zero_pad_results_single_day(x.drop(columns=["grupo", 
-                                                                                                                            "residential_status"]), 
-                                                                                                            "total_time")).reset_index().drop(columns=["level_2"])
+    share_of_time = rollup(time_with_labels, [["datetime", "grupo", "residential_status"], ["datetime", "grupo"]], 
+                           {"total_time": ("stay_time", "sum")})
     
-    zero_padded['share_of_time_percentage'] = zero_padded.groupby(['datetime', 'residential_status'])['total_time'].transform(lambda x: x / x.sum())
+    hours = [pd.to_datetime(f"{day} {hour:02d}:00:00", utc=True) for hour in range(24)]
+    zero_padded = densify(share_of_time.loc[:, ["grupo", "residential_status", "datetime", "total_time"]], 
+                          {("grupo", "residential_status"): list(share_of_time.groupby(["grupo", "residential_status"]).size().index), 
+                           "datetime": hours})
+    
+    zero_padded['share_of_time_percentage'] = zero_padded['total_time'] / zero_padded.groupby(['datetime', 'residential_status'])['total_time'].transform('sum')
     zero_padded["polygon_id"] = polygon["polygon_id"]
     
     zero_padded.rename(columns={"residential_status": "residency_status", "total_time": "seconds_in_store"}, inplace = True)
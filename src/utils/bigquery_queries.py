@@ -143,3 +143,17 @@ def unfinished_trajectories_query(day, time_start, time_end, raw_data_table, pro
                         raw_data_table.imsi"""
     
     return query
+
+
+def new_pings_query(day, time_start, time_end, raw_data_table):
+    
+    query = f"""SELECT DISTINCT
+                    {', '.join([f"raw_data_table.{col}" for col in config.data_columns])}
+                FROM 
+                    {raw_data_table} AS raw_data_table
+                WHERE 
+                    day_part = DATE('{day}') AND 
+                    location_data_quality_score_name IN UNNEST(['medium','high']) AND
+                    rec_timestamp >= '{time_start}' AND rec_timestamp < '{time_end}'"""
+    
+    return query
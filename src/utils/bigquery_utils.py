@@ -1,5 +1,18 @@
+import re
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
 import utils.config as config
+import google.auth
 from google.cloud import bigquery
+from google.api_core.exceptions import NotFound
+
+
+def default_client():
+    '''
+    BigQuery client with the default credentials of the environment. Used as client factory by the pipeline workers.
+    '''
+    credentials, _ = google.auth.default()
+    return bigquery.Client(credentials=credentials)
 
 
 def upload_table_bq(df, table_name, schema = {}, client = None):
@@ -10,3 +23,117 @@ def upload_table_bq(df, table_name, schema = {}, client = None):
     job = client.load_table_from_dataframe(df, table_name, job_config=job_config)  # Make an API request.
     job.result()  # Wait for the job to complete.
 
+
+def table_exists(table_name, client):
+    '''
+    Whether the table exists. LocalClient raises ValueError for a missing table, as in its delete_table.
+    '''
+    try:
+        client.get_table(table_name)
+    except (NotFound, ValueError):
+        return False
+    return True
+
+
+
+class _DoneJob:
+
+    def result(self):
+        return self
+
+
+class UploadManager:
+    '''
+    Client proxy that batches the uploads.
+
+    load_table_from_dataframe (and so upload_table_bq) only appends the frame to the pending frames of its table. When the
+    pending frames of a table reach batch_bytes they are concatenated and loaded with one load_table_from_dataframe of the
+    client in a background thread, with at most max_jobs load jobs in flight. Before a query runs, the
+    pending and in flight uploads of the tables it mentions are finished, so reads always see the uploaded rows.
+    flush() must be called at the end of the run.
+    '''
+
+    def __init__(self, client, batch_bytes = config.upload_batch_bytes, max_jobs = config.upload_max_jobs):
+        self._client = client
+        self.batch_bytes = batch_bytes
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(max_workers = max_jobs)
+        self.pending = {} # table -> frames waiting to be loaded, their size and the schema fields of their uploads
+        self.in_flight = {} # table -> futures of its load jobs
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def query(self, query, *args, **kwargs):
+        for table_name in list(self.pending) + list(self.in_flight):
+            if re.search(rf"\b{re.escape(str(table_name).split('.')[-1])}\b", query):
+                self.flush_table(table_name)
+        return self._client.query(query, *args, **kwargs)
+
+    def delete_table(self, table, *args, **kwargs):
+        self.flush_table(table)
+        return self._client.delete_table(table, *args, **kwargs)
+
+    def load_table_from_dataframe(self, dataframe, destination, job_config = None):
+
+        destination = str(destination)
+        write_disposition = getattr(job_config, "write_disposition", None)
+        if write_disposition is not None and not str(write_disposition).endswith("WRITE_APPEND"):
+            # truncating or conditional loads are not batched with the appends
+            self.flush_table(destination)
+            return self._client.load_table_from_dataframe(dataframe, destination, job_config = job_config)
+
+        batch = self.pending.setdefault(destination, dict(frames = [], bytes = 0, schema = {}))
+        batch["frames"].append(dataframe)
+        batch["bytes"] += int(dataframe.memory_usage(deep=True).sum())
+        for field in getattr(job_config, "schema", None) or []:
+            batch["schema"].setdefault(field.name, field)
+        if batch["bytes"] >= self.batch_bytes:
+            self._submit(destination)
+        return _DoneJob()
+
+    def _submit(self, destination):
+
+        pending = self.pending.pop(destination)
+        schema = list(pending["schema"].values())
+        batch = pd.concat(pending["frames"], ignore_index = True)
+        for column in batch.columns[batch.dtypes == object]:
+            # shapely geographies are loaded as WKT
+            if batch[column].map(lambda value: hasattr(value, "wkt")).any():
+                batch[column] = batch[column].map(lambda value: value.wkt if hasattr(value, "wkt") else value)
+
+        # the schema only overrides the types of its fields, as in upload_table_bq: the client takes the others from
+        # the table or the dtypes of the frame
+        job_config = bigquery.LoadJobConfig(schema = schema, write_disposition = bigquery.WriteDisposition.WRITE_APPEND)
+
+        self._wait_for_slot()
+        print(f'Loading {len(batch)} rows and {len(batch.columns)} columns to table {destination}')
+        future = self.executor.submit(self._load, batch, destination, job_config)
+        self.in_flight.setdefault(destination, []).append(future)
+
+    def _load(self, batch, destination, job_config):
+        return self._client.load_table_from_dataframe(batch, destination, job_config = job_config).result()
+
+    def _wait_for_slot(self):
+        running = [future for futures in self.in_flight.values() for future in futures if not future.done()]
+        if len(running) >= self.max_jobs:
+            wait(running, return_when = FIRST_COMPLETED)
+
+    def flush_table(self, destination):
+        '''
+        Load the pending frames of the table and wait for all its load jobs.
+        '''
+        destination = str(destination)
+        if destination in self.pending:
+            self._submit(destination)
+        for future in self.in_flight.pop(destination, []):
+            future.result()
+
+    def flush(self):
+        '''
+        Load the pending frames of every table and wait for all the load jobs.
+        '''
+        for destination in list(self.pending):
+            self._submit(destination)
+        for destination in list(self.in_flight):
+            self.flush_table(destination)
@@ -0,0 +1,124 @@
+import os
+import numpy as np
+import pandas as pd
+import utils.config as config
+from utils.s2_arrays import to_unsigned
+
+
+'''
+In-memory index from S2 cells (config.s2_level) to the administrative codes of the polygons table, replacing the
+
+    SELECT DISTINCT s2code, sccode FROM polygons WHERE polygon_description = 'Celula'
+
+mapping joined in the queries. For every code column the distinct (cell, code) pairs are kept as a sorted uint64 array
+of cell ids and a parallel int32 array of codes into the array of labels, so a batch of cells is mapped with one
+searchsorted. The arrays are saved as .npy files in config.cell_index_dir and memory-mapped, the index is built from
+the polygons table the first time and loaded once per process; delete the directory when the polygons table changes.
+'''
+
+
+_indexes = {}
+
+
+def _as_cell_ids(cell_ids):
+    # cell ids as BigQuery returns them (INT64, or STRING after a CAST), nulls map to 0 which is not a valid cell
+    cell_ids = pd.Series(np.asarray(cell_ids, dtype=object))
+    valid = cell_ids.notna().values
+    unsigned = np.zeros(len(cell_ids), dtype="uint64")
+    unsigned[valid] = to_unsigned(cell_ids[valid].astype("int64").values)
+    return unsigned
+
+
+class CellIndex:
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.cells, self.codes, self.labels = {}, {}, {}
+        for level in config.cell_index_levels:
+            self.cells[level] = np.load(self._path(level, "cells"), mmap_mode="r")
+            self.codes[level] = np.load(self._path(level, "codes"), mmap_mode="r")
+            self.labels[level] = np.load(self._path(level, "labels")).astype(object)
+
+    def _path(self, level, name):
+        return os.path.join(self.directory, f"{level}.{name}.npy")
+
+    @classmethod
+    def build(cls, mapping, directory):
+        '''
+        Write the index of a dataframe with an s2code column and one column per level, and load it.
+        '''
+        os.makedirs(directory, exist_ok=True)
+        for level in config.cell_index_levels:
+            pairs = mapping.loc[:, ["s2code", level]].dropna().drop_duplicates()
+            cells = _as_cell_ids(pairs.s2code)
+            labels, codes = np.unique(pairs[level].astype(str).values, return_inverse=True)
+            order = np.argsort(cells, kind="stable")
+            np.save(os.path.join(directory, f"{level}.cells.npy"), cells[order])
+            np.save(os.path.join(directory, f"{level}.codes.npy"), codes[order].astype("int32"))
+            np.save(os.path.join(directory, f"{level}.labels.npy"), labels.astype(str))
+        return cls(directory)
+
+    def join(self, cell_ids, level):
+        '''
+        Inner join of the cells with the codes of level: positions in cell_ids and code of every (cell, code) pair, a
+        cell in several polygons of the level appears once per polygon.
+        '''
+        cell_ids = _as_cell_ids(cell_ids)
+        left = np.searchsorted(self.cells[level], cell_ids, side="left")
+        counts = np.searchsorted(self.cells[level], cell_ids, side="right") - left
+        positions = np.repeat(np.arange(len(cell_ids)), counts)
+        entries = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(left, counts)
+        return positions, self.labels[level][self.codes[level][entries]]
+
+    def lookup(self, cell_ids, level):
+        '''
+        Code of level of every cell (the first one for cells in several polygons), None for cells not in the index.
+        '''
+        cell_ids = _as_cell_ids(cell_ids)
+        left = np.minimum(np.searchsorted(self.cells[level], cell_ids), len(self.cells[level]) - 1)
+        found = self.cells[level][left] == cell_ids
+        codes = np.full(len(cell_ids), None, dtype=object)
+        codes[found] = self.labels[level][self.codes[level][left[found]]]
+        return codes
+
+    def cells_of(self, codes, level):
+        '''
+        Signed ids of the cells in the polygons of level with the given codes.
+        '''
+        wanted = np.flatnonzero(np.isin(self.labels[level], np.asarray(codes).astype(str)))
+        return np.unique(self.cells[level][np.isin(self.codes[level], wanted)].view("int64"))
+
+
+def get_cell_index(bq_client, project_dataset, directory = config.cell_index_dir):
+    '''
+    The cell index of the process, loaded from directory or built from the polygons table when it does not exist yet.
+    '''
+    if directory in _indexes:
+        return _indexes[directory]
+
+    if os.path.exists(os.path.join(directory, f"{config.cell_index_levels[-1]}.labels.npy")):
+        _indexes[directory] = CellIndex(directory)
+    else:
+        columns = ", ".join(f"CAST({level} AS STRING) AS {level}" for level in config.cell_index_levels)
+        sql = f"""SELECT DISTINCT CAST(s2code AS STRING) AS s2code, {columns}
+                  FROM {project_dataset}.{config.table_polygons}
+                  WHERE polygon_description = 'Celula'"""
+        _indexes[directory] = CellIndex.build(bq_client.query(sql).to_dataframe(), directory)
+    return _indexes[directory]
+
+
+def join_cell_arrays(df, cell_column, level, code_column, index):
+    '''
+    Replace a column of arrays of cells (as ARRAY_AGG returns them) by the distinct codes of level of the cells, one
+    row per code, as a LEFT JOIN with the distinct (row, code) pairs: rows without any code keep a null code.
+    '''
+    lengths = np.array([len(cells) if isinstance(cells, (list, np.ndarray)) else 0 for cells in df[cell_column]],
+                       dtype="int64")
+    flat = np.concatenate([np.asarray(cells, dtype=object) for cells, length in zip(df[cell_column], lengths) if length > 0]
+                          + [np.array([], dtype=object)])
+    positions, codes = index.join(flat, level)
+    pairs = pd.DataFrame({"row": np.repeat(np.arange(len(df)), lengths)[positions], code_column: codes}).drop_duplicates()
+
+    df = df.drop(columns=[cell_column]).reset_index(drop=True)
+    df["row"] = np.arange(len(df))
+    return df.merge(pairs, on="row", how="left").drop(columns=["row"])
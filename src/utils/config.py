@@ -1,6 +1,7 @@
 schema_dictionary = {"geography": "GEOGRAPHY",
                      "float": "FLOAT",
-                     "string": "STRING"}
+                     "string": "STRING", 
+                     "bytes": "BYTES"}
 
 
 data_columns = ["imsi", "rec_timestamp", "lat", "lon", "mcc", "ue_type_vendor_name", "ue_type_model_name", "day_part"]
@@ -10,6 +11,7 @@ table_trajectory_details = "trajectory_details_demo"
 table_stay_points = "stay_points_demo" 
 
 unfinished_trajectories_table = "unfinished_trajectories_table"
+unfinished_trajectories_buffer = "unfinished_trajectories_buffer.parquet" # local carry-over of the pings of unfinished trajectories
 table_OD = "OD_matrix_16_demo"
 table_OD_totals = "OD_matrix_16_totals_demo"
 table_users = "user_profile_demo"
@@ -21,6 +23,7 @@ table_user_work_location = "work_place_s2cell_demo"
 table_user_professional = "user_professional_status_profile_demo"
 table_mcc = "table_mcc"
 table_night_stay_type = "night_stay_type_demo"
+table_cell_occupancy = "cell_occupancy_hourly_demo" # distinct users per cell and hour, appended by the pipeline (BB5)
 
 
 mode_of_transport_labels = ["stationary", "undefined",
@@ -38,6 +41,7 @@ NEW_TRAJECTORY_TIME_THRESHOLD = 1800  # 1800 seconds equals to 30 minutes
 NEW_TRAJECTORY_DISTANCE_THRESHOLD = 1000 # 1 km
 
 STAY_POINT_TIME_THRESHOLD = 900 # 15 minutes
+STAY_POINT_DISTANCE_THRESHOLD = 200 # meters, radius of the points of a stay point
 
 THRESHOLD_VISIT_INSIDE = 120  # 2 minutes
 THRESHOLD_VISIT_OUTSIDE = 600  # 10 minutes: people have to be outside the area for 10 mins to consider a new visit (still a bit low, but should remove random jumps)
@@ -53,6 +57,19 @@ friendly_weekday_reverse = {"Sunday":1, "Monday":2, "Tuesday": 3, "Wednesday":4,
 modes_of_transport = {0: "train", 1: 'car', 2: 'walk', 3: 'bus', 4: 'bike'} 
 
 mode_of_transport_model = "building_blocks/self_updating_MLP.pkl"
+benchmark_history = "benchmark_history.json" # timings of every run of benchmarks/benchmark_preprocessing.py
+pipeline_report = "pipeline_report_{day}.json" # run report of preprocessing_pipeline.py, per day
+pipeline_n_jobs = 4 # processes for the hourly loops that are independent per hour (BB4 labelling, BB6)
+upload_batch_bytes = 64 * 1024 * 1024 # in-memory size of the frames batched in one load job by UploadManager
+upload_max_jobs = 4 # load jobs in flight in UploadManager
+s2_covering_cache = "s2_coverings" # disk cache of the local S2 coverings of polygons, one .npy file per polygon and level
+s2_covering_n_jobs = 4 # processes computing the coverings of a batch of polygons
+cell_index_dir = "cell_index" # memory-mapped index from S2 cells to the codes of the polygons table, see utils/cell_index.py
+cell_index_levels = ["sscode", "sccode", "frcode", "cocode", "frnome"] # columns of the polygons table in the cell index
+hll_precision = 12 # 2^12 registers per HyperLogLog sketch of distinct users, about 1.6 % error, see utils/hll.py
+area_count_sketches = False # also upload the hourly sketches of the area counts, to count days, weeks or larger areas by merging them
+cell_occupancy_sketches = True # keep the sketches of the users in the cell occupancy cube, needed to count sections, freguesias and whole periods from it
+profile_store_partitions = 64 # Parquet partitions (by hash of the user) of the local profile stores, see utils/profile_store.py
 
 """
 Frequent trajectories settings
@@ -79,4 +96,9 @@ max_commute_time = 30.0 # commuter is passing and does not stay in a location fo
 min_regular_visit_days = 2.0 # visit more than one day in a week is a regular visitor
 min_residence_days = 5.0 # stay more than 4.0 days in a week is a resident
 area_cocodes = ['0303','1313'] # codes of concelhos for which user profiles needs to be calculated
+# hours [start, end) of the day parts of the user profiles (UTC), a window with start > end begins on the evening before
+day_part_windows = {"night": (20, 8),    # night locations (BB2), nights of the residential status (BB9)
+                    "day": (8, 20),      # day users of the night locations (BB2), days of the residential status (BB9)
+                    "work": (8, 18),     # work locations (BB3)
+                    "off_work": (18, 8)} # night users of the work locations (BB3)
     
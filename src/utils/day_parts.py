@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+import utils.config as config
+from utils.s2_arrays import lon_lat_to_cell_ids, to_signed
+
+
+'''
+The points of trajectory_details of a day and of the evening before, read once and shared by the user profiles (night
+locations of BB2, work locations of BB3, residential status of BB9) instead of one query per profile and day part.
+
+Every point has its S2 cell (s2code, signed as S2_CELLIDFROMPOINT returns it) computed locally and one boolean column
+per window of config.day_part_windows, with the hours of CAST(datetime AS DATETIME), in UTC, as the queries it
+replaces. The frame of the last table and day read is kept in memory, the profiles of the same day reuse it.
+'''
+
+
+_points_cache = {}
+
+
+def _in_window(hours, current, start, end):
+    if start < end:
+        return current & (hours >= start) & (hours < end)
+    return (~current & (hours >= start)) | (current & (hours < end))
+
+
+def get_day_points(client, source_table_id, current_day_part, windows = config.day_part_windows, level = config.s2_level):
+    '''
+    Points (imsi, datetime, mcc, lon, lat, day_part, s2code) of source_table_id on current_day_part and on the evening
+    before that are in one of the windows, tagged with one boolean column per window.
+    '''
+    current_day_part = pd.Timestamp(current_day_part).date()
+    key = (source_table_id, current_day_part, tuple(windows.items()), level)
+    if key in _points_cache:
+        return _points_cache[key]
+
+    previous_day_part = current_day_part - pd.Timedelta(days=1)
+    evening = min([start for start, end in windows.values() if start > end], default=24)
+    query = f"""SELECT imsi, datetime, mcc, ST_X(geography) AS lon, ST_Y(geography) AS lat, day_part
+                FROM {source_table_id}
+                WHERE day_part = DATE('{current_day_part}') OR
+                      (day_part = DATE('{previous_day_part}') AND EXTRACT(HOUR FROM CAST(datetime AS DATETIME)) >= {evening})"""
+    points = client.query(query).to_dataframe()
+
+    points['day_part'] = pd.to_datetime(points['day_part']).dt.date
+    points['s2code'] = to_signed(lon_lat_to_cell_ids(points.lon.values.astype(float), points.lat.values.astype(float), level))
+    hours = pd.to_datetime(points['datetime'], utc=True).dt.hour.values
+    current = (points['day_part'] == current_day_part).values
+    for name, (start, end) in windows.items():
+        points[name] = _in_window(hours, current, start, end)
+
+    points = points.loc[np.any([points[name].values for name in windows], axis=0)].reset_index(drop=True)
+    _points_cache.clear()
+    _points_cache[key] = points
+    return points
+
+
+def window_points(points, window, columns):
+    '''
+    Distinct rows of the columns of the points in the window, as a new frame.
+    '''
+    return points.loc[points[window], columns].drop_duplicates().reset_index(drop=True)
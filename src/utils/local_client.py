@@ -0,0 +1,422 @@
+import os
+import re
+import math
+import threading
+from functools import lru_cache, wraps
+import duckdb
+import pandas as pd
+import shapely
+from shapely import wkt, wkb
+from shapely.ops import nearest_points
+from s2sphere import CellId, LatLng
+from utils.s2_covering import covering_cell_ids
+
+
+'''
+Local drop-in for the bigquery.Client used across the building blocks.
+
+Tables are Parquet files in a data directory, one file per table, named after the last two components of the BigQuery
+table id (project.dataset.table -> dataset__table.parquet). Queries run on an in-process DuckDB connection: the
+BigQuery-specific syntax the project uses is rewritten to DuckDB, and the geography functions are provided as Python
+shims over shapely and s2sphere. Geographies are kept as WKT strings, as bigquery returns them in to_dataframe().
+
+Only the client surface the project uses is covered: query(...).result() / .to_dataframe(), load_table_from_dataframe,
+dataset(...).table(...), get_table and delete_table. Modified tables are written back to Parquet by flush().
+'''
+
+
+EARTH_RADIUS = 6371008.8 # meters, the sphere radius used by the BigQuery geography functions
+UNIT_SECONDS = {"MICROSECOND": 1e-6, "MILLISECOND": 1e-3, "SECOND": 1, "MINUTE": 60, "HOUR": 3600, "DAY": 86400}
+
+TABLE_ID = r"`?([A-Za-z_][\w-]*\.)?([A-Za-z_]\w*)\.([A-Za-z_]\w*)`?"
+MODIFYING_STATEMENT = re.compile(r"^\s*(?:CREATE\s+(?:OR\s+REPLACE\s+)?TABLE|INSERT\s+INTO|DELETE\s+FROM|UPDATE|MERGE\s+INTO|"
+                                 r"DROP\s+TABLE(?:\s+IF\s+EXISTS)?)\s+(\w+)", re.IGNORECASE)
+TRANSACTION_STATEMENT = re.compile(r"^\s*(BEGIN|COMMIT|ROLLBACK)(?:\s+TRANSACTION)?\s*$", re.IGNORECASE)
+
+
+def local_table_name(table_id):
+    '''
+    Name of the local table for a BigQuery table id, from its last two components (dataset and table).
+    '''
+    parts = str(table_id).replace("`", "").split(".")
+    return "__".join(parts[-2:])
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# geography shims, geographies are WKT strings
+
+@lru_cache(maxsize=4096)
+def _geometry(geography):
+    return wkt.loads(geography)
+
+
+def _signed_cell_id(cell_id):
+    # BigQuery returns S2 cell ids as signed INT64
+    return cell_id - (1 << 64) if cell_id >= (1 << 63) else cell_id
+
+
+def _haversine(lon1, lat1, lon2, lat2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def st_geogpoint(lon, lat):
+    return f"POINT({lon} {lat})"
+
+
+def st_intersects(geography_1, geography_2):
+    return _geometry(geography_1).intersects(_geometry(geography_2))
+
+
+def st_contains(geography_1, geography_2):
+    return _geometry(geography_1).contains(_geometry(geography_2))
+
+
+def st_distance(geography_1, geography_2):
+    point_1, point_2 = nearest_points(_geometry(geography_1), _geometry(geography_2))
+    return _haversine(point_1.x, point_1.y, point_2.x, point_2.y)
+
+
+def st_x(geography):
+    return _geometry(geography).x
+
+
+def st_y(geography):
+    return _geometry(geography).y
+
+
+def st_buffer(geography, radius):
+    '''
+    Buffer of radius meters, computed in a local equirectangular projection around the centroid of the geography.
+    '''
+    geometry = _geometry(geography)
+    scale = math.cos(math.radians(geometry.centroid.y))
+    projected = shapely.transform(geometry, lambda coords: coords * [scale, 1])
+    buffered = projected.buffer(math.degrees(radius / EARTH_RADIUS))
+    return shapely.transform(buffered, lambda coords: coords / [scale, 1]).wkt
+
+
+def st_asbinary(geography):
+    return wkb.dumps(_geometry(geography))
+
+
+def st_geogfromwkb(geography_wkb):
+    return wkb.loads(geography_wkb).wkt
+
+
+def s2_cellidfrompoint(geography, level = 30):
+    point = _geometry(geography)
+    cell_id = CellId.from_lat_lng(LatLng.from_degrees(point.y, point.x)).parent(level).id()
+    return _signed_cell_id(cell_id)
+
+
+def s2_coveringcellids(geography, min_level = 0, max_level = 30, max_cells = 8):
+    '''
+    Cells at max_level that intersect the geography, see utils.s2_covering.
+    '''
+    return covering_cell_ids(_geometry(geography), max_level).tolist()
+
+
+GEOGRAPHY_FUNCTIONS = [("ST_GEOGPOINT", st_geogpoint, ["DOUBLE", "DOUBLE"], "VARCHAR"),
+                       ("ST_INTERSECTS", st_intersects, ["VARCHAR", "VARCHAR"], "BOOLEAN"),
+                       ("ST_CONTAINS", st_contains, ["VARCHAR", "VARCHAR"], "BOOLEAN"),
+                       ("ST_DISTANCE", st_distance, ["VARCHAR", "VARCHAR"], "DOUBLE"),
+                       ("ST_X", st_x, ["VARCHAR"], "DOUBLE"),
+                       ("ST_Y", st_y, ["VARCHAR"], "DOUBLE"),
+                       ("ST_BUFFER", st_buffer, ["VARCHAR", "DOUBLE"], "VARCHAR"),
+                       ("ST_ASBINARY", st_asbinary, ["VARCHAR"], "BLOB"),
+                       ("ST_GEOGFROMWKB", st_geogfromwkb, ["BLOB"], "VARCHAR"),
+                       ("S2_CELLIDFROMPOINT", s2_cellidfrompoint, ["VARCHAR", "INTEGER"], "BIGINT"),
+                       ("S2_COVERINGCELLIDS", s2_coveringcellids, ["VARCHAR", "INTEGER", "INTEGER", "INTEGER"], "BIGINT[]")]
+
+SQL_MACROS = ["CREATE MACRO ST_GEOGFROMTEXT(g) AS g",
+              "CREATE MACRO ST_ASTEXT(g) AS g",
+              "CREATE MACRO bq_date(x) AS CAST(x AS DATE)",
+              "CREATE MACRO bq_datetime(x) AS CAST(x AS TIMESTAMP)",
+              "CREATE MACRO bq_timestamp(x) AS CAST(x AS TIMESTAMPTZ)",
+              "CREATE MACRO bq_dayofweek(x) AS 1 + EXTRACT(DOW FROM x)"]
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# BigQuery to DuckDB rewriting
+
+def _call_arguments(sql, open_paren):
+    '''
+    Arguments of the call whose opening parenthesis is at open_paren, and the index after the closing parenthesis.
+    '''
+    depth, quote, arguments, start = 0, None, [], open_paren + 1
+    for i in range(open_paren, len(sql)):
+        char = sql[i]
+        if quote:
+            quote = None if char == quote else quote
+        elif char in "'\"":
+            quote = char
+        elif char in "([":
+            depth += 1
+        elif char in ")]":
+            depth -= 1
+            if depth == 0:
+                arguments.append(sql[start:i].strip())
+                return arguments, i + 1
+        elif char == "," and depth == 1:
+            arguments.append(sql[start:i].strip())
+            start = i + 1
+    raise ValueError(f"Unbalanced parenthesis in query: {sql[open_paren:open_paren + 100]}")
+
+
+def _rewrite_calls(sql, function_name, rewrite):
+    pattern = re.compile(rf"\b{function_name}\s*\(", re.IGNORECASE)
+    match = pattern.search(sql)
+    while match:
+        arguments, end = _call_arguments(sql, match.end() - 1)
+        replacement = rewrite(arguments)
+        sql = sql[:match.start()] + replacement + sql[end:]
+        match = pattern.search(sql, match.start() + len(replacement))
+    return sql
+
+
+def _time_diff(arguments):
+    end, start, unit = arguments
+    return f"CAST(TRUNC((epoch({end}) - epoch({start})) / {UNIT_SECONDS[unit.upper()]}) AS BIGINT)"
+
+
+def _split_strings(sql):
+    # alternating code and string literal chunks, string chunks keep their quotes
+    return re.split(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\")", sql)
+
+
+def _split_statements(sql):
+    # the statements of a script, split on the semicolons outside the string literals
+    statements = [""]
+    for i, chunk in enumerate(_split_strings(sql)):
+        parts = chunk.split(";") if i % 2 == 0 else [chunk]
+        statements[-1] += parts[0]
+        statements.extend(parts[1:])
+    return [statement.strip() for statement in statements if statement.strip()]
+
+
+def _rewrite_code(code):
+    code = re.sub(TABLE_ID, lambda match: f"{match.group(2)}__{match.group(3)}" if match.group(1) else match.group(0), code)
+    code = re.sub(r"\bEXTRACT\s*\(\s*DAYOFWEEK\s+FROM\b", "bq_dayofweek(", code, flags=re.IGNORECASE)
+    code = re.sub(r"\bEXTRACT\s*\(\s*DATE\s+FROM\b", "bq_date(", code, flags=re.IGNORECASE)
+    code = re.sub(r"\b(DATE|DATETIME|TIMESTAMP)\s*\(", lambda match: f"bq_{match.group(1).lower()}(", code, flags=re.IGNORECASE)
+    code = re.sub(r"\bAS\s+FLOAT64\b", "AS DOUBLE", code, flags=re.IGNORECASE)
+    code = re.sub(r"\b\w+\s*=>\s*", "", code)
+    return code
+
+
+def to_duckdb_sql(sql, query_parameters = ()):
+    '''
+    Rewrite a BigQuery standard SQL query to the DuckDB dialect with the shims registered by LocalClient.
+    '''
+    for parameter in query_parameters:
+        sql = re.sub(rf"@{parameter.name}\b", "'" + str(parameter.value).replace("'", "''") + "'", sql)
+
+    chunks = _split_strings(sql)
+    for i, chunk in enumerate(chunks):
+        if i % 2 == 0:
+            chunks[i] = _rewrite_code(chunk)
+        elif chunk.startswith('"'):
+            # double quoted strings are literals in BigQuery, identifiers in DuckDB
+            chunks[i] = "'" + chunk[1:-1].replace("'", "''") + "'"
+    sql = "".join(chunks)
+
+    sql = _rewrite_calls(sql, r"IN\s+UNNEST", lambda arguments: f"IN (SELECT UNNEST({arguments[0]}))")
+    for function_name in ["TIMESTAMP_DIFF", "DATETIME_DIFF", "DATE_DIFF"]:
+        sql = _rewrite_calls(sql, function_name, _time_diff)
+    sql = re.sub(r"(\bUNNEST\s*\([^()]*\)\s+AS\s+)(\w+)\b(?!\s*\()", r"\1\2(\2)", sql, flags=re.IGNORECASE)
+    return sql
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+# client
+
+class LocalTableReference:
+
+    def __init__(self, dataset_id, table_id):
+        self.dataset_id = dataset_id
+        self.table_id = table_id
+
+    def __str__(self):
+        return f"{self.dataset_id}.{self.table_id}"
+
+
+class LocalDatasetReference:
+
+    def __init__(self, dataset_id):
+        self.dataset_id = dataset_id
+
+    def table(self, table_id):
+        return LocalTableReference(self.dataset_id, table_id)
+
+
+class LocalQueryJob:
+
+    def __init__(self, dataframe):
+        self.dataframe = dataframe
+        self.total_bytes_processed = None
+
+    def result(self):
+        return self
+
+    def to_dataframe(self):
+        return pd.DataFrame() if self.dataframe is None else self.dataframe
+
+
+def _locked(method):
+    # a DuckDB connection can not be used from several threads at once (the load jobs of UploadManager run in threads)
+    @wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked_method
+
+
+class LocalClient:
+    '''
+    bigquery.Client look-alike over the Parquet files of data_dir.
+    '''
+
+    def __init__(self, data_dir, project = "local"):
+        self.data_dir = data_dir
+        self.project = project
+        self.connection = duckdb.connect()
+        self.lock = threading.RLock()
+        self.connection.execute("SET TimeZone = 'UTC'")
+        self.dirty_tables = set()
+        self.dropped_tables = set()
+
+        for name, function, parameters, return_type in GEOGRAPHY_FUNCTIONS:
+            self.connection.create_function(name, function, parameters, return_type, side_effects=False)
+        for macro in SQL_MACROS:
+            self.connection.execute(macro)
+
+        os.makedirs(data_dir, exist_ok=True)
+        for file_name in sorted(os.listdir(data_dir)):
+            if file_name.endswith(".parquet"):
+                # tables are read straight from Parquet until they are modified
+                name = file_name[:-len(".parquet")]
+                self.connection.execute(f"CREATE VIEW {name} AS SELECT * FROM read_parquet('{self._path(name)}')")
+
+    def _path(self, name):
+        return os.path.join(self.data_dir, f"{name}.parquet")
+
+    def _table_type(self, name):
+        table_type = self.connection.execute("SELECT table_type FROM information_schema.tables WHERE table_name = ?",
+                                             [name]).fetchone()
+        return None if table_type is None else table_type[0]
+
+    def _materialize(self, name):
+        if self._table_type(name) == "VIEW":
+            self.connection.execute(f"CREATE TABLE {name}__materialized AS SELECT * FROM {name}")
+            self.connection.execute(f"DROP VIEW {name}")
+            self.connection.execute(f"ALTER TABLE {name}__materialized RENAME TO {name}")
+
+    def _modified(self, name):
+        self.dirty_tables.add(name)
+        self.dropped_tables.discard(name)
+
+    def dataset(self, dataset_id):
+        return LocalDatasetReference(dataset_id)
+
+    @_locked
+    def query(self, query, job_config = None):
+
+        statements = _split_statements(query)
+        if len(statements) > 1:
+            return self._run_script(statements, job_config)
+        transaction = TRANSACTION_STATEMENT.match(query)
+        if transaction is not None:
+            self.connection.execute(transaction.group(1).upper())
+            return LocalQueryJob(None)
+
+        sql = to_duckdb_sql(query, getattr(job_config, "query_parameters", None) or ())
+        modified = MODIFYING_STATEMENT.match(sql)
+        if modified is None:
+            return LocalQueryJob(self.connection.execute(sql).fetchdf())
+
+        name = modified.group(1)
+        statement = modified.group(0).upper()
+        if statement.lstrip().startswith("DROP"):
+            self.delete_table(name, not_found_ok = "IF EXISTS" in statement)
+            return LocalQueryJob(None)
+
+        if statement.lstrip().startswith("CREATE") and self._table_type(name) == "VIEW":
+            self.connection.execute(f"DROP VIEW {name}")
+        else:
+            self._materialize(name)
+        self.connection.execute(sql)
+        self._modified(name)
+        return LocalQueryJob(None)
+
+    def _run_script(self, statements, job_config):
+        # a multi-statement query, as BEGIN TRANSACTION; ...; COMMIT TRANSACTION; a failed transaction is rolled back
+        in_transaction = False
+        try:
+            for statement in statements:
+                job = self.query(statement, job_config)
+                transaction = TRANSACTION_STATEMENT.match(statement)
+                if transaction is not None:
+                    in_transaction = transaction.group(1).upper() == "BEGIN"
+        except Exception:
+            if in_transaction:
+                self.connection.execute("ROLLBACK")
+            raise
+        return job
+
+    def _load(self, name, source, job_config):
+        write_disposition = str(getattr(job_config, "write_disposition", None) or "WRITE_APPEND")
+        if self._table_type(name) is None or write_disposition.endswith("WRITE_TRUNCATE"):
+            self.connection.execute(f"CREATE OR REPLACE TABLE {name} AS SELECT * FROM {source}")
+        else:
+            self._materialize(name)
+            self.connection.execute(f"INSERT INTO {name} BY NAME SELECT * FROM {source}")
+        self._modified(name)
+
+    @_locked
+    def load_table_from_dataframe(self, dataframe, destination, job_config = None):
+
+        dataframe = dataframe.copy()
+        for column in dataframe.columns[dataframe.dtypes == object]:
+            if dataframe[column].map(lambda value: isinstance(value, shapely.Geometry)).any():
+                dataframe[column] = dataframe[column].map(lambda value: value.wkt if isinstance(value, shapely.Geometry) else value)
+
+        self.connection.register("loaded_dataframe", dataframe)
+        self._load(local_table_name(destination), "loaded_dataframe", job_config)
+        self.connection.unregister("loaded_dataframe")
+        return LocalQueryJob(None)
+
+    @_locked
+    def get_table(self, table):
+
+        if self._table_type(local_table_name(table)) is None:
+            raise ValueError(f"Table {table} not found")
+        return LocalTableReference(*str(table).replace("`", "").split(".")[-2:])
+
+    @_locked
+    def delete_table(self, table, not_found_ok = False):
+
+        name = local_table_name(table)
+        table_type = self._table_type(name)
+        if table_type is None:
+            if not_found_ok:
+                return
+            raise ValueError(f"Table {table} not found")
+        self.connection.execute(f"DROP {'VIEW' if table_type == 'VIEW' else 'TABLE'} {name}")
+        self.dropped_tables.add(name)
+        self.dirty_tables.discard(name)
+
+    @_locked
+    def flush(self):
+        '''
+        Write the tables modified since the last flush back to their Parquet files.
+        '''
+        for name in self.dirty_tables:
+            self.connection.execute(f"COPY {name} TO '{self._path(name)}.tmp' (FORMAT PARQUET)")
+            os.replace(f"{self._path(name)}.tmp", self._path(name))
+        for name in self.dropped_tables:
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        self.dirty_tables = set()
+        self.dropped_tables = set()
@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+import utils.config as config
+
+
+'''
+Stores of the user profile tables that are updated every day (the night locations of BB2), read and rewritten only for
+the users of the day instead of the whole table.
+
+Both stores have the same interface: read(users) returns the current rows of the users, replace(rows) replaces the rows
+of the users of the last read by rows. BigQueryProfileStore keeps the profile in its BigQuery table, the users of the
+day are loaded to a staging table that the read and the DELETE join, the new rows to a second one that is inserted in
+the same transaction as the DELETE. LocalProfileStore keeps it in Parquet files partitioned by a hash of the user, only
+the partitions of the users of the day are read and written, for tests and local runs.
+'''
+
+
+class BigQueryProfileStore:
+
+    def __init__(self, client, dataset, table):
+        self.client = client
+        self.table = f"{dataset}.{table}"
+        self.staging_table = f"{dataset}.{table}_users"
+        self.rows_table = f"{dataset}.{table}_rows"
+
+    def read(self, users):
+        '''
+        Rows of the table of the users.
+        '''
+        job_config = bigquery.LoadJobConfig()
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        self.client.load_table_from_dataframe(pd.DataFrame({config.USER_ID: pd.unique(np.asarray(users))}),
+                                              self.staging_table, job_config=job_config).result()
+
+        sql = f"""SELECT * FROM {self.table}
+                  WHERE {config.USER_ID} IN (SELECT {config.USER_ID} FROM {self.staging_table})"""
+        return self.client.query(sql).to_dataframe()
+
+    def replace(self, rows):
+        '''
+        Replace the rows of the users of the last read by rows. The rows are loaded to a staging table first and applied
+        in one transaction, a failed run leaves the table as it was.
+        '''
+        job_config = bigquery.LoadJobConfig()
+        job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+        self.client.load_table_from_dataframe(rows, self.rows_table, job_config=job_config).result()
+
+        columns = ", ".join(rows.columns)
+        sql = f"""BEGIN TRANSACTION;
+                  DELETE FROM {self.table}
+                  WHERE {config.USER_ID} IN (SELECT {config.USER_ID} FROM {self.staging_table});
+                  INSERT INTO {self.table} ({columns})
+                  SELECT {columns} FROM {self.rows_table};
+                  COMMIT TRANSACTION;"""
+        self.client.query(sql).result()
+
+
+class LocalProfileStore:
+
+    def __init__(self, directory, partitions = config.profile_store_partitions):
+        self.directory = directory
+        self.partitions = partitions
+        self.users = np.array([], dtype=object)
+        os.makedirs(directory, exist_ok=True)
+
+    def _partition(self, users):
+        return pd.util.hash_array(np.asarray(users).astype(str).astype(object)) % np.uint64(self.partitions)
+
+    def _path(self, partition):
+        return os.path.join(self.directory, f"part-{partition:04d}.parquet")
+
+    def _load(self, partition):
+        if os.path.exists(self._path(partition)):
+            return pd.read_parquet(self._path(partition))
+        return None
+
+    def read(self, users):
+        '''
+        Rows of the partitions of the users that belong to the users.
+        '''
+        self.users = pd.unique(np.asarray(users))
+        frames = [self._load(partition) for partition in np.unique(self._partition(self.users))]
+        frames = [frame for frame in frames if frame is not None]
+        if len(frames) == 0:
+            return pd.DataFrame(columns=[config.USER_ID])
+        rows = pd.concat(frames, ignore_index=True)
+        return rows.loc[rows[config.USER_ID].isin(self.users)].reset_index(drop=True)
+
+    def replace(self, rows):
+        '''
+        Replace the rows of the users of the last read by rows, rewriting their partitions.
+        '''
+        row_partitions = self._partition(rows[config.USER_ID].values)
+        for partition in np.unique(np.append(self._partition(self.users), row_partitions)):
+            kept = self._load(partition)
+            new_rows = rows.loc[row_partitions == partition]
+            if kept is not None:
+                new_rows = pd.concat([kept.loc[~kept[config.USER_ID].isin(self.users)], new_rows], ignore_index=True)
+            new_rows.to_parquet(f"{self._path(partition)}.tmp", index=False)
+            os.replace(f"{self._path(partition)}.tmp", self._path(partition))
+
+    def to_dataframe(self):
+        '''
+        All the rows of the store.
+        '''
+        frames = [self._load(partition) for partition in range(self.partitions)]
+        frames = [frame for frame in frames if frame is not None]
+        return pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame(columns=[config.USER_ID])
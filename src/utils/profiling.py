@@ -0,0 +1,136 @@
+import json
+import time
+import resource
+from contextlib import contextmanager
+import pandas as pd
+
+
+'''
+Lightweight instrumentation of the daily pipeline.
+
+A RunReport times named stages with the stage() context manager. Every stage records its duration, the peak RSS of the
+process when it ends, the rows it reads from queries and uploads, and the bytes scanned and uploaded by the client calls
+made inside it (through InstrumentedClient). Stages can be nested, the innermost active stage receives the client
+metrics. The report is saved as JSON, with one record per stage and a summary per stage name.
+'''
+
+
+_active_stages = []
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def record(**metrics):
+    '''
+    Add the metrics to the innermost active stage, if any.
+    '''
+    if len(_active_stages) == 0:
+        return
+    stage = _active_stages[-1]
+    for key, value in metrics.items():
+        if value is not None:
+            stage[key] = stage.get(key, 0) + value
+
+
+class RunReport:
+
+    def __init__(self, name):
+        self.name = name
+        self.started_at = pd.Timestamp.now(tz="UTC").isoformat()
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, **labels):
+        '''
+        Time the block and collect its metrics. Rows produced by the block can be set with stage["rows_out"] = ...
+        '''
+        parents = [parent["name"] for parent in _active_stages]
+        stage = dict(name = name, path = "/".join(parents + [name]), **labels)
+        _active_stages.append(stage)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage["duration_s"] = round(time.perf_counter() - start, 4)
+            stage["peak_rss_mb"] = round(peak_rss_mb(), 1)
+            _active_stages.pop()
+            self.stages.append(stage)
+            print(f"{stage['path']}: {stage['duration_s']:.2f}s")
+
+    def summary(self):
+        '''
+        Total duration, rows and bytes per stage name, slowest first.
+        '''
+        if len(self.stages) == 0:
+            return pd.DataFrame()
+        stages = pd.DataFrame(self.stages)
+        metrics = [column for column in ["duration_s", "rows_read", "rows_out", "rows_uploaded", "bytes_processed",
+                                         "bytes_uploaded", "queries"] if column in stages.columns]
+        summary = stages.groupby("path")[metrics].sum()
+        summary["calls"] = stages.groupby("path").size()
+        summary["peak_rss_mb"] = stages.groupby("path").peak_rss_mb.max()
+        return summary.sort_values("duration_s", ascending=False)
+
+    def to_dict(self):
+        return dict(name = self.name,
+                    started_at = self.started_at,
+                    peak_rss_mb = round(peak_rss_mb(), 1),
+                    stages = self.stages,
+                    summary = self.summary().reset_index().to_dict(orient="records"))
+
+    def save(self, path):
+        with open(path, "w") as report_file:
+            json.dump(self.to_dict(), report_file, indent=2, default=str)
+        print(f"Run report written to {path}")
+
+
+class InstrumentedQueryJob:
+    '''
+    Query job proxy that records the bytes scanned by the query and the rows it returns.
+    '''
+
+    def __init__(self, job):
+        self._job = job
+        self._recorded = False
+
+    def __getattr__(self, name):
+        return getattr(self._job, name)
+
+    def _record(self, rows_read = None):
+        if not self._recorded:
+            record(queries = 1, bytes_processed = getattr(self._job, "total_bytes_processed", None))
+            self._recorded = True
+        record(rows_read = rows_read)
+
+    def result(self, *args, **kwargs):
+        result = self._job.result(*args, **kwargs)
+        self._record()
+        return result
+
+    def to_dataframe(self, *args, **kwargs):
+        dataframe = self._job.to_dataframe(*args, **kwargs)
+        self._record(len(dataframe))
+        return dataframe
+
+
+class InstrumentedClient:
+    '''
+    Client proxy (bigquery.Client or LocalClient) that reports the queries and uploads to the active stage.
+    '''
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def query(self, *args, **kwargs):
+        return InstrumentedQueryJob(self._client.query(*args, **kwargs))
+
+    def load_table_from_dataframe(self, dataframe, *args, **kwargs):
+        job = self._client.load_table_from_dataframe(dataframe, *args, **kwargs)
+        record(rows_uploaded = len(dataframe), bytes_uploaded = int(dataframe.memory_usage(deep=True).sum()))
+        return job
@@ -0,0 +1,176 @@
+import numpy as np
+from s2sphere.sphere import LOOKUP_IJ, LOOKUP_POS, LOOKUP_BITS, SWAP_MASK, INVERT_MASK
+
+
+'''
+Vectorized S2 cell arithmetic on numpy arrays of cell ids, following the s2sphere implementation (quadratic projection)
+with one array operation per step instead of one Python call per cell.
+
+Cell ids are uint64 here. BigQuery returns them as signed INT64, convert with to_signed / to_unsigned.
+'''
+
+
+MAX_LEVEL = 30
+_LOOKUP_IJ = np.array(LOOKUP_IJ, dtype="uint64")
+_LOOKUP_POS = np.array(LOOKUP_POS, dtype="uint64")
+
+
+def to_unsigned(cell_ids):
+    return np.asarray(cell_ids, dtype="int64").view("uint64")
+
+
+def to_signed(cell_ids):
+    return np.asarray(cell_ids, dtype="uint64").view("int64")
+
+
+def lowest_bits(cell_ids):
+    cell_ids = np.asarray(cell_ids, dtype="uint64")
+    return cell_ids & (~cell_ids + np.uint64(1))
+
+
+def cell_levels(cell_ids):
+    # the lowest set bit of a cell id at level L is bit 2 * (30 - L)
+    return MAX_LEVEL - np.log2(lowest_bits(cell_ids).astype("float64")).astype("int64") // 2
+
+
+def children(cell_ids):
+    '''
+    The four children of every cell, in curve order: children(ids).reshape(-1, 4)[k] are the children of ids[k].
+    '''
+    cell_ids = np.asarray(cell_ids, dtype="uint64")
+    lsb = lowest_bits(cell_ids)
+    child_lsb = lsb >> np.uint64(2)
+    first = cell_ids - lsb + child_lsb
+    return (first[:, None] + (child_lsb[:, None] << np.uint64(1)) * np.arange(4, dtype="uint64")).ravel()
+
+
+def descendants(cell_ids, level):
+    '''
+    All the cells at level inside the cells (at level or above), in curve order.
+    '''
+    cell_ids = np.asarray(cell_ids, dtype="uint64")
+    lsb = lowest_bits(cell_ids)
+    level_lsb = np.uint64(1 << (2 * (MAX_LEVEL - level)))
+    counts = (lsb // level_lsb).astype("int64") # 4 ** (level - cell level)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(cell_ids - lsb + level_lsb, counts) + offsets.astype("uint64") * (level_lsb << np.uint64(1))
+
+
+def face_ij(cell_ids):
+    '''
+    Face and (i, j) leaf coordinates of the cells, decoded from the Hilbert curve position as s2sphere's
+    CellId.to_face_ij_orientation.
+    '''
+    cell_ids = np.asarray(cell_ids, dtype="uint64")
+    face = (cell_ids >> np.uint64(61)).astype("int64")
+    bits = (face & SWAP_MASK).astype("uint64")
+    i = np.zeros(len(cell_ids), dtype="int64")
+    j = np.zeros(len(cell_ids), dtype="int64")
+    lookup_mask = np.uint64((1 << LOOKUP_BITS) - 1)
+
+    for k in range(7, -1, -1):
+        n_bits = MAX_LEVEL - 7 * LOOKUP_BITS if k == 7 else LOOKUP_BITS
+        bits = bits + (((cell_ids >> np.uint64(k * 2 * LOOKUP_BITS + 1)) & np.uint64((1 << (2 * n_bits)) - 1)) << np.uint64(2))
+        bits = _LOOKUP_IJ[bits.astype("int64")]
+        i += ((bits >> np.uint64(LOOKUP_BITS + 2)) << np.uint64(k * LOOKUP_BITS)).astype("int64")
+        j += (((bits >> np.uint64(2)) & lookup_mask) << np.uint64(k * LOOKUP_BITS)).astype("int64")
+        bits = bits & np.uint64(SWAP_MASK | INVERT_MASK)
+
+    return face, i, j
+
+
+def from_face_ij(face, i, j):
+    '''
+    Leaf cell ids of the (i, j) leaf coordinates on the faces, encoded on the Hilbert curve as s2sphere's
+    CellId.from_face_ij.
+    '''
+    face = np.asarray(face, dtype="int64")
+    i = np.asarray(i, dtype="int64")
+    j = np.asarray(j, dtype="int64")
+    cell_ids = face.astype("uint64") << np.uint64(2 * MAX_LEVEL)
+    bits = (face & SWAP_MASK).astype("uint64")
+    lookup_mask = (1 << LOOKUP_BITS) - 1
+
+    for k in range(7, -1, -1):
+        bits = bits + (((i >> (k * LOOKUP_BITS)) & lookup_mask) << (LOOKUP_BITS + 2)).astype("uint64")
+        bits = bits + (((j >> (k * LOOKUP_BITS)) & lookup_mask) << 2).astype("uint64")
+        bits = _LOOKUP_POS[bits.astype("int64")]
+        cell_ids = cell_ids | ((bits >> np.uint64(2)) << np.uint64(k * 2 * LOOKUP_BITS))
+        bits = bits & np.uint64(SWAP_MASK | INVERT_MASK)
+
+    return cell_ids * np.uint64(2) + np.uint64(1)
+
+
+def parents(cell_ids, level):
+    '''
+    The ancestors at level of the cells (at level or below).
+    '''
+    cell_ids = np.asarray(cell_ids, dtype="uint64")
+    level_lsb = np.uint64(1 << (2 * (MAX_LEVEL - level)))
+    return (cell_ids & ~(level_lsb * np.uint64(2) - np.uint64(1))) | level_lsb
+
+
+def st_to_uv(s):
+    return np.where(s >= 0.5, (4 * s * s - 1) / 3, (1 - 4 * (1 - s) * (1 - s)) / 3)
+
+
+def uv_to_st(u):
+    half = 0.5 * np.sqrt(1 + 3 * np.abs(u))
+    return np.where(u >= 0, half, 1 - half)
+
+
+def face_uv_to_xyz(face, u, v):
+    one = np.ones_like(u)
+    x = np.choose(face, [one, -u, -u, -one, v, v])
+    y = np.choose(face, [u, one, -v, -v, -one, u])
+    z = np.choose(face, [v, v, one, -u, -u, -one])
+    return x, y, z
+
+
+def xyz_to_lon_lat(x, y, z):
+    lat = np.degrees(np.arctan2(z, np.sqrt(x * x + y * y)))
+    lon = np.degrees(np.arctan2(y, x))
+    return lon, lat
+
+
+def lon_lat_to_face_uv(lon, lat):
+    lon, lat = np.radians(np.asarray(lon, dtype="float64")), np.radians(np.asarray(lat, dtype="float64"))
+    xyz = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    # the face is the axis of the largest component, + 3 when it is negative
+    axis = np.argmax(np.abs(xyz), axis=0)
+    face = axis + 3 * (np.take_along_axis(xyz, axis[None, :], axis=0)[0] < 0)
+    x, y, z = xyz
+    # the divisions by the other axes are not used, and may be by zero
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u = np.choose(face, [y / x, -x / y, -x / z, z / x, z / y, -y / z])
+        v = np.choose(face, [z / x, z / y, -y / z, y / x, -x / y, -x / z])
+    return face, u, v
+
+
+def lon_lat_to_cell_ids(lon, lat, level = MAX_LEVEL):
+    '''
+    Ids of the cells at level of the points, as s2sphere's CellId.from_lat_lng(...).parent(level).
+    '''
+    face, u, v = lon_lat_to_face_uv(np.atleast_1d(lon), np.atleast_1d(lat))
+    size = 1 << MAX_LEVEL
+    i = np.clip(np.floor(size * uv_to_st(u)), 0, size - 1).astype("int64")
+    j = np.clip(np.floor(size * uv_to_st(v)), 0, size - 1).astype("int64")
+    return parents(from_face_ij(face, i, j), level)
+
+
+def cell_vertices(cell_ids):
+    '''
+    (lon, lat) of the four vertices of every cell, as an array of shape (n, 4, 2) in the order of s2sphere's
+    Cell.get_vertex.
+    '''
+    cell_ids = np.asarray(cell_ids, dtype="uint64")
+    face, i, j = face_ij(cell_ids)
+    size = np.left_shift(1, MAX_LEVEL - cell_levels(cell_ids))
+    i0, j0 = i & -size, j & -size
+
+    vertex_i = np.stack([i0, i0 + size, i0 + size, i0], axis=1)
+    vertex_j = np.stack([j0, j0, j0 + size, j0 + size], axis=1)
+    u = st_to_uv(vertex_i / (1 << MAX_LEVEL))
+    v = st_to_uv(vertex_j / (1 << MAX_LEVEL))
+    lon, lat = xyz_to_lon_lat(*face_uv_to_xyz(np.repeat(face[:, None], 4, axis=1), u, v))
+    return np.stack([lon, lat], axis=2)
@@ -0,0 +1,133 @@
+import os
+import hashlib
+import multiprocessing
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import shapely
+from s2sphere import LatLng, LatLngRect, RegionCoverer
+import utils.config as config
+from utils.s2_arrays import children, descendants, cell_vertices, to_signed
+
+
+'''
+In-process replacement of S2_COVERINGCELLIDS(geography, min_level => level, max_level => level, max_cells => 1000000).
+
+The bounding box of the polygon is covered with s2sphere's RegionCoverer at a coarse level, then the cells that cross the
+boundary of the polygon are split level by level down to the target level (one vectorized shapely test per level). Cells
+inside the polygon are not split, they are expanded to their descendants at the target level at the end. Coverings are
+cached on disk by polygon hash and level.
+'''
+
+
+COARSE_LEVEL = 8 # level of the RegionCoverer covering of the bounding box
+MARGIN_DEGREES = 0.001 # at the coarse levels the cell edges are drawn straight in lon/lat, not as geodesics
+PARALLEL_MIN_POLYGONS = 500 # at about 10 ms per polygon, smaller batches do not pay for starting the process pool
+
+
+def _bounding_box_covering(geometry, level):
+    min_lon, min_lat, max_lon, max_lat = geometry.bounds
+    rect = LatLngRect.from_point_pair(LatLng.from_degrees(min_lat, min_lon), LatLng.from_degrees(max_lat, max_lon))
+
+    coverer = RegionCoverer()
+    coverer.min_level = level
+    coverer.max_level = level
+    coverer.max_cells = 1000000
+    return np.array([cell_id.id() for cell_id in coverer.get_covering(rect)], dtype="uint64")
+
+
+def _cell_polygons(cell_ids):
+    return shapely.polygons(cell_vertices(cell_ids))
+
+
+def covering_cell_ids(geometry, level = config.s2_level):
+    '''
+    Sorted ids (signed, as BigQuery returns them) of the cells at level that intersect the geometry, given in (lon, lat).
+    '''
+    start_level = min(level, COARSE_LEVEL)
+    cell_ids = _bounding_box_covering(geometry, start_level)
+
+    outer = geometry.buffer(MARGIN_DEGREES)
+    inner = geometry.buffer(-MARGIN_DEGREES)
+    shapely.prepare(outer)
+    shapely.prepare(inner)
+    interior = [np.array([], dtype="uint64")]
+    for _ in range(start_level, level):
+        # cells inside the polygon are not split further, their descendants at level are added at the end
+        polygons = _cell_polygons(cell_ids)
+        inside = shapely.contains(inner, polygons)
+        interior.append(cell_ids[inside])
+        cell_ids = children(cell_ids[~inside & shapely.intersects(outer, polygons)])
+
+    shapely.prepare(geometry)
+    if len(cell_ids) > 0:
+        cell_ids = cell_ids[shapely.intersects(geometry, _cell_polygons(cell_ids))]
+    return np.sort(to_signed(np.concatenate([descendants(np.concatenate(interior), level), cell_ids])))
+
+
+def polygon_key(geometry, level = config.s2_level):
+    # the same polygon starting at another vertex has the same key
+    return hashlib.sha1(shapely.to_wkb(shapely.normalize(geometry)) + f"/{level}".encode()).hexdigest()
+
+
+def _cache_path(geometry, level, cache_dir):
+    return os.path.join(cache_dir, f"{polygon_key(geometry, level)}.npy")
+
+
+def cached_covering_cell_ids(geometry, level = config.s2_level, cache_dir = config.s2_covering_cache):
+    '''
+    covering_cell_ids, read from / written to the disk cache (cache_dir = None disables it).
+    '''
+    if cache_dir is None:
+        return covering_cell_ids(geometry, level)
+
+    path = _cache_path(geometry, level, cache_dir)
+    if os.path.exists(path):
+        return np.load(path)
+
+    cell_ids = covering_cell_ids(geometry, level)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written under a temporary name, concurrent writers of the same polygon do not leave a partial file
+    with open(f"{path}.{os.getpid()}.tmp", "wb") as cache_file:
+        np.save(cache_file, cell_ids)
+    os.replace(f"{path}.{os.getpid()}.tmp", path)
+    return cell_ids
+
+
+def covering_cell_ids_batch(geometries, level = config.s2_level, cache_dir = config.s2_covering_cache,
+                            n_jobs = config.s2_covering_n_jobs):
+    '''
+    Coverings of several geometries, in order. The ones missing from the cache are computed in a pool of n_jobs
+    processes when there are enough of them.
+    '''
+    geometries = list(geometries)
+    coverings = [None] * len(geometries)
+    missing = []
+    for position, geometry in enumerate(geometries):
+        if cache_dir is not None and os.path.exists(_cache_path(geometry, level, cache_dir)):
+            coverings[position] = np.load(_cache_path(geometry, level, cache_dir))
+        else:
+            missing.append(position)
+
+    compute = partial(cached_covering_cell_ids, level = level, cache_dir = cache_dir)
+    if n_jobs == 1 or len(missing) < PARALLEL_MIN_POLYGONS:
+        computed = [compute(geometries[position]) for position in missing]
+    else:
+        with ProcessPoolExecutor(max_workers = n_jobs, mp_context = multiprocessing.get_context("spawn")) as executor:
+            computed = list(executor.map(compute, [geometries[position] for position in missing],
+                                         chunksize = max(1, len(missing) // (4 * n_jobs))))
+
+    for position, cell_ids in zip(missing, computed):
+        coverings[position] = cell_ids
+    return coverings
+
+
+def union_covering_cell_ids(geometries, level = config.s2_level, cache_dir = config.s2_covering_cache,
+                            n_jobs = config.s2_covering_n_jobs):
+    '''
+    Sorted ids of the cells at level that intersect any of the geometries.
+    '''
+    coverings = covering_cell_ids_batch(geometries, level, cache_dir, n_jobs)
+    if len(coverings) == 0:
+        return np.array([], dtype="int64")
+    return np.unique(np.concatenate(coverings))
@@ -0,0 +1,149 @@
+import numpy as np
+import pandas as pd
+import utils.config as config
+
+
+'''
+Reproducible synthetic raw pings, shaped like the rows of the raw data table (config.data_columns).
+
+Every user lives around the centroid of a Portuguese concelho and spends the day in a home -> work -> home pattern: a stay
+at home, a trip to a work place a few kilometers away at a walking, cycling, driving or train speed, a stay at work and
+the trip back. Pings arrive as a Poisson process over the day, with GPS noise on every position and a share of pings
+repeated within the same second, as the raw data has.
+
+generate_profiles makes merged user profiles of BB9, with values on both sides of the thresholds of the residential
+status rules.
+'''
+
+
+EARTH_RADIUS = 6371000 # meters
+
+# code, name, latitude, longitude, approximate population
+CONCELHOS = [("1106", "Lisboa", 38.7223, -9.1393, 545000),
+             ("1312", "Porto", 41.1579, -8.6291, 232000),
+             ("0303", "Braga", 41.5454, -8.4265, 193000),
+             ("0603", "Coimbra", 40.2033, -8.4103, 140000),
+             ("0805", "Faro", 37.0194, -7.9322, 64000),
+             ("0105", "Aveiro", 40.6405, -8.6538, 80000),
+             ("0705", "Évora", 38.5714, -7.9135, 53000),
+             ("1823", "Viseu", 40.6566, -7.9125, 99000),
+             ("1512", "Setúbal", 38.5244, -8.8882, 123000),
+             ("1313", "Póvoa de Varzim", 41.3807, -8.7609, 64000),
+             ("0308", "Guimarães", 41.4425, -8.2918, 156000)]
+
+TRAVEL_SPEEDS = [1.4, 4.5, 12, 20] # meters per second: walk, bike, car, train
+TRAVEL_SPEED_SHARES = [0.15, 0.05, 0.65, 0.15]
+
+FOREIGN_MCCS = [214, 208, 234, 262] # Spain, France, United Kingdom, Germany
+RESIDENTIAL_STATUSES = ['commuter', 'casual visitor', 'regular visitor', 'national tourist', 'international tourist',
+                        'resident', None]
+DEVICES = [("Apple", "iPhone 13"), ("Apple", "iPhone 14"), ("Samsung", "Galaxy S22"), ("Samsung", "Galaxy A53"),
+           ("Xiaomi", "Redmi Note 11"), ("Huawei", "P30")]
+
+
+def _offset(lat, lon, distance, bearing):
+    # move (lat, lon) by distance meters towards bearing, with the equirectangular approximation
+    lat_new = lat + np.degrees(distance * np.cos(bearing) / EARTH_RADIUS)
+    lon_new = lon + np.degrees(distance * np.sin(bearing) / (EARTH_RADIUS * np.cos(np.radians(lat))))
+    return lat_new, lon_new
+
+
+def generate_users(n_users, rng):
+    '''
+    One row per user with their home and work places and the times of the two commutes, in seconds since midnight.
+    '''
+    weights = np.array([concelho[4] for concelho in CONCELHOS], dtype=float)
+    concelho = rng.choice(len(CONCELHOS), size=n_users, p=weights / weights.sum())
+    centroid_lat = np.array([c[2] for c in CONCELHOS])[concelho]
+    centroid_lon = np.array([c[3] for c in CONCELHOS])[concelho]
+
+    home_lat, home_lon = _offset(centroid_lat, centroid_lon, np.abs(rng.normal(0, 2500, n_users)),
+                                 rng.uniform(0, 2 * np.pi, n_users))
+    commute_distance = np.clip(rng.lognormal(np.log(5000), 0.8, n_users), 300, 60000)
+    work_lat, work_lon = _offset(home_lat, home_lon, commute_distance, rng.uniform(0, 2 * np.pi, n_users))
+
+    speed = rng.choice(TRAVEL_SPEEDS, size=n_users, p=TRAVEL_SPEED_SHARES)
+    travel_time = commute_distance / speed
+    leave_home = np.clip(rng.normal(8 * 3600, 3600, n_users), 5 * 3600, 12 * 3600)
+    leave_work = np.clip(rng.normal(17.5 * 3600, 3600, n_users), leave_home + travel_time + 1800, 22 * 3600)
+
+    return pd.DataFrame(dict(concelho = np.array([c[0] for c in CONCELHOS])[concelho],
+                             home_lat = home_lat, home_lon = home_lon,
+                             work_lat = work_lat, work_lon = work_lon,
+                             leave_home = leave_home, arrive_work = leave_home + travel_time,
+                             leave_work = leave_work, arrive_home = leave_work + travel_time))
+
+
+def generate_pings(n_users, day = "2023-05-01", seed = 0, mean_ping_interval = 600, gps_noise = 20,
+                   duplicate_share = 0.02):
+    '''
+    Synthetic raw pings of n_users over one day, sorted by user and timestamp.
+
+    mean_ping_interval is the mean number of seconds between pings of a user, gps_noise the standard deviation of the
+    position error in meters and duplicate_share the share of pings that are repeated in the same second.
+    '''
+    rng = np.random.default_rng(seed)
+    users = generate_users(n_users, rng)
+
+    n_pings = np.maximum(rng.poisson(86400 / mean_ping_interval, n_users), 1)
+    user = np.repeat(np.arange(n_users), n_pings)
+    n_duplicates = int(len(user) * duplicate_share)
+    duplicated = rng.integers(0, len(user), n_duplicates)
+
+    seconds = np.floor(rng.uniform(0, 86400, len(user)))
+    seconds = np.concatenate([seconds, seconds[duplicated]])
+    user = np.concatenate([user, user[duplicated]])
+    order = np.lexsort((seconds, user))
+    user, seconds = user[order], seconds[order]
+
+    leave_home, arrive_work = users.leave_home.values[user], users.arrive_work.values[user]
+    leave_work, arrive_home = users.leave_work.values[user], users.arrive_home.values[user]
+    # 0 at home, 1 at work, moving linearly between both during the commutes
+    progress = np.where(seconds < leave_work,
+                        np.clip((seconds - leave_home) / (arrive_work - leave_home), 0, 1),
+                        1 - np.clip((seconds - leave_work) / (arrive_home - leave_work), 0, 1))
+    home_lat, home_lon = users.home_lat.values[user], users.home_lon.values[user]
+    lat = home_lat + progress * (users.work_lat.values[user] - home_lat)
+    lon = home_lon + progress * (users.work_lon.values[user] - home_lon)
+    lat, lon = _offset(lat, lon, np.abs(rng.normal(0, gps_noise, len(user))), rng.uniform(0, 2 * np.pi, len(user)))
+
+    foreign = rng.random(n_users) < 0.1
+    mcc = np.where(foreign, rng.choice(FOREIGN_MCCS, n_users), 268)
+    device = rng.integers(0, len(DEVICES), n_users)
+    imsis = np.array([f"268010{i:09d}" for i in range(n_users)], dtype=object)
+
+    pings = pd.DataFrame({config.USER_ID: imsis[user],
+                          "rec_timestamp": pd.Timestamp(day, tz="UTC") + pd.to_timedelta(seconds, unit="s"),
+                          "lat": lat,
+                          "lon": lon,
+                          "mcc": mcc[user],
+                          "ue_type_vendor_name": np.array([d[0] for d in DEVICES])[device][user],
+                          "ue_type_model_name": np.array([d[1] for d in DEVICES])[device][user],
+                          "day_part": pd.Timestamp(day).date()})
+    # the raw table also holds the location quality used to filter the pings in the trajectory queries
+    pings["location_data_quality_score_name"] = rng.choice(["high", "medium", "low"], len(pings), p=[0.6, 0.3, 0.1])
+
+    return pings
+
+
+def _around(rng, thresholds, n_rows, high):
+    # values exactly on, just below and just above the thresholds, missing and uniform in [0, high)
+    special = np.array([value + offset for value in thresholds for offset in (-0.5, 0.0, 0.5)] + [np.nan])
+    return np.where(rng.random(n_rows) < 0.5, rng.choice(special, n_rows), rng.uniform(0, high, n_rows))
+
+
+def generate_profiles(n_rows, seed = 0):
+    '''
+    Synthetic merged profiles of BB9 (new profile _x, previous profile _y) with the columns read by the residential
+    status rules, on both sides of every threshold of config.
+    '''
+    rng = np.random.default_rng(seed)
+    statuses = np.array(RESIDENTIAL_STATUSES, dtype=object)
+    return pd.DataFrame({config.USER_ID: np.arange(n_rows).astype(str),
+                         "mcc": rng.choice(['268', '214', '234'], n_rows),
+                         "length_of_stay": rng.integers(0, 8, n_rows).astype(float),
+                         "night_count": rng.integers(0, 8, n_rows).astype(float),
+                         "stay_time_night": _around(rng, [config.max_commute_time, config.min_night_stay_time], n_rows, 600),
+                         "stay_time_day": _around(rng, [config.max_commute_time], n_rows, 600),
+                         "residential_status_x": rng.choice(statuses, n_rows),
+                         "residential_status_y": rng.choice(statuses, n_rows)})
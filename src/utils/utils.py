@@ -3,6 +3,8 @@ import numpy as np
 from s2sphere import CellId, LatLng, Cell
 import s2cell
 import utils.config as config
+from utils.s2_covering import cached_covering_cell_ids, union_covering_cell_ids
+from utils.cell_index import get_cell_index
 import pandas as pd
 import h3
 
@@ -57,129 +59,58 @@ def get_square_polygon_from_coordinates(longitude, latitude, area):
 
 
 
-def polygon_to_s2list(polygon, bq_client):
-    
+def to_lon_lat_polygon(polygon):
+    '''
+    Polygon in (lon, lat) from a shapely Polygon or a list of coordinates in any order.
+    '''
     if isinstance(polygon, Polygon):
         polygon = mapping(polygon)["coordinates"][0]
     
     if check_coordinates_order(polygon):
         polygon = list(map(swap_coordinates, polygon))
         
-    polygon = Polygon(polygon)
-    
-    sql = f"""WITH s2array AS (
-WITH polygon AS (
-SELECT '{polygon}' AS p
-)
-SELECT S2_COVERINGCELLIDS(ST_GEOGFROMTEXT(p), min_level => {config.s2_level}, max_level => {config.s2_level}, max_cells => 1000000) AS s2cells 
-FROM polygon
-)
-SELECT cell_ids FROM s2array, UNNEST(s2array.s2cells) as cell_ids"""
-
-    polygon_s2_cover = bq_client.query(sql).to_dataframe()
-    
-    return polygon_s2_cover.cell_ids.values
+    return Polygon(polygon)
 
 
-def list_polygon_to_s2list(list_of_polygons, bq_client):
+def polygon_to_s2list(polygon, bq_client = None):
+    '''
+    Cells at config.s2_level covering the polygon. The covering is computed locally (utils.s2_covering), bq_client is
+    not used anymore.
+    '''
+    return cached_covering_cell_ids(to_lon_lat_polygon(polygon))
+
+
+def list_polygon_to_s2list(list_of_polygons, bq_client = None):
     
-    s2ids = np.array([])
-    for polygon in list_of_polygons:
-        s2ids = np.union1d(s2ids, polygon_to_s2list(polygon, bq_client))
-    return s2ids
+    return union_covering_cell_ids([to_lon_lat_polygon(polygon) for polygon in list_of_polygons])
 
 
+def s2list_to_codes(s2ids, code_column, bq_client, project_dataset):
+    '''
+    Distinct codes (sccode, frcode, ...) of the polygons with the given cells, from the cell index.
+    '''
+    _, codes = get_cell_index(bq_client, project_dataset).join(s2ids, code_column)
+    return np.unique(codes)
+
 
 def polygon_to_section(polygon, bq_client, project_dataset):
     
-    if isinstance(polygon, Polygon):
-        polygon = mapping(polygon)["coordinates"][0]
-    
-    if check_coordinates_order(polygon):
-        polygon = list(map(swap_coordinates, polygon))
-        
-    polygon = Polygon(polygon)
-    
-    sql = f"""WITH s2array AS (
-                  WITH polygon AS (
-                      SELECT '{polygon}' AS p
-                  )
-                  SELECT S2_COVERINGCELLIDS(ST_GEOGFROMTEXT(p), 
-                                                 min_level => {config.s2_level}, 
-                                                 max_level => {config.s2_level}, 
-                                                 max_cells => 1000000) AS s2cells 
-                  FROM polygon
-              ),
-              s2cells AS (
-                  SELECT CAST(cell_ids AS STRING) AS cell_ids
-                  FROM s2array, UNNEST(s2array.s2cells) as cell_ids
-              ),
-              scc_mapper AS (
-                  SELECT DISTINCT s2code, sccode
-                  FROM {project_dataset}.{config.table_polygons}
-                  WHERE polygon_description = "Celula"
-              )
-              SELECT DISTINCT scc_mapper.sccode
-              FROM s2cells INNER JOIN scc_mapper ON s2cells.cell_ids = scc_mapper.s2code
-            """
-
-    polygon_section_cover = bq_client.query(sql).to_dataframe()
-    
-    return polygon_section_cover.sccode.values
+    return s2list_to_codes(polygon_to_s2list(polygon), "sccode", bq_client, project_dataset)
 
 
 def list_polygon_to_section(list_of_polygons, bq_client, project_dataset):
     
-    sections = np.array([])
-    for polygon in list_of_polygons:
-        sections = np.union1d(sections, polygon_to_section(polygon, bq_client, project_dataset))
-    return sections
+    return s2list_to_codes(list_polygon_to_s2list(list_of_polygons), "sccode", bq_client, project_dataset)
 
 
 def polygon_to_freguesia(polygon, bq_client, project_dataset):
     
-    if isinstance(polygon, Polygon):
-        polygon = mapping(polygon)["coordinates"][0]
-    
-    if check_coordinates_order(polygon):
-        polygon = list(map(swap_coordinates, polygon))
-        
-    polygon = Polygon(polygon)
-    
-    sql = f"""WITH s2array AS (
-                  WITH polygon AS (
-                      SELECT '{polygon}' AS p
-                  )
-                  SELECT S2_COVERINGCELLIDS(ST_GEOGFROMTEXT(p), 
-                                                 min_level => {config.s2_level}, 
-                                                 max_level => {config.s2_level}, 
-                                                 max_cells => 1000000) AS s2cells
-                  FROM polygon
-              ),
-              s2cells AS (
-                  SELECT CAST(cell_ids AS STRING) AS cell_ids 
-                  FROM s2array, UNNEST(s2array.s2cells) as cell_ids
-              ),
-              frc_mapper AS (
-                  SELECT DISTINCT s2code, frcode
-                  FROM {project_dataset}.{config.table_polygons}
-                  WHERE polygon_description = "Celula"
-              )
-              SELECT DISTINCT frc_mapper.frcode
-              FROM s2cells INNER JOIN frc_mapper ON s2cells.cell_ids = frc_mapper.s2code
-            """
-
-    polygon_freguesia_cover = bq_client.query(sql).to_dataframe()
-    
-    return polygon_freguesia_cover.frcode.values
+    return s2list_to_codes(polygon_to_s2list(polygon), "frcode", bq_client, project_dataset)
 
 
 def list_polygon_to_freguesia(list_of_polygons, bq_client, project_dataset):
     
-    freguesias = np.array([])
-    for polygon in list_of_polygons:
-        freguesias = np.union1d(freguesias, polygon_to_freguesia(polygon, bq_client, project_dataset))
-    return freguesias
+    return s2list_to_codes(list_polygon_to_s2list(list_of_polygons), "frcode", bq_client, project_dataset)
 
 
 
@@ -198,38 +129,140 @@ def get_s2_centroid(s2cell_id):
     return s2cell.cell_id_to_lat_lon(s2cell_id)
 
 
-def zero_pad_results(df, target_col, hourly = True):
-    
+def demo_time_bins(hourly = True):
+    '''
+    The (day, hour) pairs of the demo hours, or the dates of the demo days.
+    '''
     if hourly:
         datetimes = [pd.Timestamp(config.start_datetime_demo_prev) + pd.Timedelta(hours=i) for i in range(config.demo_number_hours_prev)]
-        days = [date.date() for date in datetimes]
-        hours = [date.hour for date in datetimes]
-        base_df =  pd.DataFrame.from_dict({"day": days, "hour": hours, "number": [0 for i in range(config.demo_number_hours_prev)]})
-        aggregation_column = ["day", "hour"]
-    else:
-        days = [(pd.Timestamp(config.start_datetime_demo_prev.split(" ")[0]) + pd.Timedelta(days=i)).date() for i in range(config.demo_number_days)]
-        base_df =  pd.DataFrame.from_dict({"date": days, "number": [0 for i in range(config.demo_number_days)]})
-        aggregation_column = "date"
-    
-    
-    merged_df = base_df.merge(df, on=aggregation_column, how="left")
-    merged_df[target_col] = np.fmax(merged_df["number"], merged_df[target_col])
-    
-    return merged_df.drop(columns=["number"])
+        return [(date.date(), date.hour) for date in datetimes]
+    return [(pd.Timestamp(config.start_datetime_demo_prev.split(" ")[0]) + pd.Timedelta(days=i)).date() for i in range(config.demo_number_days)]
 
 
-def zero_pad_results_single_day(df, target_col):
-    
-    day = str(df.datetime.iloc[0].date())
-    datetimes = [pd.to_datetime(f"{day} {hour:02d}:00:00", utc=True) for hour in range(24)]
-    base_df =  pd.DataFrame.from_dict({"datetime": datetimes, "number": [0 for i in range(24)]})
-    
-    merged_df = base_df.merge(df, on="datetime", how="left")
-    merged_df[target_col] = np.fmax(merged_df["number"], merged_df[target_col])
-    
-    return merged_df.drop(columns=["number"])
+def demo_time_domain(hourly = True):
+    '''
+    The demo time bins as a domain of densify, over the day and hour columns or the date column.
+    '''
+    return {("day", "hour"): demo_time_bins(True)} if hourly else {"date": demo_time_bins(False)}
 
 
+def dimension_values(values):
+    '''
+    The values of a dimension of an aggregation: the categories of a categorical column, its sorted distinct values
+    otherwise.
+    '''
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return list(values.cat.categories)
+    return sorted(values.dropna().unique())
+
+
+def densify(df, domains, fill_value = 0):
+    '''
+    Dense version of the aggregated frame df, with one row for every combination of the values of the domains and
+    fill_value in the other columns for the combinations df does not have. domains maps a column (or a tuple of columns,
+    with tuples of values) to its values, the first domain varying slowest. Rows of df outside the domains are dropped.
+    '''
+    total = int(np.prod([len(values) for values in domains.values()]))
+    arrays, names, repeats = [], [], total
+    for columns, values in domains.items():
+        repeats //= max(len(values), 1)
+        positions = np.tile(np.repeat(np.arange(len(values)), repeats), total // max(repeats * len(values), 1))
+        columns = columns if isinstance(columns, tuple) else (columns,)
+        for k, column in enumerate(columns):
+            arrays.append(pd.Index([value[k] for value in values] if len(columns) > 1 else list(values)).take(positions))
+            names.append(column)
+    
+    # categorical keys are matched by value
+    keys = [df[name].astype(df[name].cat.categories.dtype) if isinstance(df[name].dtype, pd.CategoricalDtype) else df[name] 
+            for name in names]
+    # a single key is a plain index, a one-level MultiIndex does not match on reindex
+    index = pd.MultiIndex.from_arrays if len(names) > 1 else lambda arrays, names: pd.Index(arrays[0], name=names[0])
+    values = df.drop(columns=names).set_index(index(keys, names=names))
+    dense = values.reindex(index(arrays, names=names), fill_value=fill_value)
+    return dense.reset_index()
+
+
+def _key_codes(values):
+    # codes of the values (-1 when missing) and the values of the codes
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.values.astype("int64"), values.cat.categories
+    codes, uniques = pd.factorize(values, sort=True)
+    return codes.astype("int64"), uniques
+
+
+def rollup(df, grouping_sets, aggregations, total_label = "total"):
+    '''
+    Aggregation of df by every grouping set (list of key columns) in one pass, as GROUP BY GROUPING SETS: the keys are
+    coded once and every set is aggregated from the codes, the rows of a set have total_label in the keys outside the
+    set. aggregations maps every output column to (column, "sum" | "nunique" | "size"), distinct values are counted by
+    sorting the (group, value) pairs. Rows with a missing key are dropped, as groupby does, and only the groups with
+    rows are returned, one set after the other, by key. Categorical keys stay categorical with total_label added.
+    '''
+    keys = list(dict.fromkeys(key for grouping_set in grouping_sets for key in grouping_set))
+    codes, uniques = {}, {}
+    for key in keys:
+        codes[key], uniques[key] = _key_codes(df[key])
+    valid = np.all([codes[key] >= 0 for key in keys], axis=0) if keys else np.ones(len(df), dtype=bool)
+    codes = {key: key_codes[valid] for key, key_codes in codes.items()}
+
+    values = {}
+    for column, function in set(aggregations.values()):
+        if function == "nunique":
+            values[column, function] = _key_codes(df[column])[0][valid]
+        elif function == "sum":
+            values[column, function] = df[column].fillna(0).values[valid]
+
+    results = []
+    for grouping_set in grouping_sets:
+        group = np.zeros(int(valid.sum()), dtype="int64")
+        for key in grouping_set:
+            group = group * len(uniques[key]) + codes[key]
+        groups, group = np.unique(group, return_inverse=True)
+
+        result = {}
+        for key in reversed(grouping_set):
+            result[key] = uniques[key].take(groups % len(uniques[key]))
+            groups = groups // len(uniques[key])
+        result = pd.DataFrame({key: result[key] if key in grouping_set else total_label for key in keys},
+                              index=pd.RangeIndex(len(result[grouping_set[0]]) if grouping_set else int(len(group) > 0)))
+
+        for output, (column, function) in aggregations.items():
+            if function == "size":
+                result[output] = np.bincount(group, minlength=len(result))
+            elif function == "sum":
+                sums = np.bincount(group, weights=values[column, function], minlength=len(result))
+                result[output] = sums.astype(df[column].dtype) if df[column].dtype.kind in "iu" else sums
+            elif function == "nunique":
+                value = values[column, function]
+                pairs = np.unique(group[value >= 0] * (value.max(initial=0) + 1) + value[value >= 0])
+                result[output] = np.bincount(pairs // (value.max(initial=0) + 1), minlength=len(result))
+        results.append(result)
+
+    result = pd.concat(results, ignore_index=True)
+    for key in keys:
+        if isinstance(df[key].dtype, pd.CategoricalDtype):
+            result[key] = pd.Categorical(result[key], categories=list(uniques[key]) + [total_label],
+                                         ordered=df[key].cat.ordered)
+    return result
+
+
+def elect_top(df, group_column, sort_columns, eligible, label_column, others = None, relabel_others = True):
+    '''
+    Election of the home / work place of every group (user) of df in one pass: the eligible rows (boolean mask) are
+    sorted once by group and sort_columns in descending order, the first row of every group is labelled 'yes' and the
+    other ones 'other'. They are followed by the other rows (others, ~eligible by default), labelled 'other' unless
+    relabel_others is False, as the groupby-apply sort and append it replaces.
+    '''
+    others = ~eligible if others is None else others
+    elected = df.loc[eligible].sort_values([group_column] + sort_columns, ascending=[True] + [False] * len(sort_columns),
+                                           kind="stable")
+    elected[label_column] = np.where(elected[group_column].duplicated().values, "other", "yes")
+
+    rest = df.loc[others].copy()
+    if relabel_others:
+        rest[label_column] = "other"
+    return pd.concat([elected, rest], ignore_index=True)
+
 
 def split_dates(start_time, end_time, granularity):
     
@@ -243,27 +276,68 @@ def split_dates(start_time, end_time, granularity):
     return days_hours
 
 
-def align_user_table(polygon, user_table):
-    
-    column_to_use = {'Concelho': "cocode", 
+def split_into_bins(time_in, time_out, bin_width):
+    '''
+    Split the intervals (time_in, time_out) into the time bins of width bin_width they overlap (a Timedelta or a string
+    as "15min", "1h" or "1D", bins aligned to midnight UTC). An interval is in the bins with start < time_out and
+    end > time_in. Returns the position of the interval, the start of the bin and the seconds of the interval inside
+    the bin for every (interval, bin) pair.
+    '''
+    width = pd.Timedelta(bin_width).value
+    time_in = pd.to_datetime(pd.Series(time_in), utc=True).values.view("int64")
+    time_out = pd.to_datetime(pd.Series(time_out), utc=True).values.view("int64")
+
+    first_bin = time_in // width
+    counts = np.maximum(-(-time_out // width) - first_bin, 0)
+    positions = np.repeat(np.arange(len(time_in)), counts)
+    bins = np.repeat(first_bin, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    nanoseconds = np.minimum(time_out[positions], (bins + 1) * width) - np.maximum(time_in[positions], bins * width)
+    return positions, pd.to_datetime(bins * width, utc=True), nanoseconds / 1e9
+
+
+USER_TABLE_COLUMN = {'Concelho': "cocode", 
                      'Celula': "sccode", 
                      'Secção': "sccode", 
                      'Freguesia': "frcode", 
                      'Subsecção': "sccode", 
                      'POI': "sccode"}
+
+RESIDENTIAL_STATUSES = ["resident", "national tourist", 'international tourist', "regular visitor", "casual visitor", "commuter"]
+
+MODES_OF_TRANSPORT = ["train",'car', 'walk', 'bus', 'bike', "stationary", "undefined"]
+
+
+def align_user_table(polygon, user_table):
     
-    target_column = column_to_use[polygon["polygon_description"]]
+    target_column = USER_TABLE_COLUMN[polygon["polygon_description"]]
     
     red_user_table = user_table.loc[user_table["polygon_id"] == polygon[target_column], 
                           [config.USER_ID, "residential_status"]]
     
     red_user_table["residential_status"] = pd.Categorical(red_user_table["residential_status"], 
-                                                          categories=["resident", "national tourist", 'international tourist', 
-                                                                      "regular visitor", "casual visitor", "commuter"], ordered=True)
+                                                          categories=RESIDENTIAL_STATUSES, ordered=True)
     
     return red_user_table
 
 
+def align_user_tables(polygons, user_table):
+    '''
+    align_user_table of all the rows of polygons at once, with the position of the polygon in polygons in the
+    polygon_position column.
+    '''
+    user_polygons = pd.DataFrame({"polygon_position": np.arange(len(polygons)),
+                                  "polygon_id": [polygon[USER_TABLE_COLUMN[polygon["polygon_description"]]] 
+                                                 for _, polygon in polygons.iterrows()]})
+    
+    red_user_table = user_polygons.merge(user_table.loc[:, ["polygon_id", config.USER_ID, "residential_status"]], on="polygon_id")
+    
+    red_user_table["residential_status"] = pd.Categorical(red_user_table["residential_status"], 
+                                                          categories=RESIDENTIAL_STATUSES, ordered=True)
+    
+    return red_user_table.loc[:, ["polygon_position", config.USER_ID, "residential_status"]]
+
+
 def align_user_table_old(polygon, user_table):
     
     column_to_use = {'Concelho': "cocode", 
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+import utils.config as config
+from utils.point_in_polygon import PolygonIndex
+
+
+'''
+Visits of the users to polygons, for many polygons at once, replacing the LAG / ROW_NUMBER queries that pair the points
+where a user enters a polygon with the points where the user leaves it.
+
+The points of the users are read once, in (user, datetime) order, and joined with all the polygons in memory. A visit
+is a run of consecutive points of a user inside a polygon: it starts at the first point of the run (time_in) and ends
+at the first point after the run (time_out). A run that lasts until the last point of the user has no end and is not
+a visit.
+'''
+
+
+def extract_visits(point_users, point_positions, polygon_positions):
+    '''
+    Visits from the distinct (point, polygon) pairs of the points inside the polygons, with the points numbered in
+    (user, datetime) order and point_users the user of every point. Returns the polygon, the first point and the end
+    point of every visit, by polygon and first point.
+    '''
+    point_users = np.asarray(point_users)
+    first = np.ones(len(point_users), dtype=bool)
+    first[1:] = point_users[1:] != point_users[:-1]
+    last = np.append(first[1:], True)
+
+    order = np.lexsort((point_positions, polygon_positions))
+    points, polygons = np.asarray(point_positions)[order], np.asarray(polygon_positions)[order]
+
+    # a run continues while the next pair is the next point of the same user, in the same polygon
+    run_start = np.ones(len(points), dtype=bool)
+    run_start[1:] = (polygons[1:] != polygons[:-1]) | (points[1:] != points[:-1] + 1) | first[points[1:]]
+    starts = np.flatnonzero(run_start)
+    run_last = points[(np.append(starts[1:], len(points)) - 1)[:len(starts)]]
+
+    closed = ~last[run_last]
+    return polygons[starts][closed], points[starts][closed], run_last[closed] + 1
+
+
+def filter_visits(visits, threshold_inside = config.THRESHOLD_VISIT_INSIDE, threshold_outside = config.THRESHOLD_VISIT_OUTSIDE):
+    '''
+    Visits of at least threshold_inside seconds that start at least threshold_outside seconds after the end of the
+    previous visit of the user to the polygon (kept or not).
+    '''
+    if len(visits) == 0:
+        return visits
+    visits = visits.sort_values(["polygon_position", config.USER_ID, "time_in"], kind="stable").reset_index(drop=True)
+    same_group = (visits.polygon_position == visits.polygon_position.shift()) & (visits[config.USER_ID] == visits[config.USER_ID].shift())
+    prev_time_out = visits.time_out.shift().where(same_group)
+
+    # TIMESTAMP_DIFF(..., SECOND) counts whole seconds
+    time_inside = np.trunc((visits.time_out - visits.time_in).dt.total_seconds())
+    time_outside = np.trunc((visits.time_in - prev_time_out).dt.total_seconds())
+    keep = (time_inside >= threshold_inside) & (prev_time_out.isna() | (time_outside >= threshold_outside))
+    return visits.loc[keep].reset_index(drop=True)
+
+
+def get_polygon_visits(polygons, condition, project_dataset, bq_client, by_day = False):
+    '''
+    Visits to every polygon (shapely, in lon/lat) of the points of trajectory_details that satisfy the SQL condition,
+    with the position of the polygon in polygons, the user, time_in and time_out. With by_day, the visits of every day
+    are made of the points of the day only, as with a DATE(datetime) = day condition per day.
+    '''
+    query = f"""SELECT {config.USER_ID}, datetime, ST_X(geography) AS lon, ST_Y(geography) AS lat
+                FROM {project_dataset}.{config.table_trajectory_details}
+                WHERE {condition}
+                ORDER BY {config.USER_ID}, datetime"""
+
+    points = bq_client.query(query).to_dataframe()
+
+    point_positions, polygon_positions = PolygonIndex(polygons).join(points.lon.values, points.lat.values)
+    point_users = points[config.USER_ID].values
+    if by_day and len(points) > 0:
+        # runs are cut where the user or the day changes
+        days = pd.to_datetime(points.datetime, utc=True).values.view("int64") // pd.Timedelta(days=1).value
+        point_users = pd.factorize(point_users)[0] * (days.max() - days.min() + 1) + (days - days.min())
+    polygon_positions, time_in, time_out = extract_visits(point_users, point_positions, polygon_positions)
+
+    return pd.DataFrame({"polygon_position": polygon_positions,
+                         config.USER_ID: points[config.USER_ID].values[time_in],
+                         "time_in": pd.to_datetime(points.datetime, utc=True).array[time_in],
+                         "time_out": pd.to_datetime(points.datetime, utc=True).array[time_out]})
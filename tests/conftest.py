@@ -0,0 +1,7 @@
+import os
+import sys
+
+
+# the modules import each other from src and src/preprocessing, as when they are run from there
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path[:0] = [SRC, os.path.join(SRC, "preprocessing")]
@@ -0,0 +1,82 @@
+from functools import partial
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("h3")
+import utils.config as config
+from utils.local_client import LocalClient
+from utils.s2_arrays import lon_lat_to_cell_ids, to_signed
+from building_blocks import BB5
+import backfill_cell_occupancy
+
+
+PROJECT_DATASET = "local.rw_data_west1"
+DAY = "2023-05-01"
+CUBE = f"{PROJECT_DATASET}.{config.table_cell_occupancy}"
+
+
+@pytest.fixture
+def details():
+    rng = np.random.default_rng(0)
+    n_points = 5000
+    lon, lat = rng.uniform(-9.15, -9.149, n_points), rng.uniform(38.70, 38.701, n_points)
+    return pd.DataFrame({config.USER_ID: [f"u{i}" for i in rng.integers(0, 300, n_points)],
+                         "datetime": pd.Timestamp(DAY, tz="UTC") + pd.to_timedelta(rng.integers(0, 86400, n_points), unit="s"),
+                         "lon": lon, "lat": lat})
+
+
+@pytest.fixture
+def client(tmp_path, details):
+    client = LocalClient(str(tmp_path))
+    geography = [f"POINT({lon} {lat})" for lon, lat in zip(details.lon, details.lat)]
+    client.load_table_from_dataframe(details.drop(columns=["lon", "lat"]).assign(geography = geography),
+                                     f"{PROJECT_DATASET}.{config.table_trajectory_details}")
+    return client
+
+
+def _insert_day(client):
+    # as the pipeline: the rows of the day are deleted before its hours are inserted
+    BB5.delete_cell_occupancy(DAY, PROJECT_DATASET, client)
+    for hour in range(0, 23):
+        this_hour = pd.Timestamp(f"{DAY} {hour:02d}:00:00")
+        BB5.insert_cell_occupancy(str(this_hour), str(this_hour + pd.Timedelta(hours=1)), PROJECT_DATASET, client)
+
+
+def _cube(client):
+    cube = client.query(f"SELECT s2_id, hour, unique_users FROM {CUBE}").to_dataframe()
+    return cube.sort_values(["s2_id", "hour"]).reset_index(drop=True)
+
+
+def _brute_force(details):
+    cells = to_signed(lon_lat_to_cell_ids(details.lon.values, details.lat.values, config.s2_level))
+    points = details.assign(s2_id = cells, hour = details.datetime.dt.hour)
+    points = points.loc[points.hour < 23]
+    counts = points.groupby(["s2_id", "hour"]).agg(unique_users = (config.USER_ID, "nunique")).reset_index()
+    return counts.sort_values(["s2_id", "hour"]).reset_index(drop=True)
+
+
+def test_cube_matches_the_details(client, details):
+    _insert_day(client)
+    expected = _brute_force(details)
+    pd.testing.assert_frame_equal(_cube(client), expected, check_dtype=False)
+
+    flow = BB5.large_traffic_flow(None, f"{DAY} 00:00:00", f"{DAY} 23:00:00", client, PROJECT_DATASET,
+                                  polygon_cover = list(expected.s2_id.unique()))
+    assert flow.count_people.sum() == expected.unique_users.sum()
+
+
+def test_reinserted_day_is_not_duplicated(client):
+    _insert_day(client)
+    first = _cube(client)
+    _insert_day(client)
+    pd.testing.assert_frame_equal(_cube(client), first)
+
+
+def test_backfill(client, tmp_path, details, monkeypatch):
+    client.flush()
+    monkeypatch.setattr(backfill_cell_occupancy, "run_hourly", partial(backfill_cell_occupancy.run_hourly, n_jobs = 1))
+    backfill_cell_occupancy.main(DAY, DAY, str(tmp_path))
+    backfill_cell_occupancy.main(DAY, DAY, str(tmp_path))
+    pd.testing.assert_frame_equal(_cube(LocalClient(str(tmp_path))), _brute_force(details), check_dtype=False)
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+import utils.config as config
+from utils.hll import sketch, merge_sketches, estimate, count_distinct
+
+
+ERROR_BOUND = 3 # standard errors, 1.04 / sqrt(2^precision) each
+
+
+def _users(seed = 0):
+    # groups from 10 to 50000 distinct users, every user seen several times
+    rng = np.random.default_rng(seed)
+    sizes = [10, 100, 1_000, 5_000, 20_000, 50_000]
+    frames = []
+    for group, size in enumerate(sizes):
+        users = rng.integers(0, 10**12, size).astype(str)
+        frames.append(pd.DataFrame({"group": group, config.USER_ID: rng.choice(users, 3 * size)}))
+    return pd.concat(frames, ignore_index=True)
+
+
+@pytest.mark.parametrize("precision", [10, 12, 14])
+def test_count_distinct_within_error_bound(precision):
+    df = _users()
+    exact = df.groupby("group")[config.USER_ID].nunique()
+    counts = count_distinct(sketch(df, ["group"], precision = precision), ["group"], precision = precision)
+    counts = counts.set_index("group").count_people
+
+    relative_error = (counts - exact).abs() / exact
+    assert (relative_error <= ERROR_BOUND * 1.04 / np.sqrt(2**precision)).all(), relative_error.to_dict()
+
+
+@pytest.mark.parametrize("precision", [10, 12, 14])
+def test_merge_of_partitions_is_sketch_of_union(precision):
+    df = _users(1)
+    partition = np.random.default_rng(2).integers(0, 3, len(df))
+    parts = pd.concat([sketch(df.loc[partition == k], ["group"], precision = precision) for k in range(3)],
+                      ignore_index=True)
+
+    merged = merge_sketches(parts, ["group"], precision = precision)
+    union = sketch(df, ["group"], precision = precision)
+    assert merged.group.tolist() == union.group.tolist()
+    assert merged.sketch.tolist() == union.sketch.tolist()
+
+
+def test_empty():
+    df = pd.DataFrame({"group": pd.Series([], dtype="int64"), config.USER_ID: pd.Series([], dtype=object)})
+    sketches = sketch(df, ["group"])
+    assert len(sketches) == 0
+    assert len(merge_sketches(sketches, ["group"])) == 0
+    assert len(count_distinct(sketches, ["group"])) == 0
+    assert estimate([b""]).tolist() == [0]
+
+
+def test_missing_users():
+    df = pd.DataFrame({"group": [0, 0, 1], config.USER_ID: [np.nan, None, np.nan]})
+    sketches = sketch(df, ["group"])
+    assert sketches.sketch.tolist() == [b"", b""]
+    assert count_distinct(sketches, ["group"]).count_people.tolist() == [0, 0]
@@ -0,0 +1,48 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("google.cloud.bigquery")
+from utils.local_client import LocalClient
+from utils.profile_store import BigQueryProfileStore
+
+
+TABLE = "night_location"
+
+
+def _profile(users, home):
+    return pd.DataFrame({"imsi": users, "s2code": [str(home)] * len(users), "day_part": pd.Timestamp("2023-05-01").date()})
+
+
+def _sorted(rows):
+    return rows.sort_values(["imsi", "s2code"]).reset_index(drop=True)
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = LocalClient(str(tmp_path))
+    client.load_table_from_dataframe(_profile(["u1", "u2", "u3"], 1), f"p.ds.{TABLE}")
+    return client
+
+
+def test_replace_only_the_users_read(client, tmp_path):
+    store = BigQueryProfileStore(client, "p.ds", TABLE)
+    assert sorted(store.read(["u1", "u2", "u9"]).imsi) == ["u1", "u2"]
+    store.replace(pd.concat([_profile(["u1", "u9"], 2), _profile(["u1"], 3)]))
+    client.flush()
+
+    expected = pd.concat([_profile(["u1", "u9"], 2), _profile(["u1"], 3), _profile(["u3"], 1)])
+    stored = LocalClient(str(tmp_path)).query(f"SELECT imsi, s2code, day_part FROM p.ds.{TABLE}").to_dataframe()
+    stored["day_part"] = pd.to_datetime(stored.day_part).dt.date
+    pd.testing.assert_frame_equal(_sorted(stored), _sorted(expected))
+
+
+def test_failed_replace_keeps_the_table(client):
+    store = BigQueryProfileStore(client, "p.ds", TABLE)
+    store.read(["u1", "u2"])
+    with pytest.raises(Exception):
+        # the INSERT fails on the unknown column, after the DELETE
+        store.replace(_profile(["u1"], 2).assign(unknown = 1))
+
+    stored = client.query(f"SELECT imsi, s2code FROM p.ds.{TABLE}").to_dataframe()
+    assert sorted(stored.imsi) == ["u1", "u2", "u3"]
+    assert set(stored.s2code) == {"1"}
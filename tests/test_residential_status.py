@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+from utils.synthetic_data import generate_profiles
+
+pytest.importorskip("google.cloud.bigquery")
+pytest.importorskip("h3")
+from building_blocks.BB9 import residential_status, get_res_status
+
+
+def _assert_same_statuses(profiles):
+    # row for row, missing statuses (None or NaN) are equal
+    statuses = pd.Series(residential_status(profiles), dtype=object).fillna("missing")
+    reference = pd.Series(profiles.apply(get_res_status, axis=1).values, dtype=object).fillna("missing")
+    assert len(statuses) == len(profiles)
+    pd.testing.assert_series_equal(statuses, reference)
+
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_residential_status_matches_row_by_row_rules(seed):
+    _assert_same_statuses(generate_profiles(20_000, seed))
+
+
+def test_integer_mcc():
+    profiles = generate_profiles(5_000, 3)
+    profiles["mcc"] = np.where(profiles.mcc == '268', 268, 214)
+    _assert_same_statuses(profiles)
+
+
+def test_empty():
+    assert len(residential_status(generate_profiles(0))) == 0
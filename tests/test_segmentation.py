@@ -0,0 +1,61 @@
+from types import SimpleNamespace
+import numpy as np
+import pandas as pd
+import pytest
+import utils.config as config
+from utils.synthetic_data import generate_pings
+import segment_trajectories
+import segment_trajectories_vectorized
+
+
+@pytest.fixture(autouse=True)
+def distance_function(monkeypatch):
+    # great circle distance in meters, for the environments where config has no distance_function
+    def great_circle(point_1, point_2):
+        lat_1, lon_1, lat_2, lon_2 = np.radians([point_1[0], point_1[1], point_2[0], point_2[1]])
+        h = np.sin((lat_2 - lat_1) / 2)**2 + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2)**2
+        return SimpleNamespace(meters = 2 * 6371000 * np.arcsin(np.sqrt(h)))
+    if not hasattr(config, "distance_function"):
+        monkeypatch.setattr(config, "distance_function", great_circle, raising=False)
+
+
+def _edge_case_pings(template):
+    # a single ping user, stops of exactly NEW_TRAJECTORY_TIME_THRESHOLD seconds and of one second more, a trip over
+    # midnight. The stops are between pings that move 30 m around a point, kept by the compression, their 5 point
+    # median does not move so the stop splits the trajectory when it is longer than the threshold
+    start = pd.Timestamp("2023-05-01 10:00:00", tz="UTC")
+    rows = [("single", start, 38.72, -9.14)]
+    for user, stop in [("threshold", config.NEW_TRAJECTORY_TIME_THRESHOLD), ("over_threshold", config.NEW_TRAJECTORY_TIME_THRESHOLD + 1)]:
+        times = [start + pd.Timedelta(seconds=60 * k + (stop - 60) * (k >= 8)) for k in range(16)]
+        rows += [(user, time, 38.72 + [0, 2.7e-4, -2.7e-4][k % 3], -9.14) for k, time in enumerate(times)]
+    midnight = pd.Timestamp("2023-05-01 23:50:00", tz="UTC")
+    rows += [("midnight", midnight + pd.Timedelta(minutes=k), 38.72 + 0.002 * k, -9.14) for k in range(20)]
+
+    pings = pd.DataFrame(rows, columns=[config.USER_ID, "rec_timestamp", "lat", "lon"])
+    for column in template.columns.difference(pings.columns):
+        pings[column] = template[column].iloc[0]
+    pings["day_part"] = pings.rec_timestamp.dt.date
+    return pings.loc[:, template.columns]
+
+
+def _sorted(df, keys):
+    return df.sort_values(keys).reset_index(drop=True)
+
+
+def test_vectorized_segmentation_matches_reference():
+    pings = generate_pings(40, seed=0)
+    pings = pd.concat([pings, _edge_case_pings(pings)], ignore_index=True)
+
+    details, trajectories = segment_trajectories.process_finished_trajectories(pings.copy())
+    vectorized_details, vectorized_trajectories = segment_trajectories_vectorized.process_finished_trajectories(pings.copy())
+
+    keys = [config.USER_ID, "datetime"]
+    pd.testing.assert_frame_equal(_sorted(vectorized_details, keys), _sorted(details, keys).loc[:, vectorized_details.columns],
+                                  check_dtype=False)
+    keys = [config.USER_ID, "start_time"]
+    pd.testing.assert_frame_equal(_sorted(vectorized_trajectories, keys),
+                                  _sorted(trajectories, keys).loc[:, vectorized_trajectories.columns], check_dtype=False)
+
+    # only the stop longer than the threshold splits the trajectory, the trip over midnight is one trajectory
+    users = vectorized_trajectories.groupby(config.USER_ID).size()
+    assert users["single"] == 1 and users["threshold"] == 1 and users["over_threshold"] == 2 and users["midnight"] == 1
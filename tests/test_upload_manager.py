@@ -0,0 +1,63 @@
+import pandas as pd
+import pytest
+
+bigquery = pytest.importorskip("google.cloud.bigquery")
+from utils.bigquery_utils import UploadManager, upload_table_bq
+
+
+class _Job:
+
+    def result(self):
+        return self
+
+
+class _RecordingClient:
+
+    def __init__(self):
+        self.loads = []
+        self.queries = []
+
+    def load_table_from_dataframe(self, dataframe, destination, job_config = None):
+        self.loads.append((dataframe, destination, job_config))
+        return _Job()
+
+    def query(self, query, *args, **kwargs):
+        self.queries.append(query)
+        return _Job()
+
+
+def _details(n_rows, offset = 0):
+    return pd.DataFrame({"imsi": [f"u{i}" for i in range(offset, offset + n_rows)],
+                         "datetime": pd.Timestamp("2023-05-01", tz="UTC") + pd.to_timedelta(range(n_rows), unit="s"),
+                         "geography": ["POINT(-9.1 38.7)"] * n_rows})
+
+
+def test_partial_schema_batch_is_loaded_from_the_frame():
+    client = _RecordingClient()
+    manager = UploadManager(client, batch_bytes = 1 << 40)
+    upload_table_bq(_details(3), "p.ds.details", {"geography": "geography"}, manager)
+    upload_table_bq(_details(2, 3), "p.ds.details", {"geography": "geography"}, manager)
+    assert client.loads == []
+    manager.flush()
+
+    assert len(client.loads) == 1
+    batch, destination, job_config = client.loads[0]
+    # only the overridden field is in the schema, the other columns are taken from the frame or the table
+    assert [field.name for field in job_config.schema] == ["geography"]
+    assert str(job_config.write_disposition).endswith("WRITE_APPEND")
+    assert destination == "p.ds.details"
+    assert list(batch.columns) == ["imsi", "datetime", "geography"]
+    assert batch.imsi.tolist() == [f"u{i}" for i in range(5)]
+
+
+def test_query_flushes_the_tables_it_reads():
+    client = _RecordingClient()
+    manager = UploadManager(client, batch_bytes = 1 << 40)
+    upload_table_bq(_details(3), "p.ds.details", {}, manager)
+    upload_table_bq(_details(3), "p.ds.stays", {}, manager)
+    manager.query("SELECT * FROM p.ds.details")
+
+    assert [destination for _, destination, _ in client.loads] == ["p.ds.details"]
+    assert client.queries == ["SELECT * FROM p.ds.details"]
+    manager.flush()
+    assert [destination for _, destination, _ in client.loads] == ["p.ds.details", "p.ds.stays"]